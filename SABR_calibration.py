@@ -1,43 +1,106 @@
 import SABR_functions as sabr
-from scipy.optimize import minimize
+import numpy as np
+from scipy.optimize import minimize, OptimizeResult
+from instrumentation import metrics
 
+GRADIENT_FREE_METHODS = ("Nelder-Mead", "Powell", "COBYLA")
+# scipy option capping the function evaluations, the other methods are only stopped by the
+# max_evals wrapper below
+EVALUATION_OPTIONS = {"L-BFGS-B": "maxfun", "TNC": "maxfun", "Nelder-Mead": "maxfev", "Powell": "maxfev"}
 
-def calibrate_SABR(strikes, volatilities, forward, TTM, method='Nelder-Mead', init_param=[0.03, 1, -0.9, 0.1]):
+
+class _OutOfEvaluations(Exception):
+    pass
+
+# lower and upper bounds of alpha, beta, rho, nu (beta is fixed)
+PARAM_BOUNDS = {"alpha": [0.001, 8],
+                "beta": [1, 1],
+                "rho": [-0.99, 0.99],
+                "nu": [0.001, 10], }
+
+
+def calibrate_SABR(strikes, volatilities, forward, TTM, method='Nelder-Mead', init_param=[0.03, 1, -0.9, 0.1],
+                   max_evals=None, full_output=False):
     # strikes and vol
+    # max_evals caps the objective evaluations (scipy's maxfun can go a few over, the
+    # optimiser is stopped at the best point seen), full_output also returns the OptimizeResult
+
+    strikes = np.asarray(strikes, dtype=float)
+    volatilities = np.asarray(volatilities, dtype=float)
 
     def mse_function(params):
-        # mean squared error
+        # mean squared error, evaluated on all strikes at once
+        metrics.count("objective")
         alpha, beta, rho, nu = params
-        mse = 0
-        for i in range(len(strikes)):
-            temp = (volatilities[i]-sabr.strike_volatility_SABR(k=strikes[i],
-                    f=forward, alpha=alpha, beta=beta, nu=nu, rho=rho, t=TTM))**2
-            mse += temp
-        return mse
+        residuals = volatilities - sabr.strike_volatility_SABR(k=strikes,
+                                                                f=forward, alpha=alpha, beta=beta, nu=nu, rho=rho, t=TTM)
+        return np.sum(residuals**2)
+
+    def mse_and_gradient(params):
+        # mse with its analytic gradient, beta is fixed by its bounds so its component is 0
+        metrics.count("objective")
+        alpha, beta, rho, nu = params
+        vol, jac = sabr.strike_volatility_SABR_jacobian(k=strikes,
+                                                        f=forward, alpha=alpha, beta=beta, nu=nu, rho=rho, t=TTM)
+        residuals = volatilities - vol
+        d_alpha, d_rho, d_nu = -2*residuals @ jac
+        return np.sum(residuals**2), np.array([d_alpha, 0.0, d_rho, d_nu])
 
     def find_optimal_rho_nu(method=method):
 
         ALPHA, BETA, RHO, NU = init_param
 
-        PARAMS = {"alpha": {"x0": ALPHA, "lbub": [0.001, 8]},
-                  "beta": {"x0": BETA, "lbub": [1, 1]},
-                  "rho": {"x0": RHO, "lbub": [-0.99, 0.99]},
-                  "nu": {"x0": NU, "lbub": [0.001, 10]}, }
+        PARAMS = {"alpha": {"x0": ALPHA, "lbub": PARAM_BOUNDS["alpha"]},
+                  "beta": {"x0": BETA, "lbub": PARAM_BOUNDS["beta"]},
+                  "rho": {"x0": RHO, "lbub": PARAM_BOUNDS["rho"]},
+                  "nu": {"x0": NU, "lbub": PARAM_BOUNDS["nu"]}, }
 
         # calibrate rho, nu:
 
         x0 = [param["x0"] for key, param in PARAMS.items()]
         bounds = [param["lbub"] for key, param in PARAMS.items()]
 
-        result = minimize(mse_function, x0, tol=1e-7, method=method,
-                          options={'maxiter': 1e9}, bounds=bounds)
+        # Nelder-Mead is derivative free, the others get the mse and gradient in one call
+        if method in GRADIENT_FREE_METHODS:
+            fun, jac = mse_function, None
+        else:
+            fun, jac = mse_and_gradient, True
+
+        options = {'maxiter': 10**9}
+        if max_evals is not None and method in EVALUATION_OPTIONS:
+            options[EVALUATION_OPTIONS[method]] = int(max_evals)
+
+        calls, best = [0], [np.inf, np.asarray(x0, dtype=float)]
+
+        def capped(params):
+            if max_evals is not None and calls[0] >= max_evals:
+                raise _OutOfEvaluations
+            calls[0] += 1
+            value = fun(params)
+            mse = value[0] if jac else value
+            if mse < best[0]:
+                best[:] = [mse, np.array(params, dtype=float)]
+            return value
+
+        try:
+            result = minimize(capped, x0, tol=1e-7, method=method, jac=jac,
+                              options=options, bounds=bounds)
+        except _OutOfEvaluations:
+            result = OptimizeResult(x=best[1], fun=best[0], nfev=calls[0], nit=None, success=False,
+                                    status=-1, message="max_evals reached")
+        metrics.emit("optimizer", method=method, success=result.success, status=result.status,
+                     nfev=result.nfev, nit=result.get("nit"), fun=result.fun,
+                     message=result.message)
 
-        return result.x, mse_function(result.x)
+        # the optimiser's best point was evaluated already, no extra evaluation
+        return result, float(result.fun)
 
     if len(strikes) != len(volatilities):
-        print("! strike and volatilities not of same length !")
-        raise ValueError
+        raise ValueError("strike and volatilities not of same length")
 
-    [ALPHA, BETA, RHO, NU], mse = find_optimal_rho_nu()
+    result, mse = find_optimal_rho_nu()
+    [ALPHA, BETA, RHO, NU] = result.x
 
+    if full_output:
+        return [ALPHA, BETA, RHO, NU], mse, result
     return [ALPHA, BETA, RHO, NU], mse
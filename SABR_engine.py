@@ -0,0 +1,252 @@
+"""
+Batched multi-start SABR calibration.
+
+Instead of running number_of_tries full optimisations per quote side one after
+the other, every starting point of every side is stacked in one array:
+
+    strikes / vols  -> (sides, 1, strikes)
+    params          -> (sides, starts, 3)   [alpha, rho, nu], beta is fixed
+
+All the starts take Levenberg-Marquardt steps together (one stacked 3x3 solve
+per start and step, clipped to the parameter box) until they've converged to
+their local minimum. Only converged starts are pruned: the worse half of them is
+dropped after each round. The best n_polish distinct minima (basins) per side are
+then handed to scipy (SABR_calibration.calibrate_SABR) for the final fit.
+"""
+import time
+import numpy as np
+import SABR_functions as sabr
+import SABR_calibration as s
+from instrumentation import metrics
+
+# box of the batched [alpha, rho, nu]
+LOWER = np.array([s.PARAM_BOUNDS["alpha"][0],
+                  s.PARAM_BOUNDS["rho"][0],
+                  s.PARAM_BOUNDS["nu"][0]])
+UPPER = np.array([s.PARAM_BOUNDS["alpha"][1],
+                  s.PARAM_BOUNDS["rho"][1],
+                  s.PARAM_BOUNDS["nu"][1]])
+
+
+def stack_sides(strike_sets, vol_sets, forward):
+    """
+    Pads every side to the longest one, padded (and NaN) quotes sit at the forward with 0 weight
+
+    forward: one for all the sides or one per side
+
+    Returns strikes, vols and weights, (sides, strikes) arrays
+    """
+    n = max(len(k) for k in strike_sets)
+    forwards = np.broadcast_to(np.asarray(forward, dtype=float), (len(strike_sets),))
+    strikes = np.repeat(forwards[:, None], n, axis=1)
+    vols = np.zeros((len(strike_sets), n))
+    weights = np.zeros((len(strike_sets), n))
+    for i, (k, v) in enumerate(zip(strike_sets, vol_sets)):
+        k = np.asarray(k, dtype=float)
+        v = np.asarray(v, dtype=float)
+        valid = np.isfinite(k) & np.isfinite(v)
+        strikes[i, :len(k)] = np.where(valid, k, forwards[i])
+        vols[i, :len(v)] = np.where(valid, v, 0)
+        weights[i, :len(v)] = valid
+    return strikes, vols, weights
+
+
+def _batch_residuals(params, strikes, vols, weights, forward, TTM, beta):
+    """
+    params: (sides, starts, 3), returns the weighted residuals vols - SABR vols
+    (sides, starts, strikes) and the weighted SABR vol jacobian (sides, starts, strikes, 3)
+    """
+    alpha = params[..., 0:1]
+    rho = params[..., 1:2]
+    nu = params[..., 2:3]
+    k = strikes[:, None, :]
+    metrics.count("objective", params.shape[0]*params.shape[1])
+    vol, jac = sabr.strike_volatility_SABR_jacobian(k=k, f=forward, alpha=alpha, beta=beta,
+                                                    nu=nu, rho=rho, t=TTM)
+    w = weights[:, None, :]
+    return w*(vols[:, None, :] - vol), w[..., None]*jac
+
+
+def batch_mse(params, strikes, vols, weights, forward, TTM, beta):
+    """
+    params: (sides, starts, 3), returns mse (sides, starts) and its gradient (sides, starts, 3)
+    """
+    residuals, jac = _batch_residuals(params, strikes, vols, weights, forward, TTM, beta)
+    return np.sum(residuals**2, axis=-1), -2*np.einsum("snk,snkc->snc", residuals, jac)
+
+
+def _lm_system(residuals, jac):
+    # Gauss-Newton normal equations J'J delta = J'r of every start, NaNs (overflowing
+    # params) give a zero system, i.e. no step
+    jtj = np.nan_to_num(np.einsum("snkc,snkd->sncd", jac, jac))
+    jtr = np.nan_to_num(np.einsum("snkc,snk->snc", jac, residuals))
+    return jtj, jtr
+
+
+def _distinct_best(params, mse, n, tolerance=1e-3):
+    # indices of the n best candidates of a side that sit in different basins (more than
+    # tolerance apart in units of the parameter box)
+    chosen = []
+    for j in np.argsort(mse):
+        if all(np.max(np.abs(params[j] - params[i])/(UPPER - LOWER)) > tolerance for i in chosen):
+            chosen.append(j)
+        if len(chosen) == n:
+            break
+    return chosen
+
+
+def random_starts(rng, n_sides, number_of_tries, init_values=None):
+    """
+    Same draws as the original restarts: alpha, nu in U(0.01, 1) and rho in U(-1, 1)
+
+    init_values: [alpha, beta, rho, nu] tried first on every side, or one such list per side
+    """
+    starts = np.stack([rng.uniform(0.01, 1, (n_sides, number_of_tries)),
+                       rng.uniform(-1, 1, (n_sides, number_of_tries)),
+                       rng.uniform(0.01, 1, (n_sides, number_of_tries))], axis=-1)
+    if init_values is not None:
+        init_values = np.asarray(init_values, dtype=float)
+        first = np.broadcast_to(init_values[..., [0, 2, 3]].reshape(-1, 1, 3), (n_sides, 1, 3))
+        starts = np.concatenate([first, starts], axis=1)
+    return np.clip(starts, LOWER, UPPER)
+
+
+def calibrate_SABR_batch(strike_sets, vol_sets, forward, TTM, method='L-BFGS-B', number_of_tries=10,
+                         init_values=None, n_polish=2, steps_per_round=10, max_rounds=8, seed=None,
+                         max_evals=None, max_time=None, beta=1, polish=True, polish_evals=1000):
+    """
+    Calibrates SABR to several quote sides (e.g. call asks, call bids, put asks, put bids) at once
+
+    strike_sets, vol_sets: one array of strikes / vols (decimal, not %) per side
+    method: scipy method used to polish the best candidates
+    number_of_tries: random starting points per side
+    init_values: extra starting point, one for all the sides or one per side (see random_starts)
+    n_polish: number of distinct local minima per side passed to the scipy polish
+    steps_per_round: Levenberg-Marquardt steps between two prunings
+    max_rounds: rounds after which the starts still moving are taken as they are
+    polish: False keeps the best candidate of the batched rounds, no per side scipy fit
+            (e.g. hundreds of warm started bootstrap fits)
+    polish_evals: evaluations allowed to each scipy polish, the candidates are already
+                  converged and the methods without bounds (Newton-CG) can otherwise
+                  wander off for a very long time from a candidate on the box edge
+    seed: seed or np.random.Generator, same seed -> same fit
+    max_evals: budget of objective evaluations for the whole batch (all sides), a batched step
+               is only taken if all of its evaluations fit in it. The first evaluation of
+               the starts is always done
+    max_time: wall time budget in seconds
+
+    Returns one dict per side with "params" [alpha, beta, rho, nu], "mse", "nfev" and
+    "converged" (False when the fit kept was still moving at max_rounds or out of budget)
+    """
+    start_time = time.perf_counter()
+    rng = seed if isinstance(seed, np.random.Generator) else np.random.default_rng(seed)
+
+    if len(strike_sets) != len(vol_sets):
+        raise ValueError("strike and volatilities sets not of same length")
+
+    def out_of_budget(used):
+        if max_evals is not None and used >= max_evals:
+            return True
+        return max_time is not None and time.perf_counter() - start_time >= max_time
+
+    strikes, vols, weights = stack_sides(strike_sets, vol_sets, forward)
+    n_sides = len(strike_sets)
+    params = random_starts(rng, n_sides, number_of_tries, init_values)
+    n_polish = max(1, min(n_polish, params.shape[1]))
+    metrics.count("restarts", params.shape[0]*params.shape[1])
+
+    residuals, jac = _batch_residuals(params, strikes, vols, weights, forward, TTM, beta)
+    mse = np.sum(residuals**2, axis=-1)
+    jtj, jtr = _lm_system(residuals, jac)
+    damping = np.full(params.shape[:2], 1e-3)
+    active = np.ones(params.shape[:2], dtype=bool)  # dropped starts stay in the arrays, frozen
+    settled = np.zeros(params.shape[:2], dtype=bool)
+    identity = np.eye(3)
+    nfev = np.full(n_sides, params.shape[1])
+
+    # Levenberg-Marquardt rounds on all the starts together, after each round the worse
+    # half of the converged starts is pruned (a start still moving may be heading for a
+    # better basin than the ones found so far, it's never pruned)
+    for round in range(max_rounds):
+        if out_of_budget(nfev.sum() + params.shape[0]*params.shape[1]):
+            break
+        round_start = mse
+        moved = np.zeros(params.shape[:2], dtype=bool)
+        for _ in range(steps_per_round):
+            diagonal = jtj.diagonal(axis1=-2, axis2=-1)
+            system = jtj + (damping[..., None]*diagonal + 1e-12)[..., None]*identity
+            delta = np.linalg.solve(system, jtr[..., None])[..., 0]
+            trial = np.clip(params + delta, LOWER, UPPER)
+            trial_residuals, trial_jac = _batch_residuals(trial, strikes, vols, weights, forward, TTM, beta)
+            trial_mse = np.sum(trial_residuals**2, axis=-1)
+            nfev += params.shape[1]
+
+            better = (trial_mse < mse) & active
+            moved |= better
+            trial_jtj, trial_jtr = _lm_system(trial_residuals, trial_jac)
+            params = np.where(better[..., None], trial, params)
+            mse = np.where(better, trial_mse, mse)
+            jtj = np.where(better[..., None, None], trial_jtj, jtj)
+            jtr = np.where(better[..., None], trial_jtr, jtr)
+            damping = np.clip(np.where(better, damping/3, damping*4), 1e-9, 1e9)
+
+            if out_of_budget(nfev.sum() + params.shape[0]*params.shape[1]):
+                break
+
+        # a round of rejected steps says nothing, the damping has to saturate first
+        settled = (moved & (round_start - mse <= 1e-4*mse + 1e-14)) | (damping >= 1e9)
+        converged = settled | (round == max_rounds - 1)
+        if (converged | ~active).all():
+            break
+        # the worse half of each side's converged starts is dropped (at least n_polish of
+        # them are kept), then the arrays are shrunk to the most starts any side has left
+        ranked = np.where(converged & active, mse, np.inf)
+        rank = np.argsort(np.argsort(ranked, axis=1), axis=1)
+        n_converged = np.sum(converged & active, axis=1, keepdims=True)
+        keep = np.maximum(n_polish, (n_converged + 1)//2)
+        active &= ~converged | (rank < keep)
+        order = np.argsort(~active, axis=1, kind="stable")[:, :np.max(np.sum(active, axis=1))]
+        params = np.take_along_axis(params, order[..., None], axis=1)
+        mse = np.take_along_axis(mse, order, axis=1)
+        jtj = np.take_along_axis(jtj, order[..., None, None], axis=1)
+        jtr = np.take_along_axis(jtr, order[..., None], axis=1)
+        damping = np.take_along_axis(damping, order, axis=1)
+        active = np.take_along_axis(active, order, axis=1)
+        settled = np.take_along_axis(settled, order, axis=1)
+
+    # polish only the best few distinct minima per side with the full optimiser
+    results = []
+    for i in range(n_sides):
+        valid = weights[i] > 0
+        best_params = None
+        best_mse = float('inf')
+        best_converged = False
+        for j in _distinct_best(params[i], np.where(active[i], mse[i], np.inf), n_polish):
+            alpha, rho, nu = params[i, j]
+            candidate = [alpha, beta, rho, nu]
+            candidate_mse = mse[i, j]
+            candidate_converged = bool(settled[i, j])
+            if polish and not out_of_budget(nfev.sum()):
+                remaining = polish_evals if max_evals is None else min(polish_evals, max_evals - nfev.sum())
+                polished, polished_mse, result = s.calibrate_SABR(strikes=strikes[i][valid],
+                                                                  volatilities=vols[i][valid],
+                                                                  forward=forward,
+                                                                  TTM=TTM,
+                                                                  method=method,
+                                                                  init_param=candidate,
+                                                                  max_evals=remaining,
+                                                                  full_output=True)
+                nfev[i] += result.nfev
+                # unbounded methods (e.g. Newton-CG) can walk away from the start
+                if polished_mse < candidate_mse:
+                    candidate, candidate_mse = polished, polished_mse
+                    candidate_converged = bool(result.success)
+            if candidate_mse < best_mse:
+                best_mse = candidate_mse
+                best_params = candidate
+                best_converged = candidate_converged
+        results.append({"params": best_params,
+                        "mse": float(best_mse),
+                        "nfev": int(nfev[i]),
+                        "converged": best_converged})
+    return results
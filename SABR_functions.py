@@ -1,24 +1,180 @@
 import pandas as pd
-from scipy.stats import norm
+from collections import namedtuple
+from scipy.special import ndtr, ndtri
 import numpy as np
+from instrumentation import metrics
+
+_INV_SQRT_2PI = 1/np.sqrt(2*np.pi)
+
+
+def _z_over_x(z, rho):
+    """
+    z/x(z) from Hagan's expansion, its first and second derivatives with respect
+    to z and its derivative with respect to rho.
+    Uses the series in z up to z^4 close to the money where z/x is 0/0.
+    """
+    z = np.asarray(z, dtype=float)
+    small = np.abs(z) < 1e-3
+    z_safe = np.where(small, 1.0, z)  # keeps the exact branch away from 0/0
+
+    D = np.sqrt(1 - 2*rho*z_safe + z_safe**2)
+    x = np.log((D + z_safe - rho)/(1 - rho))
+    dx_dz = 1/D
+    d2x_dz2 = -(z_safe - rho)/D**3
+    dx_drho = 1/(1 - rho) - (D + z_safe)/(D*(D + z_safe - rho))
+
+    # z/x = 1 + c1*z + c2*z^2 + c3*z^3 + c4*z^4 + ...
+    c1 = -rho/2
+    c2 = (2 - 3*rho**2)/12
+    c3 = rho*(5 - 6*rho**2)/24
+    c4 = -(225*rho**4 - 240*rho**2 + 34)/720
+    dc_drho = (-1/2, -rho/2, (5 - 18*rho**2)/24, -(900*rho**3 - 480*rho)/720)
+
+    g = np.where(small, 1 + z*(c1 + z*(c2 + z*(c3 + z*c4))), z_safe/x)
+    dg_dz = np.where(small, c1 + z*(2*c2 + z*(3*c3 + z*4*c4)),
+                     (x - z_safe*dx_dz)/x**2)
+    d2g_dz2 = np.where(small, 2*c2 + z*(6*c3 + z*12*c4),
+                       (-z_safe*d2x_dz2*x - 2*dx_dz*(x - z_safe*dx_dz))/x**3)
+    dg_drho = np.where(small, z*(dc_drho[0] + z*(dc_drho[1] + z*(dc_drho[2] + z*dc_drho[3]))),
+                       -z_safe*dx_drho/x**2)
+    return g, dg_dz, d2g_dz2, dg_drho
 
 
 def strike_volatility_SABR(k, f, alpha, beta, nu, rho, t):
     """  
     f: forward rate
-    k: strike 
+    k: strike (scalar or array, the result has the same shape)
     t: time to maturity (in years) 
     """
-    z = (nu/alpha)*(f*k)**((1-beta)/2)*np.log(f/k)
-    x = np.log((np.sqrt(1-2*rho*z+z**2)+z-rho)/(1-rho))  # x(z)
-    num = alpha*(1+(((1-beta)**2)/24)*(alpha**2/((f*k)**(1-beta))) + 0.25 *
-                 (rho*beta*nu*alpha)/((f*k)**((1-beta)/2))+((2-3*rho**2)/24)*nu**2) * t
-    denum = (f * k) ** ((1 - beta) / 2) * (1 + ((1 - beta) ** 2 / 24) *
-                                           (np.log(f / k) ** 2) + ((1 - beta) ** 4 / 1920) * (np.log(f / k) ** 4))
-    vol_bs = (num/denum) * (z/x)
+    fk_beta = (f*k)**((1-beta)/2)
+    log_fk = np.log(f/k)
+    z = (nu/alpha)*fk_beta*log_fk
+    g = _z_over_x(z, rho)[0]  # z/x(z)
+    num = alpha*(1+(((1-beta)**2)/24)*(alpha**2/(fk_beta**2)) + 0.25 *
+                 (rho*beta*nu*alpha)/fk_beta+((2-3*rho**2)/24)*nu**2) * t
+    denum = fk_beta * (1 + ((1 - beta) ** 2 / 24) *
+                       (log_fk ** 2) + ((1 - beta) ** 4 / 1920) * (log_fk ** 4))
+    vol_bs = (num/denum) * g
+    metrics.count("sabr_vol", np.size(vol_bs))
     return vol_bs
 
 
+def strike_volatility_SABR_jacobian(k, f, alpha, beta, nu, rho, t):
+    """
+    Closed-form derivatives of strike_volatility_SABR with respect to
+    (alpha, rho, nu). Beta is pinned during calibration so it is not differentiated.
+
+    Returns (vol, jac) where jac has shape k.shape + (3,)
+    """
+    fk_beta = (f*k)**((1-beta)/2)
+    log_fk = np.log(f/k)
+    z = (nu/alpha)*fk_beta*log_fk
+    g, dg_dz, _, dg_drho = _z_over_x(z, rho)
+
+    a_term = (((1-beta)**2)/24)*(alpha**2/(fk_beta**2))
+    b_term = 0.25*(rho*beta*nu*alpha)/fk_beta
+    c_term = ((2-3*rho**2)/24)*nu**2
+    p = alpha*(1 + a_term + b_term + c_term)
+
+    # the strike only part of the formula, does not depend on the params
+    scale = t/(fk_beta * (1 + ((1 - beta) ** 2 / 24) *
+                          (log_fk ** 2) + ((1 - beta) ** 4 / 1920) * (log_fk ** 4)))
+
+    dp_dalpha = 1 + 3*a_term + 2*b_term + c_term
+    dp_drho = alpha*(0.25*beta*nu*alpha/fk_beta - 0.25*rho*nu**2)
+    dp_dnu = alpha*(0.25*rho*beta*alpha/fk_beta + ((2-3*rho**2)/12)*nu)
+
+    # z = nu/alpha * ... so dz/dalpha = -z/alpha and dz/dnu = z/nu
+    d_alpha = scale*(dp_dalpha*g - p*dg_dz*z/alpha)
+    d_rho = scale*(dp_drho*g + p*dg_drho)
+    d_nu = scale*(dp_dnu*g + p*dg_dz*z/nu)
+
+    vol_bs = scale*p*g
+    metrics.count("sabr_vol", np.size(vol_bs))
+    return vol_bs, np.stack([d_alpha, d_rho, d_nu], axis=-1)
+
+
+def strike_volatility_SABR_strike_derivatives(k, f, alpha, beta, nu, rho, t):
+    """
+    strike_volatility_SABR with its first and second derivatives with respect to the strike,
+    in closed form (used for the Breeden-Litzenberger density)
+
+    Returns (vol, dvol/dk, d2vol/dk2), each with the shape of k
+    """
+    k = np.asarray(k, dtype=float)
+    p = (1-beta)/2
+    q2 = (1-beta)**2/24
+    q4 = (1-beta)**4/1920
+
+    # (f*k)**p and log(f/k) with their strike derivatives
+    m = (f*k)**p
+    m1 = p*m/k
+    m2 = p*(p-1)*m/k**2
+    log_fk = np.log(f/k)
+    l1 = -1/k
+    l2 = 1/k**2
+
+    z = (nu/alpha)*m*log_fk
+    z1 = (nu/alpha)*(m1*log_fk + m*l1)
+    z2 = (nu/alpha)*(m2*log_fk + 2*m1*l1 + m*l2)
+    g, dg_dz, d2g_dz2, _ = _z_over_x(z, rho)
+    g1 = dg_dz*z1
+    g2 = d2g_dz2*z1**2 + dg_dz*z2
+
+    # numerator alpha*(1 + a/m^2 + b/m + c)*t
+    a = q2*alpha**2
+    b = 0.25*rho*beta*nu*alpha
+    c = ((2-3*rho**2)/24)*nu**2
+    num = alpha*(1 + a/m**2 + b/m + c)*t
+    num1 = alpha*t*(-2*a*m1/m**3 - b*m1/m**2)
+    num2 = alpha*t*(a*(6*m1**2/m**4 - 2*m2/m**3) + b*(2*m1**2/m**3 - m2/m**2))
+
+    # denominator m*(1 + q2*log^2 + q4*log^4)
+    poly = 1 + q2*log_fk**2 + q4*log_fk**4
+    poly1 = (2*q2*log_fk + 4*q4*log_fk**3)*l1
+    poly2 = (2*q2 + 12*q4*log_fk**2)*l1**2 + (2*q2*log_fk + 4*q4*log_fk**3)*l2
+    denum = m*poly
+    denum1 = m1*poly + m*poly1
+    denum2 = m2*poly + 2*m1*poly1 + m*poly2
+
+    # vol = num*g/denum
+    top = num*g
+    top1 = num1*g + num*g1
+    top2 = num2*g + 2*num1*g1 + num*g2
+    vol = top/denum
+    vol1 = (top1 - vol*denum1)/denum
+    vol2 = (top2 - 2*vol1*denum1 - vol*denum2)/denum
+    metrics.count("sabr_vol", np.size(vol))
+    return vol, vol1, vol2
+
+
+def _npdf(x):
+    # standard normal density, cheaper than scipy.stats.norm.pdf
+    return np.exp(-0.5*x*x)*_INV_SQRT_2PI
+
+
+def breeden_litzenberger(forward, ttm, strike, vol, dvol_dk, d2vol_dk2):
+    """
+    Risk neutral pdf and cdf d2C/dK2 and 1 + dC/dK (undiscounted) of a Black-76 smile,
+    chain rule through the smile vol(K):
+
+    d2C/dK2 = C_KK + 2*vanna_K*vol' + volga*vol'^2 + vega*vol''
+    """
+    sqrt_t = np.sqrt(ttm)
+    d1 = (np.log(forward / strike) + (0.5 * vol ** 2) * ttm) / (vol * sqrt_t)
+    d2 = d1 - vol*sqrt_t
+    n_d2 = _npdf(d2)
+
+    vega = strike*n_d2*sqrt_t  # dC/dvol
+    volga = vega*d1*d2/vol  # d2C/dvol2
+    vanna_k = n_d2*d1/vol  # d2C/dK dvol
+    c_kk = n_d2/(strike*vol*sqrt_t)
+
+    pdf = c_kk + 2*vanna_k*dvol_dk + volga*dvol_dk**2 + vega*d2vol_dk2
+    cdf = ndtr(-d2) + vega*dvol_dk
+    return pdf, cdf
+
+
 def get_gk_price(w, forward, term_rate, base_rate, ttm, vol, strike):
     """
     Gets the price of a call option using the Garman Kohlhagen formula
@@ -26,20 +182,157 @@ def get_gk_price(w, forward, term_rate, base_rate, ttm, vol, strike):
     Parameters:
 
     w: type of option: 1 for a call and -1 for a put
-    spot: Current price of the underlying asset
-    term_rate: Term risk-free rate
-    base_rate: Base risk-free rate
+    forward: forward price of the underlying asset at ttm
+    term_rate: Term risk-free rate (continuously compounded, discounts the payoff)
+    base_rate: Base risk-free rate (already in the forward, only used by the Greeks
+               of gk_price_and_greeks)
     ttm: Time to maturity
     vol: Volatility of the underlying asset
     strike: Strike price of the option
     Return value: Price of call option
 
+    Every argument can be an array, they broadcast together
     """
     T = ttm  # from days to years -> calculated using Time Delta
 
-    d1 = (np.log(forward / strike) + (0.5 * vol ** 2) * T) / (vol * np.sqrt(T))
-    d2 = (np.log(forward / strike) - (0.5 * vol ** 2) * T) / (vol * np.sqrt(T))
+    sd = vol*np.sqrt(T)
+    d1 = np.log(forward / strike)/sd + 0.5*sd
+    d2 = d1 - sd
 
-    value = w*np.exp(-term_rate) * \
-        (forward*norm.cdf(w*d1) - strike*norm.cdf(w*d2))
+    value = w*np.exp(-term_rate*T) * \
+        (forward*ndtr(w*d1) - strike*ndtr(w*d2))
+    metrics.count("gk_price", np.size(value))
     return value
+
+
+GKGreeks = namedtuple("GKGreeks", ["price", "delta", "gamma", "vega", "theta"])
+
+
+def gk_price_and_greeks(w, forward, strike, vol, ttm, term_rate=0, base_rate=0, out=None):
+    """
+    Garman Kohlhagen price with its spot Greeks in one pass, for strike x vol x maturity grids
+
+    w: 1 for calls, -1 for puts (array or scalar)
+    forward, strike, vol, ttm, term_rate, base_rate: anything broadcasting together
+    out: optional GKGreeks (or tuple) of 5 float arrays of the broadcast shape, written in
+         place. They're also the scratch space of the intermediates (d1, d2, N(d1), ...), so
+         with out nothing of the broadcast shape is allocated
+
+    Returns GKGreeks(price, delta, gamma, vega, theta), with the spot
+    S = forward*exp(-(term_rate - base_rate)*ttm):
+    delta = dV/dS, gamma = d2V/dS2, vega = dV/dvol (per 1.00 of vol) and
+    theta = dV/dt as calendar time passes (per year, spot and vol unchanged)
+    """
+    forward, strike, vol, ttm = (np.asarray(x, dtype=float) for x in (forward, strike, vol, ttm))
+    shape = np.broadcast_shapes(np.shape(w), forward.shape, strike.shape, vol.shape, ttm.shape,
+                                np.shape(term_rate), np.shape(base_rate))
+    if out is None:
+        out = GKGreeks(*(np.empty(shape) for _ in range(5)))
+    elif len(out) != 5 or any(np.shape(o) != shape for o in out):
+        raise ValueError(f"out should be 5 arrays of shape {shape}")
+    price, delta, gamma, vega, theta = out
+
+    # only input shaped arrays are allocated, every broadcast shape intermediate lives in
+    # the five result buffers (gamma is the scratch one, it's filled last)
+    sqrt_t = np.sqrt(ttm)
+    term_df = np.exp(-term_rate*ttm)
+    base_df = np.exp(-base_rate*ttm)
+    spot = forward*term_df/base_df
+
+    sd = np.multiply(vol, sqrt_t, out=gamma)
+    d1 = np.divide(forward, strike, out=delta)
+    np.log(d1, out=d1)
+    np.divide(d1, sd, out=d1)
+    d1 += np.multiply(sd, 0.5, out=price)
+    n_d1 = np.square(d1, out=vega)
+    n_d1 *= -0.5
+    np.exp(n_d1, out=n_d1)
+    n_d1 *= _INV_SQRT_2PI
+    cdf_d1 = ndtr(np.multiply(w, d1, out=price), out=price)
+    d2 = np.subtract(d1, sd, out=theta)
+    cdf_d2 = ndtr(np.multiply(w, d2, out=d2), out=d2)
+
+    np.multiply(w*base_df, cdf_d1, out=delta)
+    # price = X + Y, theta = -vega*vol/(2*ttm) + base_rate*X + term_rate*Y with
+    # X = w*term_df*forward*cdf_d1 and Y = -w*term_df*strike*cdf_d2
+    x = np.multiply(cdf_d1, w*term_df*forward, out=price)
+    y = np.multiply(cdf_d2, -w*term_df*strike, out=theta)
+    np.multiply(n_d1, forward*term_df*sqrt_t, out=vega)
+    decay = np.multiply(vega, vol, out=gamma)
+    np.divide(decay, ttm, out=decay)
+    decay *= -0.5
+    np.add(x, y, out=price)
+    np.multiply(y, term_rate - base_rate, out=theta)
+    theta += decay
+    theta += np.multiply(price, base_rate, out=gamma)
+    # gamma = base_df*n_d1/(spot*sd), n_d1 and sd recovered from vega and vol
+    np.divide(vega, vol, out=gamma)
+    gamma *= base_df/(forward*term_df*spot*ttm)
+    metrics.count("gk_price", np.prod(shape, dtype=int))
+    return GKGreeks(price, delta, gamma, vega, theta)
+
+
+def implied_volatility(price, forward, strike, ttm, w=1, term_rate=0, iterations=6):
+    """
+    Black (Garman Kohlhagen) implied vol of whole arrays of prices at once, the inverse of
+    get_gk_price. NaN where the price is outside the no arbitrage bounds
+
+    price: option prices in USD (discounted by exp(-term_rate*ttm))
+    w: 1 for calls, -1 for puts (array or scalar)
+    iterations: Halley steps, 5 already reach ~1e-12 relative accuracy over the usual
+                strikes and vols
+
+    Works on the normalised out of the money price b(s) = c/sqrt(F*K) of the total vol
+    s = vol*sqrt(ttm), x = -|log(F/K)|. b is convex below its inflection point
+    s_c = sqrt(2|x|) and concave above it, the root is bracketed on the right side of
+    s_c and a step leaving the bracket is replaced by bisection. Below b(s_c) the steps
+    are on log(b), which is much less flat in the wings.
+    """
+    price, forward, strike, ttm = np.broadcast_arrays(*(np.asarray(a, dtype=float)
+                                                        for a in (price, forward, strike, ttm)))
+    w = np.broadcast_to(w, price.shape)
+    undiscounted = price*np.exp(term_rate*ttm)
+    log_fk = np.log(forward/strike)
+    # in the money options are turned into out of the money ones by put call parity
+    itm = w*log_fk > 0
+    otm_price = np.where(itm, undiscounted - w*(forward - strike), undiscounted)
+    target = otm_price/np.sqrt(forward*strike)
+    x = -np.abs(log_fk)
+    upper_bound = np.exp(x/2)
+
+    valid = (target > 0) & (target < upper_bound) & (ttm > 0)
+    target = np.where(valid, target, upper_bound/2)
+
+    def normalised_price(s):
+        # at the money (x = 0) a ~0 price starts (and stays) at s = 0, d1 = 0/0 there
+        with np.errstate(divide="ignore", invalid="ignore"):
+            d1 = x/s + s/2
+        return upper_bound*ndtr(d1) - ndtr(d1 - s)/upper_bound
+
+    s_c = np.sqrt(2*np.abs(x))
+    lower = target < normalised_price(np.maximum(s_c, 1e-12))
+    # starting points: b ~ exp(-x^2/(2 s^2)) in the wings, the x = 0 formula above s_c
+    with np.errstate(divide="ignore", invalid="ignore"):
+        s_wing = np.abs(x)/np.sqrt(-2*np.log(target))
+    s_body = 2*ndtri((1 + target/upper_bound)/2)
+    s = np.where(lower, np.clip(s_wing, 1e-3*s_c, s_c), np.maximum(s_body, s_c))
+    lo = np.where(lower, 0, s_c)
+    hi = np.where(lower, s_c, np.inf)
+
+    for _ in range(iterations):
+        b = normalised_price(s)
+        lo = np.where(b < target, s, lo)
+        hi = np.where(b < target, hi, s)
+        # Halley on log(b) - log(target) below the inflection point, b - target above. The
+        # far wings overflow (f1**2) or divide by 0, those steps land outside [lo, hi]
+        with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+            b1 = np.exp(-x**2/(2*s**2) - s**2/8)*_INV_SQRT_2PI  # db/ds
+            b2 = b1*(x**2/s**3 - s/4)
+            f = np.where(lower, np.log(b/target), b - target)
+            f1 = np.where(lower, b1/b, b1)
+            f2 = np.where(lower, b2/b - (b1/b)**2, b2)
+            new_s = s - 2*f*f1/(2*f1**2 - f*f2)
+        inside = (new_s >= lo) & (new_s <= hi)
+        s = np.where(inside, new_s, np.where(np.isfinite(hi), (lo + hi)/2, 2*s))
+    metrics.count("implied_vol", price.size)
+    return np.where(valid, s/np.sqrt(np.where(ttm > 0, ttm, 1)), np.nan)
@@ -0,0 +1,161 @@
+"""
+Headless benchmark of the load -> forward -> calibrate -> density pipeline
+
+    python benchmark.py                                 # writes benchmark_results.json
+    python benchmark.py --enlarge 4 16 --output new.json --compare benchmark_results.json
+
+Every stage is timed on its own (best of --repeat runs) for each bundled export
+and for synthetically enlarged copies of them. Each record has the wall time, the
+optimizer evaluations, the peak traced memory and, for calibrations, the fit mse,
+so a speedup that costs accuracy shows up in --compare.
+"""
+import argparse
+import glob
+import json
+import os
+import platform
+import time
+import tracemalloc
+from datetime import datetime as dt
+import numpy as np
+import pandas as pd
+import chain_loader as loader
+from read_prices import option_prices
+
+METHODS = ['L-BFGS-B', 'TNC', 'Nelder-Mead']
+
+
+def enlarge_chain(df, factor):
+    """
+    Chain with factor times more strikes, the new strikes linearly interpolate the quotes
+    of their neighbours (per option type)
+    """
+    if factor <= 1:
+        return df
+    numeric = [column for column in df.columns if df[column].dtype == np.float64 and column != "strike"]
+    frames = []
+    for option_type, group in df.groupby("type"):
+        group = group.sort_values("strike")
+        strikes = group["strike"].to_numpy()
+        fractions = np.arange(factor)/factor
+        new_strikes = (strikes[:-1, None] + np.diff(strikes)[:, None]*fractions).ravel()
+        new_strikes = np.append(new_strikes, strikes[-1]).round()
+        data = {column: np.interp(new_strikes, strikes, group[column].to_numpy())
+                for column in numeric}
+        frame = pd.DataFrame(data)
+        frame["strike"] = new_strikes
+        for column in ["underlying", "date", "type", "expiry"]:
+            frame[column] = group[column].iloc[0]
+        frame.index = pd.Index([f"{u}-{d}-{int(k)}-{option_type}" for u, d, k in
+                                zip(frame["underlying"], frame["date"], frame["strike"])], name="instrument")
+        frames.append(frame)
+    return pd.concat(frames)[df.columns]
+
+
+def measure(function, repeat):
+    """
+    best wall time of repeat runs, peak traced memory (MB) of one extra run, last result
+    """
+    seconds = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        seconds = min(seconds, time.perf_counter() - start)
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return seconds, peak/2**20, result
+
+
+def run_chain(label, path, factor, args):
+    records = []
+
+    def record(stage, seconds, peak, **extra):
+        records.append(dict(chain=label, enlarge=factor, stage=stage, seconds=seconds,
+                            peak_mb=peak, **extra))
+
+    seconds, peak, df = measure(lambda: enlarge_chain(loader.read_export(path), factor), args.repeat)
+    record("parse", seconds, peak, rows=len(df))
+    seconds, peak, chain = measure(lambda: option_prices(df=df, valuation_time=args.valuation_time), args.repeat)
+    record("construct", seconds, peak, rows=len(df))
+    seconds, peak, _ = measure(chain.find_atm_pcp, args.repeat)
+    record("find_atm_pcp", seconds, peak)
+
+    for method in args.methods:
+        seconds, peak, _ = measure(lambda: chain.calibrate_SABR(method=method, seed=args.seed),
+                                   args.repeat)
+        results = chain.calibration_results.values()
+        record("calibrate_SABR", seconds, peak, method=method,
+               nfev=int(sum(r["nfev"] for r in results)),
+               mse=float(sum(r["mse"] for r in results)))
+
+        for pdf_method in ["butterfly", "analytic"]:
+            seconds, peak, _ = measure(lambda: chain.implied_pdf(bins=args.bins, method=pdf_method),
+                                       args.repeat)
+            record("implied_pdf", seconds, peak, method=method, pdf_method=pdf_method, bins=args.bins)
+
+    seconds, peak, _ = measure(lambda: chain.calibrate_smile(model="svi"), args.repeat)
+    results = chain.calibration_results.values()
+    record("calibrate_smile", seconds, peak, method="svi",
+           nfev=int(sum(r["nfev"] for r in results)),
+           mse=float(sum(r["mse"] for r in results)))
+    return records
+
+
+def compare(records, baseline, mse_tolerance=0.05):
+    """
+    Prints the time ratio of every stage against a previous run and flags mse regressions
+    """
+    def key(r):
+        return (r["chain"], r["enlarge"], r["stage"], r.get("method"), r.get("pdf_method"))
+    previous = {key(r): r for r in baseline["results"]}
+    print(f"{'chain':<24} {'x':>3} {'stage':<15} {'method':<12} {'old s':>9} {'new s':>9} {'speedup':>8}")
+    for r in records:
+        old = previous.get(key(r))
+        if old is None:
+            continue
+        flag = ""
+        if "mse" in r and r["mse"] > old["mse"]*(1 + mse_tolerance):
+            flag = f"  mse {old['mse']:.3g} -> {r['mse']:.3g}"
+        method = r.get("pdf_method") or r.get("method") or ""
+        print(f"{r['chain']:<24} {r['enlarge']:>3} {r['stage']:<15} {method:<12} "
+              f"{old['seconds']:>9.4f} {r['seconds']:>9.4f} {old['seconds']/r['seconds']:>8.2f}{flag}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", nargs="+", default=sorted(glob.glob("*-export.csv")))
+    parser.add_argument("--enlarge", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--methods", nargs="+", default=METHODS)
+    parser.add_argument("--bins", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--valuation-time", type=dt.fromisoformat, default=dt(2024, 4, 1, 8),
+                        help="ISO datetime the chains are valued at, fixed so that runs compare "
+                             "(default 2024-04-01T08:00, before the bundled expiries)")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--compare", default=None, help="previous output to compare against")
+    args = parser.parse_args()
+
+    records = []
+    for path in args.files:
+        for factor in args.enlarge:
+            records += run_chain(os.path.basename(path).replace("-export.csv", ""), path, factor, args)
+            print(f"{path} x{factor} done")
+
+    with open(args.output, "w") as f:
+        json.dump({"meta": {"date": dt.now().isoformat(), "python": platform.python_version(),
+                            "numpy": np.__version__, "pandas": pd.__version__,
+                            "machine": platform.machine(), "cpus": os.cpu_count(),
+                            "args": dict(vars(args), valuation_time=args.valuation_time.isoformat())},
+                   "results": records}, f, indent=1)
+    print(f"results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(records, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
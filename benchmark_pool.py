@@ -0,0 +1,76 @@
+"""
+Scaling benchmark for surface_driver.calibrate_chains
+
+The four bundled exports are copied `copies` times (4 x 12 = 48 expiries by
+default, about a full BTC + ETH chain) and calibrated with 1, 2, ... workers.
+A run where any chain fails prints no speedup and the script exits with status 1.
+
+    python benchmark_pool.py --copies 12 --workers 1 2 4 8
+"""
+import argparse
+import glob
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime as dt
+from surface_driver import calibrate_chains
+
+
+def replicate_exports(directory, copies):
+    paths = []
+    for file in sorted(glob.glob("*-export.csv")):
+        for i in range(copies):
+            path = os.path.join(directory, f"copy{i:03d}-{file}")
+            shutil.copyfile(file, path)
+            paths.append(path)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--copies", type=int, default=12)
+    parser.add_argument("--workers", type=int, nargs="+",
+                        default=sorted({1, 2, 4, os.cpu_count() or 1}))
+    parser.add_argument("--chunksize", type=int, default=1)
+    parser.add_argument("--method", default="L-BFGS-B")
+    parser.add_argument("--valuation-time", type=dt.fromisoformat, default=dt(2024, 4, 1, 8),
+                        help="ISO datetime the chains are valued at (default 2024-04-01T08:00, "
+                             "before the bundled expiries)")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        paths = replicate_exports(directory, args.copies)
+        print(f"{len(paths)} chains, {os.cpu_count()} cores")
+        print(f"{'workers':>8} {'seconds':>9} {'speedup':>8} {'efficiency':>11}")
+        base = None
+        any_failed = False
+        for workers in args.workers:
+            start = time.perf_counter()
+            results = calibrate_chains(paths, max_workers=workers, chunksize=args.chunksize,
+                                       valuation_time=args.valuation_time, method=args.method, seed=0)
+            elapsed = time.perf_counter() - start
+            errors = [r for r in results if isinstance(r, Exception)]
+            if errors:
+                # the timing of a run that skipped chains says nothing about scaling
+                any_failed = True
+                print(f"{workers:>8} {elapsed:>9.2f} {'-':>8} {'-':>11}  "
+                      f"({len(errors)} failed, e.g. {type(errors[0]).__name__}: {errors[0]})")
+                continue
+            if workers == args.workers[0]:
+                base = elapsed
+            if base is None:
+                # no baseline to compare against, the first run failed
+                print(f"{workers:>8} {elapsed:>9.2f} {'-':>8} {'-':>11}")
+                continue
+            print(f"{workers:>8} {elapsed:>9.2f} {base/elapsed:>8.2f} {base/elapsed*args.workers[0]/workers:>11.0%}")
+    finally:
+        shutil.rmtree(directory)
+    if any_failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""
+Keeps the last good SABR fit per (underlying, expiry, side) so a recalibration
+can start from it instead of random restarts:
+
+    cache = CalibrationCache(maxsize=512)
+    a.calibrate_SABR(method="L-BFGS-B", cache=cache)
+    ...
+    b = option_prices(name="BTC-27SEP")    # a minute later
+    b.calibrate_SABR(method="L-BFGS-B", cache=cache)
+"""
+import hashlib
+from collections import OrderedDict, namedtuple
+import numpy as np
+
+CacheEntry = namedtuple("CacheEntry", ["params", "mse", "snapshot"])
+
+
+def snapshot_hash(strikes, volatilities, forward, ttm):
+    """
+    Hash of the quotes, forward and TTM a fit was made on. Only an identical snapshot
+    valued at the same time reuses a fit as it is, the same quotes a little later
+    (time decay alone) are refitted starting from it
+    """
+    h = hashlib.blake2b(digest_size=16)
+    for array in (strikes, volatilities, [forward, ttm]):
+        h.update(np.ascontiguousarray(array, dtype=np.float64).tobytes())
+    return h.hexdigest()
+
+
+class CalibrationCache():
+    def __init__(self, maxsize=256, fallback_ratio=2.0):
+        """
+        maxsize: number of (underlying, expiry, side) fits kept, least recently used go first
+        fallback_ratio: a warm start fails if its mse is above fallback_ratio * the cached mse
+        """
+        self.maxsize = maxsize
+        self.fallback_ratio = fallback_ratio
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key, params, mse, snapshot):
+        self._entries[key] = CacheEntry(list(params), float(mse), snapshot)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def warm_start_failed(self, entry, mse):
+        return not np.isfinite(mse) or mse > self.fallback_ratio*max(entry.mse, 1e-12)
+
+    def clear(self):
+        self._entries.clear()
@@ -0,0 +1,86 @@
+"""
+Loads Deribit option chain exports (Instrument, Volume, ..., IV Ask, Size)
+
+    df = read_export("BTC-27SEP24-export.csv")       # one expiry
+    df = read_exports(".")                          # every export of a directory
+
+Frames are indexed by instrument, with the instrument parsed into underlying,
+date, strike and type, every quote column as float64 ('-' -> NaN), and the
+vol_mid / mark_mid columns option_prices works with.
+"""
+import os
+import numpy as np
+import pandas as pd
+
+COLUMNS = ["instrument", 'volume', 'open', 'extvalue', 'rho', 'theta', 'vega', 'gamma',
+           'ndelta', 'delta', 'last', 'bid_size', 'iv_bid', 'bid', 'mark', 'ask', 'iv_ask', 'ask_size']
+DTYPES = {column: np.float64 for column in COLUMNS[1:]}
+DTYPES["instrument"] = str
+
+# e.g. BTC-27SEP24-60000-C
+INSTRUMENT_PATTERN = r"^(?P<underlying>[A-Z]+)-(?P<date>\d{1,2}[A-Z]{3}\d{2})-(?P<strike>\d+(?:\.\d+)?)-(?P<type>[CP])$"
+
+
+def find_export(name, directory=None):
+    """
+    Path of the single export in directory whose file name contains name
+    """
+    matches = sorted(file for file in os.listdir(directory)
+                     if file.endswith(".csv") and name in file)
+    if not matches:
+        raise FileNotFoundError(f"couldn't find an option price file matching {name!r}")
+    if len(matches) > 1:
+        raise ValueError(f"several option price files match {name!r}: {matches}")
+    return os.path.join(directory or "", matches[0])
+
+
+def parse_instruments(instruments):
+    """
+    Splits instrument names into underlying, date (e.g. 27SEP24), expiry, strike and type
+    (NaN / NaT for names that don't match INSTRUMENT_PATTERN)
+    """
+    parts = pd.Series(instruments, dtype=str).str.extract(INSTRUMENT_PATTERN)
+    parts["strike"] = parts["strike"].astype(np.float64)
+    # a chain only has a handful of expiries, parse each date once
+    codes, dates = pd.factorize(parts["date"])
+    parts["expiry"] = pd.DatetimeIndex(pd.to_datetime(dates, format="%d%b%y")).take(
+        codes, allow_fill=True, fill_value=pd.NaT)  # code -1: no match
+    return parts
+
+
+def _read_quotes(path):
+    return pd.read_csv(path, header=0, names=COLUMNS, dtype=DTYPES, index_col="instrument",
+                       na_values=["-"], keep_default_na=True, engine="c")
+
+
+def _add_columns(df):
+    # instrument fields and mids, one pass over the whole frame
+    parts = parse_instruments(df.index.to_numpy())
+    parts.index = df.index
+    df = pd.concat([df, parts], axis=1)
+    df["vol_mid"] = (df["iv_bid"]+df["iv_ask"])/2
+    df["mark_mid"] = (df["bid"]+df["ask"])/2
+    return df
+
+
+def read_export(path):
+    """
+    One Deribit export as a DataFrame indexed by instrument
+    """
+    return _add_columns(_read_quotes(path))
+
+
+def read_exports(paths):
+    """
+    Several exports in one frame indexed by instrument, with a source column (file name)
+
+    paths: list of CSV paths or a directory (every *-export.csv in it)
+    """
+    if isinstance(paths, str) and os.path.isdir(paths):
+        paths = [os.path.join(paths, file) for file in sorted(os.listdir(paths))
+                 if file.endswith("-export.csv")]
+    frames = [_read_quotes(path) for path in paths]
+    df = _add_columns(pd.concat(frames))
+    df["source"] = np.repeat([os.path.basename(path) for path in paths],
+                             [len(frame) for frame in frames])
+    return df
@@ -0,0 +1,87 @@
+"""
+No-arbitrage checks and repair of implied densities, vectorised over smiles
+
+    report = check_density(strikes, pdf, lower_cdf, upper_cdf)
+    pdf, cdf = repair_density(strikes, pdf, report.lower_tail, report.upper_tail)
+
+Butterfly arbitrage is a negative density (call prices not convex in the strike),
+vertical spread arbitrage a cdf outside [0, 1] (calls not decreasing). The grid
+stops at finite strikes (pdf_grid goes up to the highest strike + 40000), the mass
+the smile puts beyond them is reported as lower_tail / upper_tail.
+Calendar arbitrage is total variance decreasing with the expiry at fixed moneyness.
+"""
+from collections import namedtuple
+import numpy as np
+
+DensityReport = namedtuple("DensityReport", ["negative_mass", "lower_tail", "upper_tail", "mass",
+                                             "max_cdf", "arbitrage_free"])
+
+
+def _cumulative_mass(strikes, pdf):
+    # trapezoid integral of pdf from strikes[0] to every strike, along the last axis
+    h = np.diff(strikes, axis=-1)
+    steps = (pdf[..., 1:] + pdf[..., :-1])*h/2
+    return np.concatenate([np.zeros(pdf.shape[:-1] + (1,)), np.cumsum(steps, axis=-1)], axis=-1)
+
+
+def check_density(strikes, pdf, lower_cdf, upper_cdf, tolerance=1e-4, cdf=None):
+    """
+    strikes: (n,) sorted grid, pdf: (..., n) probability per unit of strike
+    lower_cdf / upper_cdf: (...) cdf of the smile at strikes[0] / strikes[-1]
+    tolerance: negative mass (or cdf overshoot) accepted before calling it arbitrage
+    cdf: (..., n) analytic cdf on the grid (sabr.breeden_litzenberger), when given the
+         cdf bounds are checked on it rather than on the trapezoid integral of pdf, whose
+         quadrature error on a coarse grid is larger than the tolerance
+
+    Returns a DensityReport of (...) arrays: negative_mass, lower_tail / upper_tail (mass
+    below / above the grid), mass (tails + grid, 1 for a consistent density), max_cdf.
+    NaNs in the density count as arbitrage
+    """
+    strikes = np.asarray(strikes, dtype=float)
+    pdf = np.asarray(pdf, dtype=float)
+    lower_tail = np.asarray(lower_cdf, dtype=float)
+    upper_tail = 1 - np.asarray(upper_cdf, dtype=float)
+
+    cumulative = _cumulative_mass(strikes, pdf)
+    negative_mass = _cumulative_mass(strikes, np.maximum(-pdf, 0))[..., -1]
+    mass = lower_tail + cumulative[..., -1] + upper_tail
+    if cdf is None:
+        max_cdf = lower_tail + np.max(cumulative, axis=-1)
+        min_cdf = lower_tail
+    else:
+        cdf = np.asarray(cdf, dtype=float)
+        max_cdf = np.max(cdf, axis=-1)
+        min_cdf = np.min(cdf, axis=-1)
+    arbitrage_free = ((negative_mass <= tolerance) & (min_cdf >= -tolerance) &
+                      (upper_tail >= -tolerance) & (max_cdf <= 1 + tolerance))
+    return DensityReport(negative_mass, lower_tail, upper_tail, mass, max_cdf, arbitrage_free)
+
+
+def repair_density(strikes, pdf, lower_tail=0, upper_tail=0):
+    """
+    Clips the negative (and NaN) density to 0 and rescales what is left so that the grid
+    holds 1 - lower_tail - upper_tail. Returns (pdf, cdf), the cdf starts at lower_tail
+    """
+    strikes = np.asarray(strikes, dtype=float)
+    pdf = np.asarray(pdf, dtype=float)
+    pdf = np.where(pdf > 0, pdf, 0)
+    lower_tail = np.clip(lower_tail, 0, 1)
+    upper_tail = np.clip(upper_tail, 0, 1 - lower_tail)
+
+    inside = _cumulative_mass(strikes, pdf)[..., -1]
+    scale = np.where(inside > 0, (1 - lower_tail - upper_tail)/np.where(inside > 0, inside, 1), 0)
+    pdf = pdf*np.expand_dims(scale, -1)
+    cdf = np.expand_dims(lower_tail, -1) + _cumulative_mass(strikes, pdf)
+    return pdf, cdf
+
+
+def calendar_arbitrage(total_variance):
+    """
+    total_variance: (expiries, points) vol^2 * ttm at the same log-moneyness points,
+    expiries sorted by TTM
+
+    Returns the largest drop of total variance from each expiry to the next one
+    (expiries - 1,), 0 when it only increases. A drop is a calendar spread arbitrage
+    """
+    drops = -np.diff(np.asarray(total_variance, dtype=float), axis=0)
+    return np.maximum(np.max(drops, axis=-1), 0)
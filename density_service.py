@@ -0,0 +1,158 @@
+"""
+In-process asyncio service for implied densities, shared by many consumers:
+
+    service = DensityService(max_workers=4, ttl=60)
+    strikes, pdf, cdf = await service.density("BTC", "27SEP24")
+    strikes, pdf, cdf = await service.density("BTC", "27SEP24", grid=np.linspace(40000, 120000, 81))
+    await service.close()
+
+Calibrations run on a process pool (the worker loads the export, calibrates with
+option_prices.calibrate_smile and sends back a compact OptionChain). Concurrent
+identical requests wait on the same computation instead of starting their own, and
+the calibrated chains and the densities are kept for ttl seconds. No sockets: other
+systems call it from their own event loop.
+"""
+import asyncio
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from instrumentation import metrics
+from option_chain import OptionChain
+from read_prices import option_prices
+
+
+def _calibrate(name, directory, valuation_time, chain_kwargs, calibration_kwargs):
+    # runs in a worker process, the seed defaults to the chain's job_seed(): same quotes and
+    # valuation time, same fit
+    chain = option_prices(name=name, directory=directory, valuation_time=valuation_time, **chain_kwargs)
+    chain.calibrate_smile(**calibration_kwargs)
+    return OptionChain.from_prices(chain)
+
+
+def _expiry_code(expiry):
+    # "27SEP24" as in the instrument names, from a string or a date
+    return expiry.strftime("%d%b%y").upper() if hasattr(expiry, "strftime") else str(expiry).upper()
+
+
+class DensityService():
+    def __init__(self, directory=None, max_workers=None, ttl=60, executor=None, valuation_time=None,
+                 chain_kwargs=None, calibration_kwargs=None, clock=time.monotonic):
+        """
+        directory: where the exports are looked up (see chain_loader.find_export)
+        max_workers: processes of the calibration pool (ignored if executor is given)
+        ttl: seconds a calibration / density is served from the cache
+        executor: concurrent.futures executor running the calibrations, e.g. a
+                  ThreadPoolExecutor in tests (the service doesn't shut it down)
+        valuation_time: datetime the chains are valued at (e.g. a replayed snapshot's),
+                        None values each calibration at the time it runs
+        chain_kwargs: passed to option_prices (min_vol_ba_spread, ...)
+        calibration_kwargs: passed to option_prices.calibrate_smile (model, method, seed, ...)
+        """
+        self.directory = directory
+        self.ttl = ttl
+        self.valuation_time = valuation_time
+        self.chain_kwargs = chain_kwargs or {}
+        self.calibration_kwargs = calibration_kwargs or {}
+        self.clock = clock
+        self._own_executor = executor is None
+        self.executor = ProcessPoolExecutor(max_workers=max_workers) if executor is None else executor
+        self._cache = {}      # key -> (expires at, value)
+        self._in_flight = {}  # key -> task computing it
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        for task in list(self._in_flight.values()):
+            task.cancel()
+        if self._own_executor:
+            await asyncio.get_running_loop().run_in_executor(None, self.executor.shutdown)
+
+    def invalidate(self, underlying=None, expiry=None):
+        """
+        Drops the cached calibrations and densities of an expiry, of an underlying or all of them.
+        The ones still being computed are forgotten too: their callers get them, the cache
+        and the later requests don't
+        """
+        if expiry is not None and underlying is None:
+            raise ValueError("an expiry needs its underlying")
+        prefix = "" if underlying is None else f"{underlying}-"
+        if expiry is not None:
+            prefix += _expiry_code(expiry)
+        for key in [key for key in self._cache if key[1].startswith(prefix)]:
+            del self._cache[key]
+        for key in [key for key in self._in_flight if key[1].startswith(prefix)]:
+            del self._in_flight[key]
+
+    async def _cached(self, key, compute):
+        """
+        (expires at, value) of key from the cache, from the computation already running
+        for it or from a new compute() task, in that order. compute() returns the pair
+        """
+        entry = self._cache.get(key)
+        if entry is not None and entry[0] > self.clock():
+            metrics.count("service_cache_hit")
+            return entry
+
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(compute())
+            self._in_flight[key] = task
+
+            def done(task):
+                if self._in_flight.get(key) is not task:
+                    return  # invalidated while it ran, the result is stale
+                del self._in_flight[key]
+                if not task.cancelled() and task.exception() is None:
+                    now = self.clock()
+                    for expired in [k for k, (expires, _) in self._cache.items() if expires <= now]:
+                        del self._cache[expired]
+                    self._cache[key] = task.result()
+            task.add_done_callback(done)
+        else:
+            metrics.count("service_coalesced")
+        # a caller giving up doesn't cancel the computation the others wait on
+        return await asyncio.shield(task)
+
+    async def _chain(self, name):
+        async def calibrate():
+            metrics.count("service_calibration")
+            loop = asyncio.get_running_loop()
+            compact = await loop.run_in_executor(self.executor, _calibrate, name, self.directory, self.valuation_time,
+                                                 self.chain_kwargs, self.calibration_kwargs)
+            return self.clock() + self.ttl, compact.to_prices()
+
+        return await self._cached(("chain", name), calibrate)
+
+    async def chain(self, underlying, expiry):
+        """
+        Calibrated option_prices of an expiry, e.g. ("BTC", "27SEP24") or ("BTC", datetime)
+        """
+        return (await self._chain(f"{underlying}-{_expiry_code(expiry)}"))[1]
+
+    async def density(self, underlying, expiry, grid=None, side="mid", bins=200):
+        """
+        (strikes, pdf, cdf) of an expiry, repaired (see option_prices.implied_pdf)
+
+        grid: strikes to evaluate the density at (analytic Breeden-Litzenberger), defaults
+              to the chain's adaptive_grid(bins+1)
+        side: "mid", "bid" or "ask" call smile
+
+        The arrays are shared by every caller of the same request, they're read only
+        """
+        name = f"{underlying}-{_expiry_code(expiry)}"
+        grid = None if grid is None else np.array(grid, dtype=float)
+        key = ("density", name, side, bins, None if grid is None else grid.tobytes())
+
+        async def compute():
+            # a density expires with the calibration it comes from
+            expires, chain = await self._chain(name)
+            result = chain.implied_pdf(grid=grid, side=side, bins=bins, method="analytic", repair=True)
+            for array in result:
+                array.setflags(write=False)
+            return expires, result
+
+        return (await self._cached(key, compute))[1]
@@ -0,0 +1,159 @@
+"""
+Counters, timers and latency histograms for the calibration / pricing hot path
+
+    import instrumentation
+    instrumentation.metrics.subscribe(lambda event, fields: print(event, fields))
+    a.calibrate_SABR(method="L-BFGS-B")
+    instrumentation.metrics.snapshot()
+    # {"counters": {"sabr_vol": ..., "objective": ..., "restarts": ...},
+    #  "latency": {"calibrate_SABR": {"count": 1, "mean": ..., "p50": ..., ...}}}
+
+Counters: objective (SSE evaluations), sabr_vol (strike vols computed), gk_price
+(options priced), restarts (calibration starting points), cache_hit / warm_start /
+warm_start_failed, arbitrage_detected / arbitrage_refit (see density_checks),
+table_build / table_hit (see smile_table).
+
+Events go to the "implied_pdf" logger and to every subscribed callback(event, fields):
+"timer" (stage, seconds and context such as the expiry), "optimizer" (the scipy
+OptimizeResult summary: nfev, nit, status, message), "calibration" (per side mse) and
+"arbitrage" / "calendar_arbitrage" / "density" (failed no-arbitrage checks, at WARNING).
+"""
+import cProfile
+import functools
+import io
+import logging
+import pstats
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+import numpy as np
+
+logger = logging.getLogger("implied_pdf")
+
+# latency buckets from 1 microsecond to ~100 seconds, 4 per decade
+_BUCKETS = 10.0**np.arange(-6, 2.01, 0.25)
+
+
+class Histogram():
+    def __init__(self):
+        self.counts = np.zeros(len(_BUCKETS) + 1, dtype=np.int64)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.counts[np.searchsorted(_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q):
+        # upper edge of the bucket holding the q quantile
+        if self.count == 0:
+            return float('nan')
+        i = int(np.searchsorted(np.cumsum(self.counts), q*self.count))
+        return float(_BUCKETS[i]) if i < len(_BUCKETS) else self.max
+
+    def summary(self):
+        return {"count": self.count,
+                "mean": self.total/self.count if self.count else float('nan'),
+                "p50": self.quantile(0.5),
+                "p90": self.quantile(0.9),
+                "p99": self.quantile(0.99),
+                "max": self.max}
+
+
+class Metrics():
+    def __init__(self):
+        self.counters = defaultdict(int)
+        self.latency = defaultdict(Histogram)
+        self._callbacks = []
+
+    def subscribe(self, callback):
+        """
+        callback(event, fields) is called on every event, returns the callback (to unsubscribe)
+        """
+        self._callbacks.append(callback)
+        return callback
+
+    def unsubscribe(self, callback):
+        self._callbacks.remove(callback)
+
+    def count(self, name, n=1):
+        self.counters[name] += int(n)
+
+    def emit(self, event, level=logging.DEBUG, **fields):
+        if logger.isEnabledFor(level):
+            logger.log(level, "%s %s", event, " ".join(f"{k}={v}" for k, v in fields.items()))
+        for callback in self._callbacks:
+            callback(event, fields)
+
+    @contextmanager
+    def timer(self, stage, **context):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.latency[stage].add(seconds)
+            self.emit("timer", stage=stage, seconds=seconds, **context)
+
+    def snapshot(self):
+        return {"counters": dict(self.counters),
+                "latency": {stage: h.summary() for stage, h in self.latency.items()}}
+
+    def reset(self):
+        self.counters.clear()
+        self.latency.clear()
+
+
+metrics = Metrics()
+
+
+def timed(stage, context=None):
+    """
+    Decorator recording every call of the function in the stage latency histogram
+
+    context: optional function of the same arguments returning extra fields of the
+             timer event (e.g. the expiry being calibrated)
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            fields = context(*args, **kwargs) if context is not None else {}
+            with metrics.timer(stage, **fields):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def profile(sort="cumulative", limit=25, memory=False):
+    """
+    Opt-in cProfile (and tracemalloc if memory=True) around a block, the report is
+    emitted as a "profile" event and kept in the yielded dict
+
+        with instrumentation.profile(memory=True) as report:
+            a.calibrate_SABR(method="TNC")
+        print(report["stats"])
+    """
+    report = {}
+    profiler = cProfile.Profile()
+    if memory:
+        tracemalloc.start()
+    profiler.enable()
+    try:
+        yield report
+    finally:
+        profiler.disable()
+        stream = io.StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats(sort).print_stats(limit)
+        report["stats"] = stream.getvalue()
+        if memory:
+            current, peak = tracemalloc.get_traced_memory()
+            report["peak_mb"] = peak/2**20
+            report["top_allocations"] = [str(stat) for stat in
+                                         tracemalloc.take_snapshot().statistics("lineno")[:10]]
+            tracemalloc.stop()
+        metrics.emit("profile", **report)
@@ -1,4 +1,5 @@
-import matplotlib.pyplot as plt
+import logging
+from datetime import datetime as dt
 from read_prices import option_prices
 
 """
@@ -13,10 +14,13 @@ Last one seems to be quite innacurate tho
 
 
 def main():
-    # a = option_prices(name="BTC-26APR")
-    # a = option_prices(name="BTC-27SEP")
-    # a = option_prices(name="BTC-27DEC")
-    a = option_prices(name="ETH-27SEP")
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    # the bundled expiries have passed, value them at a time before them
+    valuation_time = dt(2024, 4, 1, 8)
+    # a = option_prices(name="BTC-26APR", valuation_time=valuation_time)
+    # a = option_prices(name="BTC-27SEP", valuation_time=valuation_time)
+    # a = option_prices(name="BTC-27DEC", valuation_time=valuation_time)
+    a = option_prices(name="ETH-27SEP", valuation_time=valuation_time)
 
     a.calibrate_SABR(method='L-BFGS-B')
     a.plot_bid_ask_SABR_calls()
@@ -0,0 +1,195 @@
+"""
+Compact, array backed chain for keeping many snapshots in memory (backtests)
+
+    chain = OptionChain.from_prices(a)      # liquid quotes, forward, TTM and fits of an option_prices
+    chain.strike[chain.calls]               # calls / puts are slices, i.e. views, not copies
+    chain.calibrate_SABR(method="L-BFGS-B", seed=0)
+    a = chain.to_prices()                   # back to a full option_prices (plots, density, quotes)
+
+Only what the calibration and the forward use is kept: strike, bid, ask, iv_bid, iv_ask
+(float64, vols in % as in the exports), vega (weights of the put-call parity forwards,
+see option_prices.implied_forwards), mark (option_prices.fill_implied_vols) and the type (int8, CALL / PUT), one contiguous array
+each, calls first then puts, both sorted by strike. The fits are stored as
+{attribute: (model name, params)} (see smile_models) and rebuilt on demand.
+"""
+import logging
+from datetime import datetime as dt
+import numpy as np
+import pandas as pd
+import SABR_engine as engine
+import smile_models as models
+from instrumentation import metrics
+from read_prices import option_prices, job_seed, SABR_PARAM_ATTRIBUTES
+
+CALL, PUT = 1, -1
+QUOTE_COLUMNS = ["strike", "bid", "ask", "iv_bid", "iv_ask", "vega", "mark"]
+
+
+class OptionChain():
+    __slots__ = ["underlying", "exp", "atm", "ttm", "valuation_time", "option_type", "n_calls",
+                 "fits"] + QUOTE_COLUMNS
+
+    def __init__(self, underlying, exp, atm, ttm, strike, option_type, bid, ask, iv_bid, iv_ask, vega=None,
+                 mark=None, fits=None, valuation_time=None):
+        """
+        option_type: CALL / PUT per row, or the exports' "C" / "P"
+        vega: per row, NaN if not given (the forward then only uses the plain averages)
+        mark: mark price per row, NaN if not given
+        fits: {"SABR_call_params_asks": ("sabr", [alpha, beta, rho, nu]), ...}
+        valuation_time: datetime the TTM was computed at, if known
+        """
+        option_type = np.asarray(option_type)
+        if option_type.dtype.kind in "US":
+            option_type = np.where(option_type == "C", CALL, PUT)
+        option_type = option_type.astype(np.int8)
+        strike = np.asarray(strike, dtype=np.float64)
+        order = np.lexsort((strike, -option_type))  # calls then puts, by strike
+
+        self.underlying = underlying
+        self.exp = exp
+        self.atm = atm
+        self.ttm = ttm
+        self.valuation_time = valuation_time
+        self.option_type = option_type[order]
+        self.n_calls = int(np.sum(self.option_type == CALL))
+        self.strike = strike[order]
+        if vega is None:
+            vega = np.full(len(strike), np.nan)
+        if mark is None:
+            mark = np.full(len(strike), np.nan)
+        for column, values in zip(QUOTE_COLUMNS[1:], (bid, ask, iv_bid, iv_ask, vega, mark)):
+            setattr(self, column, np.ascontiguousarray(np.asarray(values, dtype=np.float64)[order]))
+        self.fits = {attribute: (name, [float(x) for x in params])
+                     for attribute, (name, params) in (fits or {}).items()}
+
+    @classmethod
+    def from_frame(cls, df, atm, ttm, fits=None, valuation_time=None):
+        """
+        df: liquid rows of a chain (option_prices.df) with the chain_loader columns
+        """
+        return cls(underlying=df["underlying"].iloc[0],
+                   exp=dt.strptime(df["date"].iloc[0], "%d%b%y"),
+                   atm=atm,
+                   ttm=ttm,
+                   strike=df["strike"].to_numpy(),
+                   option_type=df["type"].to_numpy(dtype=str),
+                   bid=df["bid"].to_numpy(),
+                   ask=df["ask"].to_numpy(),
+                   iv_bid=df["iv_bid"].to_numpy(),
+                   iv_ask=df["iv_ask"].to_numpy(),
+                   vega=df["vega"].to_numpy(),
+                   mark=df["mark"].to_numpy(),
+                   fits=fits,
+                   valuation_time=valuation_time)
+
+    @classmethod
+    def from_prices(cls, prices):
+        """
+        Compact copy of an option_prices instance: its liquid quotes, forward, TTM and fits
+        """
+        smiles = getattr(prices, "smile_models", {})
+        fits = {}
+        for attribute in SABR_PARAM_ATTRIBUTES:
+            if attribute in smiles:
+                fits[attribute] = (smiles[attribute].name, smiles[attribute].params)
+            elif getattr(prices, attribute, None) is not None:
+                fits[attribute] = ("sabr", getattr(prices, attribute))
+        return cls.from_frame(prices.df, prices.atm, prices.ttm, fits, getattr(prices, "valuation_time", None))
+
+    def __len__(self):
+        return len(self.strike)
+
+    def __repr__(self):
+        return (f"OptionChain({self.underlying} {self.exp.date()}, {self.n_calls} calls, "
+                f"{len(self) - self.n_calls} puts, forward={self.atm}, ttm={self.ttm})")
+
+    @property
+    def calls(self):
+        return slice(0, self.n_calls)
+
+    @property
+    def puts(self):
+        return slice(self.n_calls, len(self.strike))
+
+    @property
+    def nbytes(self):
+        # bytes held by the quote arrays
+        return sum(getattr(self, column).nbytes for column in QUOTE_COLUMNS) + self.option_type.nbytes
+
+    def quote_sides(self):
+        # as option_prices._quote_sides, strikes are views on the chain
+        calls, puts = self.calls, self.puts
+        return [("Calls asks", "SABR_call_params_asks", self.strike[calls], self.iv_ask[calls]/100),
+                ("Call bids", "SABR_call_params_bids", self.strike[calls], self.iv_bid[calls]/100),
+                ("Put asks", "SABR_put_params_asks", self.strike[puts], self.iv_ask[puts]/100),
+                ("Put bids", "SABR_put_params_bids", self.strike[puts], self.iv_bid[puts]/100)]
+
+    def side_model(self, attribute):
+        """
+        Smile model (see smile_models) of a fitted quote side, e.g. "SABR_call_params_asks"
+        """
+        name, params = self.fits[attribute]
+        return models.MODELS[name](self.atm, self.ttm, params)
+
+    def job_seed(self):
+        # as option_prices.job_seed, the same for a chain and its option_prices
+        return job_seed(self.strike, self.iv_bid, self.iv_ask, self.atm, self.ttm)
+
+    def calibrate_SABR(self, method="L-BFGS-B", init_values=[0.99, 1, -0.1, 0.99], number_of_tries=10,
+                       n_polish=2, seed=None, max_evals=None, max_time=None):
+        """
+        Calibrates SABR to the four quote sides in one batch, as option_prices.calibrate_SABR
+        (without the cache). Returns the per side results
+
+        seed: defaults to job_seed()
+        """
+        if seed is None:
+            seed = self.job_seed()
+        sides = self.quote_sides()
+        results = engine.calibrate_SABR_batch(strike_sets=[side[2] for side in sides],
+                                              vol_sets=[side[3] for side in sides],
+                                              forward=self.atm,
+                                              TTM=self.ttm,
+                                              method=method,
+                                              number_of_tries=number_of_tries,
+                                              init_values=init_values,
+                                              n_polish=n_polish,
+                                              seed=seed,
+                                              max_evals=max_evals,
+                                              max_time=max_time)
+        for (label, attribute, _, _), result in zip(sides, results):
+            metrics.emit("calibration", level=logging.INFO, underlying=self.underlying,
+                         expiry=self.exp.date(), side=label, mse=round(result["mse"], 8),
+                         nfev=result["nfev"], source="batch")
+            self.fits[attribute] = ("sabr", result["params"])
+        return {side[1]: result for side, result in zip(sides, results)}
+
+    def to_frame(self):
+        """
+        DataFrame of the chain in the chain_loader layout (quote columns only), indexed by instrument
+        """
+        date = self.exp.strftime("%d%b%y").upper()
+        letters = np.where(self.option_type == CALL, "C", "P")
+        strikes = [str(int(strike)) if strike.is_integer() else str(strike) for strike in self.strike]
+        index = pd.Index([f"{self.underlying}-{date}-{strike}-{letter}" for strike, letter in zip(strikes, letters)],
+                         name="instrument")
+        df = pd.DataFrame({column: getattr(self, column) for column in QUOTE_COLUMNS}, index=index)
+        df["underlying"] = self.underlying
+        df["date"] = date
+        df["type"] = letters
+        df["vol_mid"] = (df["iv_bid"]+df["iv_ask"])/2
+        df["mark_mid"] = (df["bid"]+df["ask"])/2
+        return df
+
+    def to_prices(self, min_vol_ba_spread=15):
+        """
+        option_prices instance of the chain with its forward, TTM and fits (nothing is
+        re-estimated). Only the liquid quotes were kept, they're its whole chain
+        """
+        sabr_params = {attribute: params for attribute, (name, params) in self.fits.items() if name == "sabr"}
+        smiles = {attribute: fit for attribute, fit in self.fits.items() if fit[0] != "sabr"}
+        df = self.to_frame()
+        return option_prices.from_snapshot(filterfree_df=df, liquid=np.ones(len(df), dtype=bool),
+                                           atm=self.atm, ttm=self.ttm, min_vol_ba_spread=min_vol_ba_spread,
+                                           sabr_params=sabr_params, smile_models=smiles,
+                                           valuation_time=self.valuation_time)
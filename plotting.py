@@ -0,0 +1,182 @@
+"""
+Plots of an option_prices chain, the only module importing matplotlib and plotly.
+read_prices imports it on the first plot, so calibrating / pricing never loads them:
+
+    a = option_prices(name="BTC-27SEP")
+    a.calibrate_SABR(method="L-BFGS-B")
+    a.plot_pdf_cdf()                    # or plotting.plot_pdf_cdf(a)
+"""
+import math
+import numpy as np
+import matplotlib.pyplot as plt
+from matplotlib.lines import Line2D
+import plotly.graph_objects as go
+from plotly.subplots import make_subplots
+
+
+def plot_bid_ask(chain, puts=True, calls=True):
+
+    plt.figure(figsize=(12, 8))
+    df = chain.df
+    if not calls:
+        df = df[df["type"] != "C"]
+    if not puts:
+        df = df[df["type"] != "P"]
+    for option in df.iterrows():
+        if not math.isnan(option[1]["iv_bid"]):
+            plt.scatter(option[1]["strike"], option[1]["iv_bid"],
+                        color="r")
+        if not math.isnan(option[1]["iv_ask"]):
+            plt.scatter(option[1]["strike"], option[1]
+                        ["iv_ask"], color="c")
+
+    legend_elements = [Line2D([0], [0], marker='o', color='cyan', label='Ask', markerfacecolor='cyan', markersize=10),
+                       Line2D([0], [0], marker='o', color='red', label='Bid', markerfacecolor='red', markersize=10)]
+    # Add legend with custom handles and labels
+    plt.legend(handles=legend_elements, loc='best')
+    plt.title(
+        f"{chain.underlying} options implied volatility for {chain.exp} expiry", fontweight="bold")
+    plt.xlabel(f"Strike (in {chain.underlying}/USDT)")
+    plt.ylabel(f"Implied volatility (in %)")
+    plt.show()
+
+
+def plot_bid_ask_SABR_calls(chain):
+
+    plt.figure(figsize=(12, 8))
+    k = np.array(chain.calls["strike"])
+    v = np.array(chain.calls["iv_ask"])/100
+    x = np.linspace(k[0]-5000, k[-1]+5000, 1000)
+
+    # asks
+    model = chain.side_model("SABR_call_params_asks")
+    y = model.vol(x)
+
+    plt.plot(x, 100*np.array(y), label=f"Ask {model.name.upper()} Calibration")
+    plt.scatter(k, 100*v, marker="+", color="c", label="Asks IV")
+    plt.title(
+        f"Calibration of {model.name.upper()} to BTC call options' implied volatility bid and asks", fontweight="bold")
+    plt.xlabel("Strike (in USD)")
+    plt.grid(alpha=0.3)
+    plt.ylabel("Implied vol (in %)")
+
+    # bids
+    model = chain.side_model("SABR_call_params_bids")
+    v = np.array(chain.calls["iv_bid"])/100
+    y = model.vol(x)
+    plt.plot(x, 100*np.array(y), label=f"Bid {model.name.upper()} Calibration")
+    plt.scatter(k, 100*v, marker="+", color="orange", label="Bids IV")
+
+    plt.axvline(chain.atm, linestyle="--", linewidth=0.5,
+                label="Forward price", color="0")
+
+    plt.legend()
+    plt.show()
+
+
+def plot_bid_ask_SABR_puts(chain):
+    plt.figure(figsize=(12, 8))
+    k = np.array(chain.puts["strike"])
+    v = np.array(chain.puts["iv_ask"])/100
+    x = np.linspace(k[0]-5000, k[-1]+5000, 1000)
+
+    # asks
+    model = chain.side_model("SABR_put_params_asks")
+    y = model.vol(x)
+
+    plt.plot(x, 100*np.array(y), label=f"Ask {model.name.upper()} Calibration")
+    plt.scatter(k, 100*v, marker="+", color="c", label="Asks IV")
+    plt.title(
+        f"Calibration of {model.name.upper()} to BTC put options' implied volatility bid and asks", fontweight="bold")
+    plt.xlabel("Strike (in USD)")
+    plt.grid(alpha=0.3)
+    plt.ylabel("Implied vol (in %)")
+
+    # bids
+    model = chain.side_model("SABR_put_params_bids")
+    v = np.array(chain.puts["iv_bid"])/100
+    y = model.vol(x)
+    plt.plot(x, 100*np.array(y), label=f"Bid {model.name.upper()} Calibration")
+    plt.scatter(k, 100*v, marker="+", color="orange", label="Bids IV")
+
+    plt.axvline(chain.atm, linestyle="--", linewidth=0.5,
+                label="Forward price", color="0")
+    plt.legend()
+    plt.show()
+
+
+def plot_pcp(chain):
+
+    # calibrate data first
+
+    # option 1: Synthetic long (sell put buy calls)
+
+    plt.figure(figsize=(12, 8))
+
+    model = chain.side_model("SABR_put_params_bids")
+    k_p = np.array(chain.puts["strike"])
+    k_c = np.array(chain.calls["strike"])
+    x = np.linspace(k_p[0]-5000, k_c[-1]+5000, 1000)
+    v = np.array(chain.puts["iv_bid"])/100
+    y = model.vol(x)
+    plt.plot(x, 100*np.array(y), label=f"{model.name.upper()} Bid Calibration", color="blue")
+    plt.scatter(k_p, 100*v, marker="+", color="blue", label="Put Bids IV")
+
+    # calls
+
+    model = chain.side_model("SABR_call_params_asks")
+    k = np.array(chain.calls["strike"])
+    v = np.array(chain.calls["iv_ask"])/100
+    y = model.vol(x)
+    plt.plot(x, 100*np.array(y),
+             label=f"{model.name.upper()} call Ask Calibration", color="orange")
+    plt.scatter(k, 100*v, marker="+", color="orange", label="Bids IV")
+    plt.legend()
+    plt.show()
+
+
+def plot_pdf_cdf(chain, bins=200, method="butterfly"):
+
+    strikes, pdf, cdf = chain.implied_pdf(bins=bins, method=method, repair=True)
+    # probability of expiring in a bin of the average grid spacing
+    bin_probability = pdf*(strikes[-1] - strikes[0])/(len(strikes) - 1)
+
+    fig = make_subplots(rows=1, cols=2, subplot_titles=("PDF", "CDF"))
+
+    # Add PDF plot
+    fig.add_trace(go.Scatter(
+        x=strikes, y=100 * bin_probability, mode='lines', name='PDF'), row=1, col=1)
+
+    # Add CDF plot
+    fig.add_trace(go.Scatter(
+        x=strikes, y=100 * cdf, mode='lines', name='CDF'), row=1, col=2)
+
+    # Update layout
+    fig.update_layout(
+        title=f"Implied PDF and CDF of {chain.underlying} options expiring {chain.exp.strftime('%A, %B %d, %Y')}",
+        xaxis_title="Strike (in $)",
+        yaxis_title="Probability (in %)",
+        plot_bgcolor='rgba(0,0,0,0)',  # Transparent background
+        height=600,
+        width=1000,
+        showlegend=True
+    )
+
+    # Add grids to both subplots
+    fig.update_xaxes(showgrid=True, gridwidth=1,
+                     gridcolor='rgba(0,0,0,0.1)', row=1, col=1)
+    fig.update_yaxes(showgrid=True, gridwidth=1,
+                     gridcolor='rgba(0,0,0,0.1)', row=1, col=1)
+    fig.update_xaxes(showgrid=True, gridwidth=1,
+                     gridcolor='rgba(0,0,0,0.1)', row=1, col=2)
+    fig.update_yaxes(showgrid=True, gridwidth=1,
+                     gridcolor='rgba(0,0,0,0.1)', row=1, col=2)
+
+    # Add a horizontal line at y=0 in each subplot
+    fig.add_shape(type="line", x0=strikes.min(), y0=0, x1=strikes.max(), y1=0, line=dict(color="black", width=1),
+                  row=1, col=1)
+    fig.add_shape(type="line", x0=strikes.min(), y0=0, x1=strikes.max(), y1=0, line=dict(color="black", width=1),
+                  row=1, col=2)
+
+    # Show the plot
+    fig.show()
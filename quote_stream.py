@@ -0,0 +1,55 @@
+"""
+Synthetic tick stream built from a bundled export, to exercise
+option_prices.apply_quotes without an exchange connection:
+
+    a = option_prices(name="BTC-27SEP")
+    a.calibrate_SABR(method="L-BFGS-B")
+    for updates in replay_quotes(a.filterfree_df, n_ticks=100, seed=0):
+        a.apply_quotes(updates)
+        strikes, pdf, cdf = a.density()
+"""
+import time
+import numpy as np
+import pandas as pd
+
+QUOTE_COLUMNS = ["iv_bid", "iv_ask", "bid", "ask"]
+
+
+def replay_quotes(df, batch_size=4, n_ticks=None, seed=None, vol_noise=0.5, price_noise=0.01):
+    """
+    Yields quote updates (DataFrame indexed by instrument) for batch_size random
+    two-sided instruments of df at a time, forever if n_ticks is None
+
+    vol_noise: std of the iv moves (in vol points)
+    price_noise: relative std of the bid/ask moves
+    """
+    rng = np.random.default_rng(seed)
+    quotes = df.loc[df[QUOTE_COLUMNS].notna().all(axis=1), QUOTE_COLUMNS]
+    instruments = quotes.index.to_numpy()
+    state = quotes.to_numpy(copy=True)
+
+    tick = 0
+    while n_ticks is None or tick < n_ticks:
+        rows = rng.choice(len(instruments), size=min(batch_size, len(instruments)), replace=False)
+        vol_move = rng.normal(0, vol_noise, len(rows))
+        price_move = np.exp(rng.normal(0, price_noise, len(rows)))
+        # both sides move together, the spread is kept (and never crossed)
+        state[rows, 0:2] = np.maximum(state[rows, 0:2] + vol_move[:, None], 0.01)
+        state[rows, 2:4] = state[rows, 2:4]*price_move[:, None]
+        yield pd.DataFrame(state[rows], index=pd.Index(instruments[rows], name=df.index.name),
+                           columns=QUOTE_COLUMNS)
+        tick += 1
+
+
+def replay(chain, n_ticks=200, batch_size=4, seed=0, **apply_kwargs):
+    """
+    Feeds replay_quotes into chain.apply_quotes and recomputes the density after each tick.
+    Returns the tick to density latencies in seconds
+    """
+    latencies = []
+    for updates in replay_quotes(chain.filterfree_df, batch_size=batch_size, n_ticks=n_ticks, seed=seed):
+        start = time.perf_counter()
+        chain.apply_quotes(updates, **apply_kwargs)
+        chain.density()
+        latencies.append(time.perf_counter() - start)
+    return np.array(latencies)
@@ -1,481 +1,777 @@
+import logging
+import time
+from collections import namedtuple
 import pandas as pd
-import os
 from datetime import datetime as dt
 import numpy as np
-import matplotlib.pyplot as plt
-import math
-from matplotlib.lines import Line2D
+from scipy.stats import trim_mean
 import SABR_calibration as s
+import chain_loader as loader
+import SABR_engine as engine
+from calibration_cache import snapshot_hash
+from instrumentation import metrics, timed
 import SABR_functions as sabr
-import plotly.graph_objects as go
-from plotly.subplots import make_subplots
+import density_checks as checks
+import smile_models as models
 
 
-class option_prices():
-    def __init__(self, name, min_vol_ba_spread=15):
+def liquidity_filering(df, spread):
+    df["vol_bid_ask_spread"] = df["iv_ask"] - \
+        df["iv_bid"]
+    df = df[df["vol_bid_ask_spread"] < spread]
+    return df
 
-        header = ["instrument", 'volume', 'open', 'extvalue', 'rho', 'theta', 'vega', 'gamma',
-                  'ndelta', 'delta', 'last', 'bid_size', 'iv_bid', 'bid', 'mark', 'ask', 'iv_ask', 'ask_size']
-        columns_to_transform = ['strike', 'volume', 'open', 'extvalue', 'rho', 'theta', 'vega', 'gamma',
-                                'ndelta', 'delta', 'last', 'bid_size', 'iv_bid', 'bid', 'mark', 'ask', 'iv_ask', 'ask_size']
 
-        found = False
+def aggregate_forwards(pcp_forwards, aggregation="mean", trim=0.1):
+    """
+    Averages the per strike put-call parity forwards (see option_prices.implied_forwards)
 
-        """
-        THE ACTUAL FUCK IS THIS GARB??? NEEDED TO INPUT A STRIKE (x) AND VOL (y) ARRAY 
+    aggregation: "mean", "median", "trimmed" (drops trim of each tail) or "vega"
+                 (vega weighted mean, the far OTM strikes count less)
+    """
+    forwards = pcp_forwards["forward"].to_numpy()
+    if aggregation == "mean":
+        forward = np.mean(forwards)
+    elif aggregation == "median":
+        forward = np.median(forwards)
+    elif aggregation == "trimmed":
+        forward = trim_mean(forwards, trim)
+    elif aggregation == "vega":
+        forward = np.average(forwards, weights=pcp_forwards["vega"].to_numpy())
+    else:
+        raise ValueError("aggregation should be 'mean', 'median', 'trimmed' or 'vega'")
+    return round(float(forward), 2)
 
-        This way API can come in and create an instance of option_prices
-        
-        """
-        for file in os.listdir():
-            if ".csv" in str(file) and name in file:
-                self.df = pd.read_csv(file, header=0, names=header)
-                self.df[['underlying', 'date', 'strike', 'type']
-                        ] = self.df['instrument'].str.split('-', expand=True)
 
-                self.df[columns_to_transform] = self.df[columns_to_transform].apply(
-                    pd.to_numeric, errors='coerce')
-                self.df["vol_mid"] = (self.df["iv_bid"]+self.df["iv_ask"])/2
-                self.df["mark_mid"] = (self.df["bid"]+self.df["ask"])/2
-                found = True
+def sinh_grid(forward, lower, upper, concentration, n=101):
+    """
+    n strikes from lower to upper, dense around the forward and sparse in the tails:
+    log-moneyness = c*sinh(u) with u uniform
+
+    concentration: width c (in log-moneyness) of the dense region
+    """
+    c = max(concentration, 1e-4)
+    u = np.linspace(np.arcsinh(np.log(lower/forward)/c),
+                    np.arcsinh(np.log(upper/forward)/c), n)
+    return forward*np.exp(c*np.sinh(u))
+
+
+def job_seed(strikes, iv_bid, iv_ask, forward, ttm):
+    """
+    Seed of the calibrations of a chain when none is given: a hash of its liquid quotes
+    (in any row order), the forward and the TTM, so the same snapshot valued at the same
+    time gets the same fit in any process or run. A list of non negative ints, as
+    np.random.default_rng takes (an expired chain has a negative TTM, kept as its
+    unsigned 64 bits)
+    """
+    quotes = np.column_stack([np.asarray(x, dtype=np.float64) for x in (strikes, iv_bid, iv_ask)])
+    quotes = quotes[np.lexsort(quotes.T[::-1])]
+    seconds = int(round(ttm*3600*24*365)) % 2**64
+    return [int(snapshot_hash(quotes[:, 0], quotes[:, 1:], forward, ttm), 16), seconds]
+
+
+def _plotting():
+    # matplotlib and plotly are only loaded once something is plotted
+    import plotting
+    return plotting
+
 
-        if found == False:
-            print("Error, couldn't find option price file")
+def _chain_context(chain, *args, **kwargs):
+    # fields added to the timer events of option_prices methods
+    return {"underlying": chain.underlying, "expiry": chain.exp.date()}
 
-        def liquidity_filering(df, spread):
-            df["vol_bid_ask_spread"] = df["iv_ask"] - \
-                df["iv_bid"]
-            df = df[df["vol_bid_ask_spread"] < spread]
-            return df
+
+# bands are (2, strikes): lower and upper bound at every strike
+DensityBands = namedtuple("DensityBands", ["strikes", "pdf", "cdf", "bid_ask_pdf", "bid_ask_cdf",
+                                           "bootstrap_pdf", "bootstrap_cdf"])
+
+SABR_PARAM_ATTRIBUTES = ["SABR_call_params_asks", "SABR_call_params_bids",
+                         "SABR_put_params_asks", "SABR_put_params_bids"]
+
+
+class option_prices():
+    def __init__(self, name=None, min_vol_ba_spread=15, directory=None, path=None, df=None,
+                 forward_aggregation="mean", fill_missing_vols=False, valuation_time=None):
+        """
+        name: part of the export file name (e.g. "BTC-27SEP"), looked up in directory
+              (defaults to the working directory)
+        path: explicit path of a Deribit export, instead of name
+        df: an already loaded chain (chain_loader.read_export, or one expiry of read_exports)
+        forward_aggregation: how find_atm_pcp averages the put-call parity forwards
+        fill_missing_vols: recovers the missing iv_bid / iv_ask from the prices (see fill_implied_vols)
+        valuation_time: datetime the chain is valued at (TTM = expiry - valuation_time), defaults
+                        to now. Fix it to get the same TTM, and the same fits, on every run
+        """
+        if df is None:
+            if path is None:
+                path = loader.find_export(name, directory)
+            with metrics.timer("load", path=path):
+                df = loader.read_export(path)
+        self.df = df.copy()
 
         self.filterfree_df = self.df
-        self.df = liquidity_filering(self.df, spread=min_vol_ba_spread)
+        self.min_vol_ba_spread = min_vol_ba_spread
+        self._split_chain(liquidity_filering(self.df, spread=min_vol_ba_spread))
+        self.atm = self.find_atm_pcp(aggregation=forward_aggregation)
+        self.set_valuation_time(dt.now() if valuation_time is None else valuation_time)
+        if fill_missing_vols:
+            self.fill_implied_vols()
+
+    def _split_chain(self, df):
+        # liquid options, split into calls and puts
+        self.df = df
         self.puts = self.df[self.df["type"] == "P"]
         self.calls = self.df[self.df["type"] == "C"]
         self.underlying = self.df["underlying"].iloc[0]
         exp_date_str = self.df["date"].iloc[0]
         self.exp = dt.strptime(exp_date_str, "%d%b%y")
-        self.atm = self.find_atm_pcp()
-        # ASSUMES CURRENT PRICING DATE !!!! > in years tho
-        self.ttm = (self.exp - dt.today()).days/365 + \
-            (self.exp - dt.today()).seconds/(3600*24*365)
+
+    def set_valuation_time(self, valuation_time):
+        """
+        Values the chain at valuation_time (datetime or ISO string): TTM in years (365 days)
+        to the expiry. The fits aren't redone, recalibrate if the TTM moved
+        """
+        if isinstance(valuation_time, str):
+            valuation_time = dt.fromisoformat(valuation_time)
+        self.valuation_time = valuation_time
+        self.ttm = (self.exp - valuation_time).total_seconds()/(3600*24*365)
+        self._densities = {}
+
+    def job_seed(self):
+        """
+        Seed of the calibrations when none is given (see job_seed), fits can be cached /
+        deduplicated on the same key
+        """
+        return job_seed(self.df["strike"], self.df["iv_bid"], self.df["iv_ask"], self.atm, self.ttm)
+
+    @classmethod
+    def from_snapshot(cls, filterfree_df, liquid, atm, ttm, min_vol_ba_spread=15, sabr_params=None,
+                      smile_models=None, valuation_time=None):
+        """
+        Rebuilds an instance from stored state (see snapshot_store) without re-reading
+        the CSV, re-estimating the forward or re-calibrating
+
+        liquid: boolean mask of the rows of filterfree_df that passed the liquidity filter
+        sabr_params: {"SABR_call_params_asks": [alpha, beta, rho, nu], ...}
+        smile_models: {"SABR_call_params_asks": ("svi", params), ...} for the sides not on SABR
+        valuation_time: datetime the TTM was computed at, if known
+        """
+        self = cls.__new__(cls)
+        self.filterfree_df = filterfree_df
+        self.min_vol_ba_spread = min_vol_ba_spread
+        self._split_chain(filterfree_df[np.asarray(liquid, dtype=bool)])
+        self.atm = atm
+        self.ttm = ttm
+        self.valuation_time = valuation_time
+        for attribute, params in (sabr_params or {}).items():
+            setattr(self, attribute, params)
+        self.smile_models = {attribute: models.MODELS[name](atm, ttm, params)
+                             for attribute, (name, params) in (smile_models or {}).items()}
+        return self
 
     def plot_bid_ask(self, puts=True, calls=True):
+        _plotting().plot_bid_ask(self, puts=puts, calls=calls)
+
+    def implied_forwards(self, df=None):
+        """
+        Forward implied by put-call parity at every strike with both a call and a put
+        mark (defaults to filterfree_df)
 
-        plt.figure(figsize=(12, 8))
-        df = self.df
-        if not calls:
-            df = df[df["type"] != "C"]
-        if not puts:
-            df = df[df["type"] != "P"]
-        for option in df.iterrows():
-            if not math.isnan(option[1]["iv_bid"]):
-                plt.scatter(option[1]["strike"], option[1]["iv_bid"],
-                            color="r")
-            if not math.isnan(option[1]["iv_ask"]):
-                plt.scatter(option[1]["strike"], option[1]
-                            ["iv_ask"], color="c")
-
-        legend_elements = [Line2D([0], [0], marker='o', color='cyan', label='Ask', markerfacecolor='cyan', markersize=10),
-                           Line2D([0], [0], marker='o', color='red', label='Bid', markerfacecolor='red', markersize=10)]
-        # Add legend with custom handles and labels
-        plt.legend(handles=legend_elements, loc='best')
-        plt.title(
-            f"{self.underlying} options implied volatility for {self.exp} expiry", fontweight="bold")
-        plt.xlabel(f"Strike (in {self.underlying}/USDT)")
-        plt.ylabel(f"Implied volatility (in %)")
-        plt.show()
-
-    def find_atm_pcp(self):
-        # deriving the fwd price from atm price
-        df = self.filterfree_df.groupby("strike")
-        found_atm_fwd = []
-        for strike in df:
-            if not strike[1]["mark_mid"].isna().any():
-                i = strike[1]
-                call = i[i["type"] == "C"]
-                put = i[i["type"] == "P"]
-                """
-                Original PCP assuming 0 interest rate:
-                Call Price - Put Price = Spot Price - Strike Price
-
-                PCP if Price call price in units:
-                Spot = - (Strike)/(Call - Put - 1)
-
-                since option price is in units and not in USD
-                """
-                spot = - float(call["strike"]) / \
-                    (float(call["mark_mid"]) - float(put["mark_mid"])-1)
-                found_atm_fwd.append(spot)
-        return round(np.mean(found_atm_fwd), 2)
-
-    def calibrate_SABR(self, method="Newton-CG", init_values=[0.99, 1, -0.1, 0.99], number_of_tries=10):
-        # Calls asks
-        print("Calls asks:")
-
-        best_params = None
-        best_mse = float('inf')  # Initialize with positive infinity
-        k = np.array(self.calls["strike"])
-        v = np.array(self.calls["iv_ask"]) / 100
-
-        for _ in range(number_of_tries):
-            init_values = [np.random.uniform(0.01, 1),
-                           1,
-                           np.random.uniform(-1, 1),
-                           np.random.uniform(0.01, 1)]
-            [alpha, beta, rho, nu], mse = s.calibrate_SABR(strikes=k,
-                                                           volatilities=v,
-                                                           forward=self.atm,
-                                                           TTM=self.ttm,
-                                                           method=method,
-                                                           init_param=init_values)
-            if mse < best_mse:
-                best_mse = mse
-                best_params = [alpha, beta, rho, nu]
-        print(f"-> Best MSE: {round(best_mse, 8)} ")
-        self.SABR_call_params_asks = best_params
-
-        # Calls bids
-        print("Call bids:")
-
-        best_params = None
-        best_mse = float('inf')  # Initialize with positive infinity
-        v = np.array(self.calls["iv_bid"])/100
-
-        for _ in range(number_of_tries):
-            init_values = [np.random.uniform(0.01, 1),
-                           1,
-                           np.random.uniform(-1, 1),
-                           np.random.uniform(0.01, 1)]
-            [alpha, beta, rho, nu], mse = s.calibrate_SABR(strikes=k,
-                                                           volatilities=v,
-                                                           forward=self.atm,
-                                                           TTM=self.ttm,
-                                                           method=method,
-                                                           init_param=init_values
-                                                           )
-            if mse < best_mse:
-                best_mse = mse
-                best_params = [alpha, beta, rho, nu]
-        print(f"-> Best MSE: {round(best_mse, 8)} ")
-
-        self.SABR_call_params_bids = best_params
-
-        # Puts asks
-        print("Put asks:")
-
-        best_params = None
-        best_mse = float('inf')  # Initialize with positive infinity
-        k = np.array(self.puts["strike"])
-        v = np.array(self.puts["iv_ask"])/100
-
-        for _ in range(number_of_tries):
-            init_values = [np.random.uniform(0.01, 1),
-                           1,
-                           np.random.uniform(-1, 1),
-                           np.random.uniform(0.01, 1)]
-            [alpha, beta, rho, nu], mse = s.calibrate_SABR(strikes=k,
-                                                           volatilities=v,
-                                                           forward=self.atm,
-                                                           TTM=self.ttm,
-                                                           method=method,
-                                                           init_param=init_values)
-            if mse < best_mse:
-                best_mse = mse
-                best_params = [alpha, beta, rho, nu]
-        print(f"-> Best MSE: {round(best_mse, 8)} ")
-        self.SABR_put_params_asks = best_params
-
-        # Puts bids
-        print("Put bids:")
-        best_params = None
-        best_mse = float('inf')  # Initialize with positive infinity
-        v = np.array(self.puts["iv_bid"])/100
-
-        for _ in range(number_of_tries):
-            init_values = [np.random.uniform(0.01, 1),
-                           1,
-                           np.random.uniform(-1, 1),
-                           np.random.uniform(0.01, 1)]
-            [alpha, beta, rho, nu], mse = s.calibrate_SABR(strikes=k,
-                                                           volatilities=v,
-                                                           forward=self.atm,
-                                                           TTM=self.ttm,
-                                                           method=method,
-                                                           init_param=init_values)
-            if mse < best_mse:
-                best_mse = mse
-                best_params = [alpha, beta, rho, nu]
-
-        print(f"-> Best MSE: {round(best_mse, 8)} ")
-        self.SABR_put_params_bids = best_params
+        Original PCP assuming 0 interest rate:
+        Call Price - Put Price = Spot Price - Strike Price
 
-    def plot_bid_ask_SABR_calls(self):
+        PCP if Price call price in units:
+        Spot = - (Strike)/(Call - Put - 1)
+
+        since option price is in units and not in USD
+
+        Returns a DataFrame indexed by strike with the forward and the average call/put vega
+        """
+        df = self.filterfree_df if df is None else df
+        # calls and puts aligned on the sorted unique strikes in one go
+        strikes, position = np.unique(df["strike"].to_numpy(), return_inverse=True)
+        option_type = df["type"].to_numpy()
+        mark = df["mark_mid"].to_numpy()
+        vega = df["vega"].to_numpy()
+        call, put = np.full(len(strikes), np.nan), np.full(len(strikes), np.nan)
+        call_vega, put_vega = np.zeros(len(strikes)), np.zeros(len(strikes))
+        is_call, is_put = option_type == "C", option_type == "P"
+        call[position[is_call]] = mark[is_call]
+        put[position[is_put]] = mark[is_put]
+        call_vega[position[is_call]] = vega[is_call]
+        put_vega[position[is_put]] = vega[is_put]
+
+        both = np.isfinite(call) & np.isfinite(put)
+        forwards = - strikes[both]/(call[both] - put[both] - 1)
+        vega = np.nan_to_num((call_vega[both] + put_vega[both])/2)
+        return pd.DataFrame({"forward": forwards, "vega": vega},
+                            index=pd.Index(strikes[both], name="strike"))
+
+    @timed("find_atm_pcp", context=_chain_context)
+    def find_atm_pcp(self, aggregation="mean", trim=0.1):
+        """
+        Forward price from put-call parity, aggregated over strikes (see aggregate_forwards)
+        The per strike forwards are kept in self.pcp_forwards
+        """
+        self.pcp_forwards = self.implied_forwards()
+        self.forward_aggregation = (aggregation, trim)
+        return aggregate_forwards(self.pcp_forwards, aggregation, trim)
+
+    @timed("fill_implied_vols", context=_chain_context)
+    def fill_implied_vols(self, overwrite=False):
+        """
+        Implied vols (in %) of the bid, ask and mark prices (in units of the underlying) at
+        the put-call parity forward self.atm, the whole chain in one array call
+        (SABR_functions.implied_volatility)
 
-        plt.figure(figsize=(12, 8))
-        k = np.array(self.calls["strike"])
-        v = np.array(self.calls["iv_ask"])/100
-        x, y = np.linspace(k[0]-5000, k[-1]+5000, 1000), []
-
-        # asks
-        alpha, beta, rho, nu = self.SABR_call_params_asks
-        for i in x:
-            y.append(sabr.strike_volatility_SABR(k=i,
-                                                 f=self.atm,
-                                                 alpha=alpha,
-                                                 beta=beta,
-                                                 nu=nu,
-                                                 rho=rho,
-                                                 t=self.ttm))
-
-        plt.plot(x, 100*np.array(y), label="Ask SABR Calibration")
-        plt.scatter(k, 100*v, marker="+", color="c", label="Asks IV")
-        plt.title(
-            "Calibration of SABR to BTC call options' implied volatility bid and asks", fontweight="bold")
-        plt.xlabel("Strike (in USD)")
-        plt.grid(alpha=0.3)
-        plt.ylabel("Implied vol (in %)")
-
-        # bids
-        alpha, beta, rho, nu = self.SABR_call_params_bids
-        y = []
-        v = np.array(self.calls["iv_bid"])/100
-        for i in x:
-            y.append(sabr.strike_volatility_SABR(k=i,
-                                                 f=self.atm,
-                                                 alpha=alpha,
-                                                 beta=beta,
-                                                 nu=nu,
-                                                 rho=rho,
-                                                 t=self.ttm))
-        plt.plot(x, 100*np.array(y), label="Bid SABR Calibration")
-        plt.scatter(k, 100*v, marker="+", color="orange", label="Bids IV")
-
-        plt.axvline(self.atm, linestyle="--", linewidth=0.5,
-                    label="Forward price", color="0")
-
-        plt.legend()
-        plt.show()
+        Fills the missing iv_bid / iv_ask (all of them if overwrite), adds an iv_mark column
+        and re-applies the liquidity filter, strikes the exchange gave no vol for can then
+        pass it. Returns the number of vols filled.
+        """
+        if self.ttm <= 0:
+            raise ValueError(f"the {self.exp.date()} expiry has passed, set ttm to invert prices")
+        df = self.filterfree_df.copy()
+        strikes = df["strike"].to_numpy()[:, None]
+        w = np.where(df["type"].to_numpy() == "C", 1, -1)[:, None]
+        prices = df[["bid", "ask", "mark"]].to_numpy(dtype=np.float64)*self.atm
+        vols = 100*sabr.implied_volatility(prices, self.atm, strikes, self.ttm, w)
+
+        filled = 0
+        for i, column in enumerate(["iv_bid", "iv_ask"]):
+            current = df[column].to_numpy(dtype=np.float64)
+            replace = np.isfinite(vols[:, i]) & (overwrite | np.isnan(current))
+            filled += int(np.sum(replace & np.isnan(current)))
+            df[column] = np.where(replace, vols[:, i], current)
+        df["iv_mark"] = vols[:, 2]
+        df["vol_mid"] = (df["iv_bid"]+df["iv_ask"])/2
+        metrics.count("implied_vols_filled", filled)
+
+        self.filterfree_df = df
+        self._split_chain(liquidity_filering(df, spread=self.min_vol_ba_spread))
+        self._densities = {}
+        return filled
+
+    def _quote_sides(self):
+        # (label, params attribute, strikes, vols) of the four quote sides SABR is fitted to
+        k_calls = np.array(self.calls["strike"])
+        k_puts = np.array(self.puts["strike"])
+        return [("Calls asks", "SABR_call_params_asks", k_calls, np.array(self.calls["iv_ask"])/100),
+                ("Call bids", "SABR_call_params_bids", k_calls, np.array(self.calls["iv_bid"])/100),
+                ("Put asks", "SABR_put_params_asks", k_puts, np.array(self.puts["iv_ask"])/100),
+                ("Put bids", "SABR_put_params_bids", k_puts, np.array(self.puts["iv_bid"])/100)]
+
+    @timed("calibrate_SABR", context=_chain_context)
+    def calibrate_SABR(self, method="Newton-CG", init_values=[0.99, 1, -0.1, 0.99], number_of_tries=10,
+                       n_polish=2, seed=None, max_evals=None, max_time=None, cache=None):
+        """
+        Calibrates SABR to the call/put bids and asks in one batch (see SABR_engine)
+
+        number_of_tries: random starting points per side, init_values is tried as well
+        n_polish: best starts per side refined with the scipy method
+        seed: seed or np.random.Generator of the random starting points, defaults to job_seed()
+        max_evals / max_time: evaluation or wall time (seconds) budget for the four fits
+        cache: calibration_cache.CalibrationCache, sides whose quotes didn't change reuse
+               the cached fit, the others start from it before falling back to random restarts
+        """
+        sides = self._quote_sides()
+        seed = self.job_seed() if seed is None else seed
+
+        results = {}
+        snapshots = {}
+        if cache is not None:
+            for label, attribute, k, v in sides:
+                key = (self.underlying, self.exp, attribute)
+                snapshots[attribute] = snapshot_hash(k, v, self.atm, self.ttm)
+                entry = cache.get(key)
+                if entry is None:
+                    continue
+                if entry.snapshot == snapshots[attribute]:
+                    metrics.count("cache_hit")
+                    results[attribute] = {"params": entry.params, "mse": entry.mse, "nfev": 0,
+                                          "source": "cache"}
+                    continue
+                metrics.count("warm_start")
+                params, mse, result = s.calibrate_SABR(strikes=k,
+                                                       volatilities=v,
+                                                       forward=self.atm,
+                                                       TTM=self.ttm,
+                                                       method=method,
+                                                       init_param=entry.params,
+                                                       full_output=True)
+                warm = {attribute: models.SABRModel(self.atm, self.ttm, params)}
+                if not cache.warm_start_failed(entry, mse) and self._arbitrage_reports(warm)[attribute].arbitrage_free:
+                    results[attribute] = {"params": params, "mse": float(mse), "nfev": int(result.nfev),
+                                          "source": "warm"}
+                else:
+                    metrics.count("warm_start_failed")
+
+        cold_sides = [side for side in sides if side[1] not in results]
+        if cold_sides:
+            cold_results = engine.calibrate_SABR_batch(strike_sets=[side[2] for side in cold_sides],
+                                                       vol_sets=[side[3] for side in cold_sides],
+                                                       forward=self.atm,
+                                                       TTM=self.ttm,
+                                                       method=method,
+                                                       number_of_tries=number_of_tries,
+                                                       init_values=init_values,
+                                                       n_polish=n_polish,
+                                                       seed=seed,
+                                                       max_evals=max_evals,
+                                                       max_time=max_time)
+            for side, result in zip(cold_sides, cold_results):
+                results[side[1]] = dict(result, source="batch")
+
+        self.calibration_results = {}
+        for label, attribute, _, _ in sides:
+            result = results[attribute]
+            metrics.emit("calibration", level=logging.INFO, underlying=self.underlying,
+                         expiry=self.exp.date(), side=label, mse=round(result['mse'], 8),
+                         nfev=result["nfev"], source=result["source"])
+            setattr(self, attribute, result["params"])
+            self.calibration_results[attribute] = result
+            if cache is not None and result["params"] is not None:
+                cache.put((self.underlying, self.exp, attribute),
+                          result["params"], result["mse"], snapshots[attribute])
+        self.smile_models = {}
+        self.check_arbitrage()
+        self._densities = {}
+
+    @timed("calibrate_smile", context=_chain_context)
+    def calibrate_smile(self, model="auto", tolerance=1.1, max_mse=None, method="L-BFGS-B", **sabr_kwargs):
+        """
+        Fits a smile model (see smile_models) to the four quote sides of the expiry
+
+        model: "sabr" (calibrate_SABR), "svi" or "auto": SVI is fitted first (deterministic
+               and cheap) and SABR only if the SVI total mse is above max_mse (None: always).
+               The model with the fewest sides in arbitrage (see check_arbitrage) is kept, on
+               a tie the expiry stays on SVI unless SABR's total mse is below SVI's / tolerance,
+               i.e. the slower fit has to buy that much error
+        sabr_kwargs: passed to calibrate_SABR (number_of_tries, seed, cache, ...)
+
+        Returns the name of the model kept
+        """
+        if model not in ("sabr", "svi", "auto"):
+            raise ValueError("model should be 'sabr', 'svi' or 'auto'")
+        if model == "sabr":
+            self.calibrate_SABR(method=method, **sabr_kwargs)
+            return "sabr"
+
+        sides = self._quote_sides()
+        svi = {attribute: models.SVIModel(self.atm, self.ttm).calibrate(k, v)
+               for _, attribute, k, v in sides}
+        svi_mse = sum(fit.mse for fit in svi.values())
+        svi_reports = self._arbitrage_reports(svi)
+        svi_arbitrage = sum(not report.arbitrage_free for report in svi_reports.values())
+        if model == "auto" and (max_mse is None or svi_mse > max_mse or svi_arbitrage):
+            start = time.perf_counter()
+            self.calibrate_SABR(method=method, **sabr_kwargs)
+            results = self.calibration_results.values()
+            sabr_mse = sum(result["mse"] for result in results)
+            sabr_arbitrage = sum(not result["arbitrage_free"] for result in results)
+            keep_sabr = (sabr_arbitrage, sabr_mse*tolerance) < (svi_arbitrage, svi_mse)
+            metrics.emit("model_selection", underlying=self.underlying, expiry=self.exp.date(),
+                         svi_mse=svi_mse, svi_seconds=sum(fit.seconds for fit in svi.values()),
+                         svi_arbitrage=svi_arbitrage, sabr_mse=sabr_mse,
+                         sabr_seconds=time.perf_counter() - start, sabr_arbitrage=sabr_arbitrage,
+                         model="sabr" if keep_sabr else "svi")
+            if keep_sabr:
+                return "sabr"
+
+        self.smile_models = svi
+        self.calibration_results = {}
+        for label, attribute, _, _ in sides:
+            fit = svi[attribute]
+            metrics.emit("calibration", level=logging.INFO, underlying=self.underlying,
+                         expiry=self.exp.date(), side=label, mse=round(fit.mse, 8),
+                         nfev=fit.nfev, source="svi")
+            self.calibration_results[attribute] = {"params": fit.params, "mse": fit.mse,
+                                                   "nfev": fit.nfev, "source": "svi"}
+        self._record_arbitrage(svi_reports)
+        self._densities = {}
+        return "svi"
+
+    def side_model(self, attribute):
+        """
+        Smile model of a quote side (e.g. "SABR_call_params_asks"): the one kept by
+        calibrate_smile, else SABR with the side's params, at the current forward and TTM
+        """
+        model = getattr(self, "smile_models", {}).get(attribute)
+        if model is None:
+            model = models.SABRModel(self.atm, self.ttm, getattr(self, attribute))
+        model.forward, model.ttm = self.atm, self.ttm
+        return model
+
+    def _arbitrage_reports(self, smiles, bins=100, tolerance=1e-4):
+        """
+        density_checks.check_density of the Breeden-Litzenberger density of every smile
+        model of smiles ({attribute: model}), all on one adaptive_grid(bins+1)
+
+        Returns {attribute: DensityReport}
+        """
+        smiles = {attribute: model for attribute, model in smiles.items() if model.params is not None}
+        if not smiles:
+            return {}
+        concentration = np.nanmean([model.vol(self.atm) for model in smiles.values()])*np.sqrt(self.ttm)
+        grid = self.adaptive_grid(bins+1, concentration=concentration)
+        vol, dvol_dk, d2vol_dk2 = (np.array(x) for x in zip(*(model.vol_derivatives(grid)
+                                                             for model in smiles.values())))
+        pdf, cdf = sabr.breeden_litzenberger(forward=self.atm, ttm=self.ttm, strike=grid,
+                                             vol=vol, dvol_dk=dvol_dk, d2vol_dk2=d2vol_dk2)
+        report = checks.check_density(grid, pdf, cdf[:, 0], cdf[:, -1], tolerance, cdf=cdf)
+        return {attribute: checks.DensityReport._make(np.asarray(field)[i].item() for field in report)
+                for i, attribute in enumerate(smiles)}
+
+    def _record_arbitrage(self, reports):
+        for attribute, report in reports.items():
+            result = self.calibration_results.setdefault(attribute, {})
+            result["arbitrage_free"] = report.arbitrage_free
+            result["negative_mass"] = report.negative_mass
+            if not report.arbitrage_free:
+                metrics.count("arbitrage_detected")
+                metrics.emit("arbitrage", level=logging.WARNING, underlying=self.underlying,
+                             expiry=self.exp.date(), side=attribute, negative_mass=report.negative_mass,
+                             lower_tail=report.lower_tail, upper_tail=report.upper_tail,
+                             max_cdf=report.max_cdf)
+
+    def check_arbitrage(self, bins=100, tolerance=1e-4):
+        """
+        Butterfly / vertical spread arbitrage of the four fitted smiles (see density_checks),
+        cheap enough to run after every calibration (which they do)
+
+        tolerance: negative mass accepted
+
+        Returns {attribute: DensityReport}, arbitrage_free and negative_mass are also
+        added to calibration_results
+        """
+        if not hasattr(self, "calibration_results"):
+            self.calibration_results = {}
+        smiles = {attribute: self.side_model(attribute) for attribute in SABR_PARAM_ATTRIBUTES
+                  if getattr(self, attribute, None) is not None or attribute in getattr(self, "smile_models", {})}
+        reports = self._arbitrage_reports(smiles, bins=bins, tolerance=tolerance)
+        self._record_arbitrage(reports)
+        return reports
+
+    @timed("apply_quotes", context=_chain_context)
+    def apply_quotes(self, updates, drift_ratio=1.5, method="L-BFGS-B"):
+        """
+        Patches the chain with a few quote updates instead of rebuilding it
+
+        updates: DataFrame indexed by instrument (or with an instrument column), or a list
+                 of dicts, holding any of the quote columns (bid, ask, iv_bid, iv_ask, mark, ...).
+                 Unknown instruments are added to the chain.
+        drift_ratio: a side is recalibrated (starting from its current params) when its
+                     squared error per quote on the new quotes is above drift_ratio * the
+                     one of its last fit (per quote, a side gaining instruments doesn't drift)
+        method: scipy method of those recalibrations
+
+        Only the touched rows go through the liquidity filter, the others keep their
+        decision, and only their strikes' put-call parity forwards are recomputed. The
+        density is recomputed lazily by density().
+        Returns a dict with the new forward and the recalibrated sides.
+        """
+        if not isinstance(updates, pd.DataFrame):
+            updates = pd.DataFrame(list(updates))
+        if "instrument" in updates.columns:
+            updates = updates.set_index("instrument")
+        updates = updates.astype(np.float64)
+
+        results = getattr(self, "calibration_results", {})
+        # the quotes each side was fitted on, before the update moves them
+        for _, attribute, _, v in self._quote_sides():
+            if attribute in results:
+                results[attribute].setdefault("n_quotes", int(np.count_nonzero(np.isfinite(v))))
+
+        df = self.filterfree_df
+        liquid = df.index.isin(self.df.index)
+        new = updates.index.difference(df.index)
+        if len(new):
+            parts = loader.parse_instruments(new.to_numpy())
+            parts.index = new
+            df = pd.concat([df, parts])
+            liquid = np.concatenate([liquid, np.zeros(len(new), dtype=bool)])
+        if not {"vol_mid", "mark_mid", "vol_bid_ask_spread"}.issubset(df.columns):
+            df["vol_mid"] = (df["iv_bid"]+df["iv_ask"])/2
+            df["mark_mid"] = (df["bid"]+df["ask"])/2
+            df["vol_bid_ask_spread"] = df["iv_ask"]-df["iv_bid"]
+        # columns are patched as arrays, much cheaper than .loc assignments on a mixed frame
+        position = df.index.get_indexer(updates.index)
+        columns = {column: df[column].to_numpy(dtype=np.float64, copy=True)
+                   for column in set(updates.columns) | {"iv_bid", "iv_ask", "bid", "ask", "vol_mid",
+                                                         "mark_mid", "vol_bid_ask_spread"}}
+        for column in updates.columns:
+            columns[column][position] = updates[column].to_numpy()
+        columns["vol_mid"][position] = (columns["iv_bid"][position] + columns["iv_ask"][position])/2
+        columns["mark_mid"][position] = (columns["bid"][position] + columns["ask"][position])/2
+        columns["vol_bid_ask_spread"][position] = columns["iv_ask"][position] - columns["iv_bid"][position]
+        for column, values in columns.items():
+            df[column] = values
+        liquid[position] = columns["vol_bid_ask_spread"][position] < self.min_vol_ba_spread
+        self.filterfree_df = df
+        self._split_chain(df[liquid])
+
+        # put-call parity forwards of the touched strikes only
+        strikes = df.loc[updates.index, "strike"].unique()
+        aggregation, trim = getattr(self, "forward_aggregation", ("mean", 0.1))
+        if getattr(self, "pcp_forwards", None) is None:
+            self.pcp_forwards = self.implied_forwards()
+        else:
+            touched = self.implied_forwards(df[df["strike"].isin(strikes)])
+            self.pcp_forwards = pd.concat([self.pcp_forwards.drop(strikes, errors="ignore"),
+                                           touched]).sort_index()
+        self.atm = aggregate_forwards(self.pcp_forwards, aggregation, trim)
+
+        # refit only the sides whose error drifted
+        recalibrated = []
+        for label, attribute, k, v in self._quote_sides():
+            if getattr(self, attribute, None) is None and attribute not in getattr(self, "smile_models", {}):
+                continue
+            model = self.side_model(attribute)
+            n_quotes = int(np.count_nonzero(np.isfinite(v)))
+            error = model.error(k, v)/max(n_quotes, 1)
+            fitted = results.get(attribute, {})
+            fitted_error = fitted["mse"]/max(fitted["n_quotes"], 1) if "mse" in fitted else error
+            if error > drift_ratio*max(fitted_error, 1e-12):
+                model.refit(k, v, method=method)
+                if not self._arbitrage_reports({attribute: model})[attribute].arbitrage_free:
+                    # the warm refit drifted into an arbitrage, the side is fitted from scratch
+                    metrics.count("arbitrage_refit")
+                    refit = model.params, model.mse
+                    model.calibrate(k, v, method=method, seed=self.job_seed())
+                    if (not self._arbitrage_reports({attribute: model})[attribute].arbitrage_free
+                            and refit[1] < model.mse):
+                        model.params, model.mse = refit
+                if model.name == "sabr":
+                    setattr(self, attribute, model.params)
+                recalibrated.append(attribute)
+                results[attribute] = {"params": model.params, "mse": float(model.mse), "nfev": int(model.nfev),
+                                      "n_quotes": n_quotes, "source": "drift"}
+                metrics.emit("calibration", level=logging.INFO, underlying=self.underlying,
+                             expiry=self.exp.date(), side=label, mse=round(float(model.mse), 8),
+                             nfev=int(model.nfev), source="drift")
+        self.calibration_results = results
+        if recalibrated:
+            self._record_arbitrage(self._arbitrage_reports({attribute: self.side_model(attribute)
+                                                            for attribute in recalibrated}))
+
+        self._densities = {}
+        return {"atm": self.atm, "recalibrated": recalibrated}
+
+    def density(self, side="mid", bins=200, method="analytic"):
+        """
+        implied_pdf on its default grid, repaired (see implied_pdf), cached until the
+        quotes or the fits change
+        """
+        densities = getattr(self, "_densities", None)
+        if densities is None:
+            densities = self._densities = {}
+        key = (side, bins, method)
+        if key not in densities:
+            densities[key] = self.implied_pdf(side=side, bins=bins, method=method, repair=True)
+        return densities[key]
+
+    def plot_bid_ask_SABR_calls(self):
+        _plotting().plot_bid_ask_SABR_calls(self)
 
     def plot_bid_ask_SABR_puts(self):
-        plt.figure(figsize=(12, 8))
-        k = np.array(self.puts["strike"])
-        v = np.array(self.puts["iv_ask"])/100
-        x, y = np.linspace(k[0]-5000, k[-1]+5000, 1000), []
-
-        # asks
-        alpha, beta, rho, nu = self.SABR_put_params_asks
-        for i in x:
-            y.append(sabr.strike_volatility_SABR(k=i,
-                                                 f=self.atm,
-                                                 alpha=alpha,
-                                                 beta=beta,
-                                                 nu=nu,
-                                                 rho=rho,
-                                                 t=self.ttm))
-
-        plt.plot(x, 100*np.array(y), label="Ask SABR Calibration")
-        plt.scatter(k, 100*v, marker="+", color="c", label="Asks IV")
-        plt.title(
-            "Calibration of SABR to BTC put options' implied volatility bid and asks", fontweight="bold")
-        plt.xlabel("Strike (in USD)")
-        plt.grid(alpha=0.3)
-        plt.ylabel("Implied vol (in %)")
-
-        # bids
-        alpha, beta, rho, nu = self.SABR_put_params_bids
-        y = []
-        v = np.array(self.puts["iv_bid"])/100
-        for i in x:
-            y.append(sabr.strike_volatility_SABR(k=i,
-                                                 f=self.atm,
-                                                 alpha=alpha,
-                                                 beta=beta,
-                                                 nu=nu,
-                                                 rho=rho,
-                                                 t=self.ttm))
-        plt.plot(x, 100*np.array(y), label="Bid SABR Calibration")
-        plt.scatter(k, 100*v, marker="+", color="orange", label="Bids IV")
-
-        plt.axvline(self.atm, linestyle="--", linewidth=0.5,
-                    label="Forward price", color="0")
-        plt.legend()
-        plt.show()
+        _plotting().plot_bid_ask_SABR_puts(self)
 
     def plot_pcp(self):
+        _plotting().plot_pcp(self)
 
-        # calibrate data first
-
-        # option 1: Synthetic long (sell put buy calls)
-
-        plt.figure(figsize=(12, 8))
-
-        alpha, beta, rho, nu = self.SABR_put_params_bids
-        k_p = np.array(self.puts["strike"])
-        k_c = np.array(self.calls["strike"])
-        x, y = np.linspace(k_p[0]-5000, k_c[-1]+5000, 1000), []
-        v = np.array(self.puts["iv_bid"])/100
-        for i in x:
-            y.append(sabr.strike_volatility_SABR(k=i,
-                                                 f=self.atm,
-                                                 alpha=alpha,
-                                                 beta=beta,
-                                                 nu=nu,
-                                                 rho=rho,
-                                                 t=self.ttm))
-        plt.plot(x, 100*np.array(y), label="SABR Bid Calibration", color="blue")
-        plt.scatter(k_p, 100*v, marker="+", color="blue", label="Put Bids IV")
-
-        # calls
-
-        alpha, beta, rho, nu = self.SABR_call_params_asks
-        y = []
-        k = np.array(self.calls["strike"])
-        v = np.array(self.calls["iv_ask"])/100
-        for i in x:
-            y.append(sabr.strike_volatility_SABR(k=i,
-                                                 f=self.atm,
-                                                 alpha=alpha,
-                                                 beta=beta,
-                                                 nu=nu,
-                                                 rho=rho,
-                                                 t=self.ttm))
-        plt.plot(x, 100*np.array(y),
-                 label="SABR call Ask Calibration", color="orange")
-        plt.scatter(k, 100*v, marker="+", color="orange", label="Bids IV")
-        plt.legend()
-        plt.show()
-
-    def plot_pdf_cdf(self, bins=200):
-
-        bins = bins+1  # bins is no of butterflies
-        grid = np.linspace(start=np.min(self.df["strike"]),
+    def smile(self, k, params):
+        """
+        SABR vol (decimal) at strike(s) k for params [alpha, beta, rho, nu]
+        """
+        alpha, beta, rho, nu = params
+        return sabr.strike_volatility_SABR(k=k,
+                                           f=self.atm,
+                                           alpha=alpha,
+                                           beta=beta,
+                                           nu=nu,
+                                           rho=rho,
+                                           t=self.ttm)
+
+    def pdf_grid(self, bins=200):
+        # bins+1 strikes from the lowest liquid strike to the highest + 40000
+        return np.linspace(start=np.min(self.df["strike"]),
                            stop=np.max(self.df["strike"]) + 40000,
-                           num=bins)  # create a grid in all options that are liquid enough
-        pdf = []
-
-        payoff = grid[1] - grid[0]  # gonna be the same for ea bfly
-        for i in range(len(grid[:-2])):
-
-            alpha, beta, rho, nu = self.SABR_call_params_asks
-
-            option_1_iv_b = sabr.strike_volatility_SABR(k=grid[i],
-                                                        f=self.atm,
-                                                        alpha=alpha,
-                                                        beta=beta,
-                                                        nu=nu,
-                                                        rho=rho,
-                                                        t=self.ttm)  # long so hit ask
-            option_2_iv_b = sabr.strike_volatility_SABR(k=grid[i+1],
-                                                        f=self.atm,
-                                                        alpha=alpha,
-                                                        beta=beta,
-                                                        nu=nu,
-                                                        rho=rho,
-                                                        t=self.ttm)  # long so hit ask
-            option_3_iv_b = sabr.strike_volatility_SABR(k=grid[i+2],
-                                                        f=self.atm,
-                                                        alpha=alpha,
-                                                        beta=beta,
-                                                        nu=nu,
-                                                        rho=rho,
-                                                        t=self.ttm)  # long so hit ask
-            # asks
-
-            alpha, beta, rho, nu = self.SABR_call_params_bids
-
-            option_1_iv_a = sabr.strike_volatility_SABR(k=grid[i],
-                                                        f=self.atm,
-                                                        alpha=alpha,
-                                                        beta=beta,
-                                                        nu=nu,
-                                                        rho=rho,
-                                                        t=self.ttm)  # long so hit ask
-            option_2_iv_a = sabr.strike_volatility_SABR(k=grid[i+1],
-                                                        f=self.atm,
-                                                        alpha=alpha,
-                                                        beta=beta,
-                                                        nu=nu,
-                                                        rho=rho,
-                                                        t=self.ttm)  # long so hit ask
-            option_3_iv_a = sabr.strike_volatility_SABR(k=grid[i+2],
-                                                        f=self.atm,
-                                                        alpha=alpha,
-                                                        beta=beta,
-                                                        nu=nu,
-                                                        rho=rho,
-                                                        t=self.ttm)  # long so hit ask
-
-            option_1_iv = (option_1_iv_a+option_1_iv_b)/2
-            option_2_iv = (option_2_iv_a+option_2_iv_b)/2
-            option_3_iv = (option_3_iv_a+option_3_iv_b)/2
-
-            option_1_price = sabr.get_gk_price(w=1,
-                                               forward=self.atm,
-                                               term_rate=0,
-                                               base_rate=0,
-                                               ttm=self.ttm,
-                                               vol=option_1_iv,
-                                               strike=grid[i])
-
-            option_3_price = sabr.get_gk_price(w=1,
-                                               forward=self.atm,
-                                               term_rate=0,
-                                               base_rate=0,
-                                               ttm=self.ttm,
-                                               vol=option_3_iv,
-                                               strike=grid[i+2])
-
-            option_2_price = sabr.get_gk_price(w=1,
-                                               forward=self.atm,
-                                               term_rate=0,
-                                               base_rate=0,
-                                               ttm=self.ttm,
-                                               vol=option_2_iv,
-                                               strike=grid[i+1])
-
-            # print(f"2. {option_2_iv}")
-            pdf.append(-option_1_price + 2*option_2_price - option_3_price)
-
-            # both premium and payoff expressed in $
-        cdf = np.cumsum(-np.array(pdf) / payoff)
-
-        fig = make_subplots(rows=1, cols=2, subplot_titles=("PDF", "CDF"))
-
-        # Add PDF plot
-        fig.add_trace(go.Scatter(
-            x=grid[:-2], y=100 * -np.array(pdf) / payoff, mode='lines', name='PDF'), row=1, col=1)
-
-        # Add CDF plot
-        fig.add_trace(go.Scatter(
-            x=grid[:-2], y=100 * cdf, mode='lines', name='CDF'), row=1, col=2)
-
-        # Update layout
-        fig.update_layout(
-            title=f"Implied PDF and CDF of {self.underlying} options expiring {self.exp.strftime('%A, %B %d, %Y')}",
-            xaxis_title="Strike (in $)",
-            yaxis_title="Probability (in %)",
-            plot_bgcolor='rgba(0,0,0,0)',  # Transparent background
-            height=600,
-            width=1000,
-            showlegend=True
-        )
-
-        # Add grids to both subplots
-        fig.update_xaxes(showgrid=True, gridwidth=1,
-                         gridcolor='rgba(0,0,0,0.1)', row=1, col=1)
-        fig.update_yaxes(showgrid=True, gridwidth=1,
-                         gridcolor='rgba(0,0,0,0.1)', row=1, col=1)
-        fig.update_xaxes(showgrid=True, gridwidth=1,
-                         gridcolor='rgba(0,0,0,0.1)', row=1, col=2)
-        fig.update_yaxes(showgrid=True, gridwidth=1,
-                         gridcolor='rgba(0,0,0,0.1)', row=1, col=2)
-
-        # Add a horizontal line at y=0 in each subplot
-        fig.add_shape(type="line", x0=grid[:-2].min(), y0=0, x1=grid[:-2].max(), y1=0, line=dict(color="black", width=1),
-                      row=1, col=1)
-        fig.add_shape(type="line", x0=grid[:-2].min(), y0=0, x1=grid[:-2].max(), y1=0, line=dict(color="black", width=1),
-                      row=1, col=2)
-
-        # Show the plot
-        fig.show()
+                           num=bins+1)
+
+    def adaptive_grid(self, n=101, lower=None, upper=None, concentration=None):
+        """
+        Non uniform strike grid, dense around the forward self.atm and sparse in the tails
+
+        lower / upper: grid bounds, default to the pdf_grid range
+        concentration: width (in log-moneyness) of the dense region, defaults to the
+                       ATM total volatility of the mid call smile
+        """
+        lower = np.min(self.df["strike"]) if lower is None else lower
+        upper = np.max(self.df["strike"]) + 40000 if upper is None else upper
+        if concentration is None:
+            atm_vol = (self.side_model("SABR_call_params_asks").vol(self.atm) +
+                       self.side_model("SABR_call_params_bids").vol(self.atm))/2
+            concentration = abs(atm_vol)*np.sqrt(abs(self.ttm))
+        return sinh_grid(self.atm, lower, upper, concentration, n)
+
+    def _call_smile(self, grid, side, derivatives=False):
+        # vol of the mid / bid / ask call smile, with its strike derivatives if asked
+        if side == "mid":
+            smiles = [self.side_model("SABR_call_params_asks"), self.side_model("SABR_call_params_bids")]
+        elif side == "bid":
+            smiles = [self.side_model("SABR_call_params_bids")]
+        elif side == "ask":
+            smiles = [self.side_model("SABR_call_params_asks")]
+        else:
+            raise ValueError("side should be 'mid', 'bid' or 'ask'")
+
+        if not derivatives:
+            return sum(model.vol(grid) for model in smiles)/len(smiles)
+
+        vol = dvol_dk = d2vol_dk2 = 0
+        for model in smiles:
+            v, v1, v2 = model.vol_derivatives(grid)
+            vol, dvol_dk, d2vol_dk2 = vol + v, dvol_dk + v1, d2vol_dk2 + v2
+        return vol/len(smiles), dvol_dk/len(smiles), d2vol_dk2/len(smiles)
+
+    @timed("implied_pdf", context=_chain_context)
+    def implied_pdf(self, grid=None, side="mid", bins=200, method="butterfly", repair=False):
+        """
+        Implied density of the underlying at expiry from the calibrated call smiles
+
+        grid: strikes (sorted, can be non uniform)
+        side: "mid" averages the bid and ask call smiles, "bid" / "ask" uses one of them
+        method: "butterfly" prices call butterflies on the grid (defaults to pdf_grid(bins)),
+                "analytic" is d2C/dK2 in closed form (Breeden-Litzenberger) on the grid
+                points themselves (defaults to adaptive_grid(bins+1))
+
+        repair: the negative density is clipped and the rest rescaled so that the grid holds
+                the smile's mass between its first and last strike, the cdf then starts at the
+                mass below the grid (see density_checks). The check is kept in density_report
+
+        Returns (strikes, pdf, cdf): pdf is a probability per unit of strike. For
+        butterflies the strikes are the butterfly centres grid[1:-1]
+        """
+        if method == "analytic":
+            grid = self.adaptive_grid(bins+1) if grid is None else np.asarray(grid, dtype=float)
+            vol, dvol_dk, d2vol_dk2 = self._call_smile(grid, side, derivatives=True)
+            pdf, cdf = sabr.breeden_litzenberger(forward=self.atm,
+                                                 ttm=self.ttm,
+                                                 strike=grid,
+                                                 vol=vol,
+                                                 dvol_dk=dvol_dk,
+                                                 d2vol_dk2=d2vol_dk2)
+            return self._repair_density(grid, pdf, side) if repair else (grid, pdf, cdf)
+
+        if method != "butterfly":
+            raise ValueError("method should be 'butterfly' or 'analytic'")
+
+        grid = self.pdf_grid(bins) if grid is None else np.asarray(grid, dtype=float)
+        vol = self._call_smile(grid, side)
+
+        # every strike priced once, the butterflies are differences of neighbours
+        prices = sabr.get_gk_price(w=1,
+                                   forward=self.atm,
+                                   term_rate=0,
+                                   base_rate=0,
+                                   ttm=self.ttm,
+                                   vol=vol,
+                                   strike=grid)
+        h_left = np.diff(grid)[:-1]
+        h_right = np.diff(grid)[1:]
+        pdf = 2*(prices[:-2]/(h_left*(h_left+h_right)) - prices[1:-1]/(h_left*h_right) +
+                 prices[2:]/(h_right*(h_left+h_right)))
+        # a butterfly covers half of each wing
+        cdf = np.cumsum(pdf*(h_left+h_right)/2)
+        return self._repair_density(grid[1:-1], pdf, side) if repair else (grid[1:-1], pdf, cdf)
+
+    def _repair_density(self, strikes, pdf, side):
+        # the mass beyond the grid is the smile's own cdf at its ends
+        vol, dvol_dk, d2vol_dk2 = self._call_smile(strikes[[0, -1]], side, derivatives=True)
+        _, edge_cdf = sabr.breeden_litzenberger(forward=self.atm, ttm=self.ttm, strike=strikes[[0, -1]],
+                                                vol=vol, dvol_dk=dvol_dk, d2vol_dk2=d2vol_dk2)
+        report = checks.check_density(strikes, pdf, edge_cdf[0], edge_cdf[1])
+        self.density_report = checks.DensityReport._make(np.asarray(field).item() for field in report)
+        metrics.emit("density", level=logging.DEBUG if report.arbitrage_free else logging.WARNING,
+                     underlying=self.underlying, expiry=self.exp.date(), side=side,
+                     **self.density_report._asdict())
+        pdf, cdf = checks.repair_density(strikes, pdf, report.lower_tail, report.upper_tail)
+        return strikes, pdf, cdf
+
+    @timed("density_bands", context=_chain_context)
+    def density_bands(self, grid=None, bins=200, n_bootstrap=200, confidence=0.9, seed=None,
+                      number_of_tries=2, steps_per_round=25):
+        """
+        Uncertainty of the implied density coming from the bid-ask spread, two bands:
+
+        bid_ask: lowest / highest density of the four side fits (call / put bids and asks)
+        bootstrap: n_bootstrap call smiles, each fitted to vols drawn uniformly between the
+                   bid and ask vol of every strike, and its central confidence interval.
+                   All the draws are calibrated together (SABR_engine batch warm started
+                   from the call fits, without the scipy polish) and differentiated in one
+                   array call. The draws whose batched fit has not converged are polished
+                   one by one before the quantiles are taken, an unconverged fit stays
+                   near its start and would narrow the band
+
+        grid: strikes, defaults to adaptive_grid(bins+1)
+        seed: of the draws and the restarts, defaults to job_seed()
+
+        Returns DensityBands, pdf / cdf are the mid density. Every density is repaired
+        (see implied_pdf), so the cdf bands give the error bars of tail probabilities
+        """
+        grid = self.adaptive_grid(bins+1) if grid is None else np.asarray(grid, dtype=float)
+        bounds = [(1 - confidence)/2, (1 + confidence)/2]
+
+        def repaired(vol, dvol_dk, d2vol_dk2):
+            pdf, cdf = sabr.breeden_litzenberger(forward=self.atm, ttm=self.ttm, strike=grid,
+                                                 vol=vol, dvol_dk=dvol_dk, d2vol_dk2=d2vol_dk2)
+            return checks.repair_density(grid, pdf, cdf[..., 0], 1 - cdf[..., -1])
+
+        _, pdf, cdf = self.implied_pdf(grid=grid, method="analytic", repair=True)
+
+        sides = [self.side_model(attribute).vol_derivatives(grid) for attribute in SABR_PARAM_ATTRIBUTES
+                 if getattr(self, attribute, None) is not None or attribute in getattr(self, "smile_models", {})]
+        side_pdf, side_cdf = repaired(*(np.array(x) for x in zip(*sides)))
+
+        # vols drawn between bid and ask, a one sided quote is kept as it is
+        rng = np.random.default_rng(self.job_seed() if seed is None else seed)
+        strikes = self.calls["strike"].to_numpy()
+        bid = self.calls["iv_bid"].to_numpy()/100
+        ask = self.calls["iv_ask"].to_numpy()/100
+        low, high = np.fmin(bid, ask), np.fmax(bid, ask)
+        draws = low + rng.uniform(size=(n_bootstrap, len(strikes)))*(high - low)
+        metrics.count("bootstrap_samples", n_bootstrap)
+
+        starts = [getattr(self, attribute) for attribute in ["SABR_call_params_asks", "SABR_call_params_bids"]
+                  if getattr(self, attribute, None) is not None]
+        results = engine.calibrate_SABR_batch(strike_sets=[strikes]*n_bootstrap,
+                                              vol_sets=draws,
+                                              forward=self.atm,
+                                              TTM=self.ttm,
+                                              number_of_tries=number_of_tries,
+                                              init_values=np.mean(starts, axis=0) if starts else None,
+                                              n_polish=1,
+                                              steps_per_round=steps_per_round,
+                                              seed=rng,
+                                              polish=False)
+        for draw, result in zip(draws, results):
+            if result["converged"]:
+                continue
+            metrics.count("bootstrap_unconverged")
+            quoted = ~np.isnan(draw)
+            params, mse = s.calibrate_SABR(strikes=strikes[quoted], volatilities=draw[quoted],
+                                           forward=self.atm, TTM=self.ttm, method="L-BFGS-B",
+                                           init_param=result["params"])
+            if mse < result["mse"]:
+                result["params"] = params
+        alpha, beta, rho, nu = np.array([result["params"] for result in results]).T[..., None]
+        bootstrap_pdf, bootstrap_cdf = repaired(*sabr.strike_volatility_SABR_strike_derivatives(
+            k=grid, f=self.atm, alpha=alpha, beta=beta, nu=nu, rho=rho, t=self.ttm))
+
+        return DensityBands(strikes=grid, pdf=pdf, cdf=cdf,
+                            bid_ask_pdf=np.stack([side_pdf.min(axis=0), side_pdf.max(axis=0)]),
+                            bid_ask_cdf=np.stack([side_cdf.min(axis=0), side_cdf.max(axis=0)]),
+                            bootstrap_pdf=np.quantile(bootstrap_pdf, bounds, axis=0),
+                            bootstrap_cdf=np.quantile(bootstrap_cdf, bounds, axis=0))
+
+    def plot_pdf_cdf(self, bins=200, method="butterfly"):
+        _plotting().plot_pdf_cdf(self, bins=bins, method=method)
@@ -0,0 +1,236 @@
+"""
+Smile models behind one vectorised interface, so option_prices can fit and
+evaluate a quote side without knowing which model it is:
+
+    model = SVIModel(forward=a.atm, ttm=a.ttm).calibrate(strikes, vols)
+    model.vol(k)                        # decimal vols, any shape of strikes
+    model.vol_derivatives(k)            # vol, dvol/dk, d2vol/dk2
+    pdf, cdf = model.density(k)         # Breeden-Litzenberger
+
+SABRModel is the Hagan SABR of SABR_functions (multi-start, see SABR_engine).
+SVIModel is raw SVI on the total variance w(y) = a + b*(rho*(y - m) + sqrt((y - m)^2 + sigma^2)),
+y = log(K/F), fitted with the quasi-explicit reduction of Zeliade (2009): for a
+given (m, sigma) the best (a, b*rho*sigma, b*sigma) is a 3x3 linear least squares,
+so only (m, sigma) are searched. That fit is deterministic and doesn't need restarts.
+"""
+import abc
+import time
+import numpy as np
+import SABR_calibration as s
+import SABR_engine as engine
+import SABR_functions as sabr
+import smile_table
+from instrumentation import metrics
+
+
+class SmileModel(abc.ABC):
+    name = None
+
+    def __init__(self, forward, ttm, params=None):
+        self.forward = forward
+        self.ttm = ttm
+        self.params = params
+        self.mse = None
+        self.nfev = 0
+        self.seconds = None
+
+    def __repr__(self):
+        return f"{type(self).__name__}(forward={self.forward}, ttm={self.ttm}, params={self.params})"
+
+    @abc.abstractmethod
+    def vol(self, k):
+        """
+        Vol (decimal) at strike(s) k
+        """
+
+    @abc.abstractmethod
+    def vol_derivatives(self, k):
+        """
+        (vol, dvol/dk, d2vol/dk2) at strike(s) k
+        """
+
+    @abc.abstractmethod
+    def calibrate(self, strikes, vols, **kwargs):
+        """
+        Fits the model to the vols (decimal) quoted at strikes, returns the model
+        """
+
+    def refit(self, strikes, vols, **kwargs):
+        # recalibration after a quote update, models with a cheap warm start override it
+        return self.calibrate(strikes, vols, **kwargs)
+
+    def error(self, strikes, vols):
+        # sum of squared vol errors, the "mse" of calibrate_SABR
+        return float(np.nansum((np.asarray(vols) - self.vol(np.asarray(strikes, dtype=float)))**2))
+
+    def density(self, k):
+        """
+        Risk neutral (pdf, cdf) at strike(s) k, see SABR_functions.breeden_litzenberger
+        """
+        k = np.asarray(k, dtype=float)
+        vol, dvol_dk, d2vol_dk2 = self.vol_derivatives(k)
+        return sabr.breeden_litzenberger(forward=self.forward, ttm=self.ttm, strike=k,
+                                         vol=vol, dvol_dk=dvol_dk, d2vol_dk2=d2vol_dk2)
+
+
+class SABRModel(SmileModel):
+    name = "sabr"
+
+    def vol(self, k):
+        alpha, beta, rho, nu = self.params
+        return sabr.strike_volatility_SABR(k=k, f=self.forward, alpha=alpha, beta=beta,
+                                           nu=nu, rho=rho, t=self.ttm)
+
+    def vol_derivatives(self, k):
+        alpha, beta, rho, nu = self.params
+        return sabr.strike_volatility_SABR_strike_derivatives(k=k, f=self.forward, alpha=alpha, beta=beta,
+                                                              nu=nu, rho=rho, t=self.ttm)
+
+    def table(self, **kwargs):
+        """
+        Cached lookup table of the smile (see smile_table), for evaluating it many times
+        """
+        alpha, beta, rho, nu = self.params
+        return smile_table.sabr_table(alpha, beta, rho, nu, f=self.forward, t=self.ttm, **kwargs)
+
+    def calibrate(self, strikes, vols, method="L-BFGS-B", number_of_tries=10, init_values=None,
+                  n_polish=2, seed=None, max_evals=None, max_time=None):
+        """
+        Multi-start fit of one quote side, see SABR_engine.calibrate_SABR_batch
+        """
+        start = time.perf_counter()
+        result = engine.calibrate_SABR_batch(strike_sets=[strikes], vol_sets=[vols], forward=self.forward,
+                                             TTM=self.ttm, method=method, number_of_tries=number_of_tries,
+                                             init_values=init_values, n_polish=n_polish, seed=seed,
+                                             max_evals=max_evals, max_time=max_time)[0]
+        self.params, self.mse, self.nfev = result["params"], result["mse"], result["nfev"]
+        self.seconds = time.perf_counter() - start
+        return self
+
+    def refit(self, strikes, vols, method="L-BFGS-B", **kwargs):
+        # one scipy fit from the current params
+        start = time.perf_counter()
+        params, mse, result = s.calibrate_SABR(strikes=strikes, volatilities=vols, forward=self.forward,
+                                               TTM=self.ttm, method=method, init_param=self.params,
+                                               full_output=True)
+        self.params, self.mse, self.nfev = params, float(mse), int(result.nfev)
+        self.seconds = time.perf_counter() - start
+        return self
+
+
+def _svi_inner(y, w, weights, m, sigma):
+    """
+    Quasi-explicit step: best (a, d, c) of w = a + d*u + c*sqrt(u^2 + 1), u = (y - m)/sigma,
+    for every (m, sigma) candidate at once, inside the domain keeping SVI arbitrage-sane
+    (0 <= c <= 4 sigma, |d| <= c, |d| <= 4 sigma - c, 0 <= a <= max w)
+
+    y, w, weights: (strikes,), m, sigma: (candidates,). Returns a, d, c and the weighted
+    squared error in total variance, each (candidates,)
+    """
+    u = (y[None, :] - m[:, None])/sigma[:, None]
+    z = np.sqrt(u**2 + 1)
+    total = np.sum(weights)
+
+    def refit_a(d, c):
+        # a is the weighted mean of what d and c leave, kept in [0, max w]
+        residual = w[None, :] - d[:, None]*u - c[:, None]*z
+        a = np.clip(residual @ weights/total, 0, np.max(w))
+        return a, np.sum(weights*(residual - a[:, None])**2, axis=-1)
+
+    # unconstrained 3x3 least squares, kept where it lands inside the domain
+    design = np.stack([np.ones_like(u), u, z], axis=-1)
+    normal = np.einsum("j,nja,njb->nab", weights, design, design)
+    rhs = np.einsum("j,nja,j->na", weights, design, w)
+    # a relative ridge keeps the degenerate candidates (huge sigma, z ~ 1) solvable
+    normal += 1e-10*np.trace(normal, axis1=1, axis2=2)[:, None, None]*np.eye(3)
+    _, d, c = np.moveaxis(np.linalg.solve(normal, rhs[..., None])[..., 0], -1, 0)
+    inside = (c >= 0) & (np.abs(d) <= c) & (np.abs(d) <= 4*sigma - c)
+    a, error = refit_a(d, c)
+    error = np.where(inside, error, np.inf)
+
+    # otherwise the optimum is on an edge d = slope*c + offset*sigma of the domain,
+    # where the problem is a 2 parameter least squares in (a, c)
+    for slope, offset, low, high in [(1, 0, 0, 2), (-1, 0, 0, 2), (-1, 4, 2, 4), (1, -4, 2, 4)]:
+        x = slope*u + z
+        target = w[None, :] - offset*sigma[:, None]*u
+        x_mean = x @ weights/total
+        target_mean = target @ weights/total
+        covariance = ((x - x_mean[:, None])*(target - target_mean[:, None])) @ weights
+        variance = ((x - x_mean[:, None])**2) @ weights
+        edge_c = np.clip(covariance/np.maximum(variance, 1e-300), low*sigma, high*sigma)
+        edge_d = slope*edge_c + offset*sigma
+        edge_a, edge_error = refit_a(edge_d, edge_c)
+        better = edge_error < error
+        a, d, c = np.where(better, edge_a, a), np.where(better, edge_d, d), np.where(better, edge_c, c)
+        error = np.where(better, edge_error, error)
+    return a, d, c, error
+
+
+class SVIModel(SmileModel):
+    name = "svi"
+
+    def total_variance(self, k):
+        """
+        w(y), dw/dy and d2w/dy2 at y = log(k/forward)
+        """
+        a, b, rho, m, sigma = self.params
+        y = np.log(np.asarray(k, dtype=float)/self.forward) - m
+        root = np.sqrt(y**2 + sigma**2)
+        return a + b*(rho*y + root), b*(rho + y/root), b*sigma**2/root**3
+
+    def vol(self, k):
+        w = self.total_variance(k)[0]
+        return np.sqrt(np.maximum(w, 0)/self.ttm)
+
+    def vol_derivatives(self, k):
+        k = np.asarray(k, dtype=float)
+        w, w1, w2 = self.total_variance(k)
+        vol = np.sqrt(np.maximum(w, 0)/self.ttm)
+        # in y = log(k/F) first, then chained to the strike
+        vol_y = w1/(2*self.ttm*vol)
+        vol_yy = (w2/(2*self.ttm) - vol_y**2)/vol
+        return vol, vol_y/k, (vol_yy - vol_y)/k**2
+
+    def calibrate(self, strikes, vols, grid_size=9, rounds=6, **kwargs):
+        """
+        Quasi-explicit fit: the linear inner step is vectorised over a grid_size x grid_size
+        grid of (m, log sigma), the grid is then shrunk around its best point rounds times.
+        Other keyword arguments (SABR options) are ignored.
+        """
+        start = time.perf_counter()
+        strikes = np.asarray(strikes, dtype=float)
+        vols = np.asarray(vols, dtype=float)
+        valid = np.isfinite(strikes) & np.isfinite(vols)
+        if np.sum(valid) < 5:
+            raise ValueError("SVI needs at least 5 quotes")
+        y = np.log(strikes[valid]/self.forward)
+        w = vols[valid]**2*self.ttm
+        weights = np.ones_like(y)
+
+        span = max(np.ptp(y), 1e-3)
+        m_center, m_width = (y.min() + y.max())/2, span
+        log_sigma_center, log_sigma_width = np.log(span)/2 + np.log(1e-3*span)/2, -np.log(1e-3)
+        steps = np.linspace(-0.5, 0.5, grid_size)
+        self.nfev = 0
+        for _ in range(rounds + 1):
+            m, log_sigma = np.meshgrid(m_center + m_width*steps, log_sigma_center + log_sigma_width*steps)
+            m, sigma = m.ravel(), np.exp(log_sigma.ravel())
+            errors = _svi_inner(y, w, weights, m, sigma)[3]
+            best = np.argmin(errors)
+            self.nfev += len(m)
+            # the next grid spans 4 cells of this one around its best point
+            m_center, log_sigma_center = m[best], np.log(sigma[best])
+            m_width *= 4/(grid_size - 1)
+            log_sigma_width *= 4/(grid_size - 1)
+
+        a, d, c, _ = _svi_inner(y, w, weights, m[best:best+1], sigma[best:best+1])
+        b = c[0]/sigma[best]
+        rho = d[0]/c[0] if c[0] > 0 else 0.0
+        self.params = [float(a[0]), float(b), float(rho), float(m[best]), float(sigma[best])]
+        self.mse = self.error(strikes[valid], vols[valid])
+        self.seconds = time.perf_counter() - start
+        metrics.count("objective", self.nfev)
+        return self
+
+
+MODELS = {"sabr": SABRModel, "svi": SVIModel}
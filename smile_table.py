@@ -0,0 +1,93 @@
+"""
+Lookup tables of calibrated SABR smiles, for evaluating the same smile many times
+(scenario runs, Greeks ladders, ...):
+
+    table = sabr_table(alpha, beta, rho, nu, f=a.atm, t=a.ttm)   # built once, then cached
+    table(strikes)                                               # any shape of strikes
+
+The smile is tabulated on a uniform log-moneyness grid and interpolated with a cubic
+spline: the cell of a strike is computed directly (no search), so a lookup costs the
+same whatever the table size. The grid is refined until the spline is within tolerance
+of strike_volatility_SABR half way between the nodes (where its error is largest),
+strikes outside the table go through strike_volatility_SABR itself.
+"""
+from collections import OrderedDict
+import numpy as np
+from scipy.interpolate import CubicSpline
+import SABR_functions as sabr
+from instrumentation import metrics
+
+TABLE_CACHE_SIZE = 128
+_tables = OrderedDict()
+
+
+class SABRTable():
+    def __init__(self, alpha, beta, rho, nu, f, t, lower=-3, upper=3, n=257, tolerance=1e-6, max_n=16385):
+        """
+        lower / upper: log-moneyness log(k/f) range of the table
+        n: initial number of nodes, doubled (up to max_n) until the error is below tolerance
+        tolerance: largest absolute vol error (decimal vol) accepted
+        """
+        self.params = tuple(float(x) for x in (alpha, beta, rho, nu))
+        self.f = f
+        self.t = t
+        self.lower = lower
+        self.upper = upper
+        while True:
+            y = np.linspace(lower, upper, n)
+            spline = CubicSpline(y, self._exact(f*np.exp(y)))
+            middle = (y[1:] + y[:-1])/2
+            self.error = float(np.max(np.abs(spline(middle) - self._exact(f*np.exp(middle)))))
+            if self.error <= tolerance or n >= max_n:
+                break
+            n = 2*n - 1  # keeps the current nodes
+        self.step = (upper - lower)/(n - 1)
+        self.coefficients = np.ascontiguousarray(spline.c)  # (4, cells), highest power first
+        metrics.count("table_build")
+
+    def __repr__(self):
+        return (f"SABRTable(params={self.params}, f={self.f}, t={self.t}, "
+                f"nodes={self.coefficients.shape[1] + 1}, error={self.error:.1e})")
+
+    def _exact(self, k):
+        alpha, beta, rho, nu = self.params
+        return sabr.strike_volatility_SABR(k=k, f=self.f, alpha=alpha, beta=beta, nu=nu, rho=rho, t=self.t)
+
+    def __call__(self, k):
+        """
+        SABR vol (decimal) at strike(s) k
+        """
+        shape = np.shape(k)
+        k = np.atleast_1d(np.asarray(k, dtype=float))
+        y = np.log(k/self.f)
+        cell = np.clip(((y - self.lower)/self.step).astype(np.int64), 0, self.coefficients.shape[1] - 1)
+        dy = y - (self.lower + cell*self.step)
+        c3, c2, c1, c0 = (c.take(cell) for c in self.coefficients)
+        vol = ((c3*dy + c2)*dy + c1)*dy + c0
+
+        outside = (y < self.lower) | (y > self.upper)
+        if np.any(outside):
+            vol[outside] = self._exact(k[outside])
+        return vol.reshape(shape)
+
+
+def sabr_table(alpha, beta, rho, nu, f, t, **kwargs):
+    """
+    SABRTable of these parameters, the last TABLE_CACHE_SIZE tables are kept (LRU)
+
+    kwargs: table options (lower, upper, n, tolerance), part of the cache key
+    """
+    key = (float(alpha), float(beta), float(rho), float(nu), float(f), float(t), tuple(sorted(kwargs.items())))
+    table = _tables.get(key)
+    if table is not None:
+        _tables.move_to_end(key)
+        metrics.count("table_hit")
+        return table
+    table = _tables[key] = SABRTable(alpha, beta, rho, nu, f, t, **kwargs)
+    while len(_tables) > TABLE_CACHE_SIZE:
+        _tables.popitem(last=False)
+    return table
+
+
+def clear_tables():
+    _tables.clear()
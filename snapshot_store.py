@@ -0,0 +1,145 @@
+"""
+On-disk store of parsed chains and their fits, one directory per snapshot:
+
+    <root>/<key>/meta.json          underlying, expiry, forward, TTM, valuation time, fits
+    <root>/<key>/<column>.npy       one array per column of filterfree_df
+
+Columns are plain .npy files so they're memory-mapped on load, a backtest over
+thousands of snapshots reads pages on demand instead of parsing CSVs.
+
+    store = SnapshotStore("snapshots")
+    store.save(a, key="BTC-27SEP24-20240401T0800")
+    a = store.load("BTC-27SEP24-20240401T0800")    # no CSV, no calibration
+    chain = store.load_chain("BTC-27SEP24-20240401T0800")   # compact OptionChain, no pandas frame
+"""
+import json
+import os
+from datetime import datetime as dt
+import numpy as np
+import pandas as pd
+from read_prices import option_prices, SABR_PARAM_ATTRIBUTES
+from option_chain import OptionChain
+
+_INDEX_FILE = "_index.npy"
+_LIQUID_FILE = "_liquid.npy"
+
+
+def _column_file(column):
+    return f"{column}.npy"
+
+
+def _valuation_time(meta):
+    # older snapshots don't have it
+    value = meta.get("valuation_time")
+    return None if value is None else dt.fromisoformat(value)
+
+
+class SnapshotStore():
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def keys(self):
+        return sorted(key for key in os.listdir(self.root)
+                      if os.path.isfile(os.path.join(self.root, key, "meta.json")))
+
+    def __contains__(self, key):
+        return os.path.isfile(os.path.join(self.root, key, "meta.json"))
+
+    def save(self, chain, key=None):
+        """
+        Writes an option_prices instance (calibrated or not), returns its key
+
+        key: snapshot id, defaults to underlying-expiry (e.g. BTC-27SEP24)
+        """
+        key = key or f"{chain.underlying}-{chain.exp.strftime('%d%b%y').upper()}"
+        directory = os.path.join(self.root, key)
+        os.makedirs(directory, exist_ok=True)
+
+        df = chain.filterfree_df
+        columns = {}
+        for column in df.columns:
+            values = df[column].to_numpy()
+            if values.dtype == object:
+                values = values.astype(str)  # fixed width unicode, mmap-able
+            np.save(os.path.join(directory, _column_file(column)), values)
+            columns[column] = values.dtype.str
+        np.save(os.path.join(directory, _INDEX_FILE), df.index.to_numpy().astype(str))
+        np.save(os.path.join(directory, _LIQUID_FILE), df.index.isin(chain.df.index))
+
+        meta = {"underlying": chain.underlying,
+                "exp": chain.exp.isoformat(),
+                "atm": float(chain.atm),
+                "ttm": float(chain.ttm),
+                "valuation_time": None if getattr(chain, "valuation_time", None) is None
+                else chain.valuation_time.isoformat(),
+                "min_vol_ba_spread": chain.min_vol_ba_spread,
+                "index_name": df.index.name,
+                "columns": columns,
+                "sabr_params": {attribute: [float(x) for x in getattr(chain, attribute)]
+                                for attribute in SABR_PARAM_ATTRIBUTES
+                                if getattr(chain, attribute, None) is not None},
+                "smile_models": {attribute: [model.name, [float(x) for x in model.params]]
+                                 for attribute, model in getattr(chain, "smile_models", {}).items()}}
+        # meta.json is written last, a snapshot without it is incomplete and ignored
+        with open(os.path.join(directory, "meta.json"), "w") as f:
+            json.dump(meta, f, indent=1)
+        return key
+
+    def load_meta(self, key):
+        with open(os.path.join(self.root, key, "meta.json")) as f:
+            return json.load(f)
+
+    def load_frame(self, key, mmap_mode="r"):
+        """
+        filterfree_df of a snapshot, columns are views on the memory-mapped files
+        (mmap_mode=None reads them in memory instead)
+        """
+        directory = os.path.join(self.root, key)
+        meta = self.load_meta(key)
+        data = {column: np.load(os.path.join(directory, _column_file(column)), mmap_mode=mmap_mode)
+                for column in meta["columns"]}
+        index = pd.Index(np.load(os.path.join(directory, _INDEX_FILE)), name=meta["index_name"])
+        return pd.DataFrame(data, index=index, copy=False)
+
+    def load(self, key, mmap_mode="r"):
+        """
+        option_prices instance of a snapshot, with its forward, TTM and smile fits
+        """
+        meta = self.load_meta(key)
+        liquid = np.load(os.path.join(self.root, key, _LIQUID_FILE))
+        return option_prices.from_snapshot(filterfree_df=self.load_frame(key, mmap_mode=mmap_mode),
+                                           liquid=liquid,
+                                           atm=meta["atm"],
+                                           ttm=meta["ttm"],
+                                           min_vol_ba_spread=meta["min_vol_ba_spread"],
+                                           sabr_params=meta["sabr_params"],
+                                           smile_models=meta.get("smile_models"),
+                                           valuation_time=_valuation_time(meta))
+
+    def load_chain(self, key):
+        """
+        OptionChain (liquid quotes, forward, TTM and fits) of a snapshot, read straight from
+        the column files: only the quote columns are touched and no DataFrame is built
+        """
+        directory = os.path.join(self.root, key)
+        meta = self.load_meta(key)
+        liquid = np.load(os.path.join(directory, _LIQUID_FILE))
+        columns = {column: np.load(os.path.join(directory, _column_file(column)), mmap_mode="r")[liquid]
+                   for column in ["strike", "type", "bid", "ask", "iv_bid", "iv_ask", "vega", "mark"]}
+        fits = {attribute: ("sabr", params) for attribute, params in meta["sabr_params"].items()}
+        fits.update(meta.get("smile_models", {}))
+        return OptionChain(underlying=meta["underlying"],
+                           exp=dt.fromisoformat(meta["exp"]),
+                           atm=meta["atm"],
+                           ttm=meta["ttm"],
+                           strike=columns["strike"],
+                           option_type=columns["type"],
+                           bid=columns["bid"],
+                           ask=columns["ask"],
+                           iv_bid=columns["iv_bid"],
+                           iv_ask=columns["iv_ask"],
+                           vega=columns["vega"],
+                           mark=columns["mark"],
+                           fits=fits,
+                           valuation_time=_valuation_time(meta))
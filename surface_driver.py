@@ -0,0 +1,86 @@
+"""
+Calibrates many expiries / underlyings in parallel:
+
+    chains = calibrate_chains(["BTC-26APR", "BTC-27SEP", "data/ETH-27SEP24-export.csv"],
+                              max_workers=4, timeout=60, method="L-BFGS-B")
+
+Each name is either an instrument name as used by option_prices (matched in the
+working directory) or a path to a Deribit export.
+"""
+import os
+from datetime import datetime as dt
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+import numpy as np
+from read_prices import option_prices
+
+
+def _calibrate_one(name, chain_kwargs, calibration_kwargs):
+    if os.path.isfile(name):
+        chain = option_prices(path=name, **chain_kwargs)
+    else:
+        chain = option_prices(name=name, **chain_kwargs)
+    # each job gets its own random stream, set by the base seed and its own snapshot only,
+    # so a fit doesn't depend on the other names, the chunking or the worker it ran on
+    seed = calibration_kwargs.get("seed")
+    chain.calibrate_SABR(**dict(calibration_kwargs, seed=chain.job_seed() + ([] if seed is None else [int(seed)])))
+    return chain
+
+
+def _calibrate_chunk(names, chain_kwargs, calibration_kwargs):
+    # one failing expiry shouldn't take the rest of its chunk down
+    results = []
+    for name in names:
+        try:
+            results.append(_calibrate_one(name, chain_kwargs, calibration_kwargs))
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+def calibrate_chains(names, max_workers=None, chunksize=1, timeout=None, chain_kwargs=None, valuation_time=None,
+                     **calibration_kwargs):
+    """
+    Builds and calibrates an option_prices instance per name on a process pool
+
+    names: instrument names or CSV paths
+    max_workers: number of processes (defaults to the number of cores)
+    chunksize: names sent to a worker at once, bigger chunks = less pickling overhead
+    timeout: seconds allowed per name (a chunk gets chunksize * timeout)
+    chain_kwargs: passed to option_prices (e.g. min_vol_ba_spread)
+    valuation_time: datetime every chain is valued at, defaults to now (once, for all of them)
+    calibration_kwargs: passed to option_prices.calibrate_SABR (method, seed, ...), an integer
+                        seed is combined with each chain's job_seed()
+
+    Returns a list in the same order as names. Failed or timed out names hold the
+    exception (e.g. TimeoutError) instead of the calibrated option_prices.
+    """
+    seed = calibration_kwargs.get("seed")
+    if seed is not None and not isinstance(seed, (int, np.integer)):
+        # a Generator can't be split between the processes reproducibly
+        raise TypeError(f"seed should be an integer or None, got {type(seed).__name__}")
+    names = list(names)
+    chain_kwargs = dict(chain_kwargs or {}, valuation_time=valuation_time or dt.now())
+    chunks = [names[i:i + chunksize] for i in range(0, len(names), chunksize)]
+
+    executor = ProcessPoolExecutor(max_workers=max_workers)
+    timed_out = False
+    results = []
+    try:
+        futures = [executor.submit(_calibrate_chunk, chunk, chain_kwargs, calibration_kwargs)
+                   for chunk in chunks]
+        # collected in submission order, so results line up with names
+        for chunk, future in zip(chunks, futures):
+            try:
+                results.extend(future.result(
+                    timeout=None if timeout is None else timeout*len(chunk)))
+            except TimeoutError:
+                timed_out = True
+                future.cancel()
+                results.extend(TimeoutError(f"calibration of {name} timed out")
+                               for name in chunk)
+            except Exception as e:
+                results.extend(e for _ in chunk)
+    finally:
+        # a running task can't be interrupted, don't block on it if something timed out
+        executor.shutdown(wait=not timed_out, cancel_futures=timed_out)
+    return results
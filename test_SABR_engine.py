@@ -0,0 +1,58 @@
+"""
+The batched multi-start calibration should find minima at least as good as the
+original one side at a time scipy restarts, on every bundled export
+"""
+import glob
+import os
+from datetime import datetime as dt
+import numpy as np
+import pytest
+import SABR_calibration as s
+import SABR_engine as engine
+from read_prices import option_prices
+
+EXPORTS = sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "*-export.csv")))
+VALUATION_TIME = dt(2024, 4, 1, 8)
+
+
+@pytest.mark.parametrize("path", EXPORTS, ids=os.path.basename)
+@pytest.mark.parametrize("seed", [0, 1])
+def test_batch_no_worse_than_sequential_restarts(path, seed):
+    a = option_prices(path=path, valuation_time=VALUATION_TIME)
+    sides = a._quote_sides()
+    results = engine.calibrate_SABR_batch(strike_sets=[side[2] for side in sides],
+                                          vol_sets=[side[3] for side in sides],
+                                          forward=a.atm, TTM=a.ttm, method="L-BFGS-B",
+                                          number_of_tries=10, init_values=[0.99, 1, -0.1, 0.99], seed=seed)
+
+    rng = np.random.default_rng(seed)
+    for (label, _, k, v), result in zip(sides, results):
+        sequential = min(s.calibrate_SABR(k, v, a.atm, a.ttm, method="L-BFGS-B",
+                                          init_param=[rng.uniform(0.01, 1), 1,
+                                                      rng.uniform(-1, 1), rng.uniform(0.01, 1)])[1]
+                         for _ in range(10))
+        assert result["mse"] <= sequential*(1 + 1e-4) + 1e-10, label
+
+
+def test_unpolished_batch_reports_convergence():
+    a = option_prices(path=EXPORTS[0], valuation_time=VALUATION_TIME)
+    strikes = a.calls["strike"].to_numpy()
+    low, high = a.calls["iv_bid"].to_numpy()/100, a.calls["iv_ask"].to_numpy()/100
+    rng = np.random.default_rng(0)
+    draws = low + rng.uniform(size=(20, len(strikes)))*(high - low)
+    quoted = ~np.isnan(draws)
+
+    stopped = engine.calibrate_SABR_batch(strike_sets=[strikes]*20, vol_sets=draws, forward=a.atm, TTM=a.ttm,
+                                          number_of_tries=2, steps_per_round=1, max_rounds=1, seed=0,
+                                          polish=False)
+    assert not any(result["converged"] for result in stopped)
+
+    results = engine.calibrate_SABR_batch(strike_sets=[strikes]*20, vol_sets=draws, forward=a.atm, TTM=a.ttm,
+                                          number_of_tries=2, steps_per_round=25, seed=0, polish=False)
+    assert sum(result["converged"] for result in results) >= 15
+    # a fit called converged is a minimum the scipy polish can't improve on
+    for draw, ok, result in zip(draws, quoted, results):
+        if result["converged"]:
+            _, polished = s.calibrate_SABR(strikes[ok], draw[ok], a.atm, a.ttm, method="L-BFGS-B",
+                                           init_param=result["params"])
+            assert result["mse"] <= polished*(1 + 1e-3) + 1e-10
@@ -0,0 +1,63 @@
+"""
+gk_price_and_greeks against finite differences of get_gk_price, with rates, for calls
+and puts, and written in place (out=) or not
+"""
+import warnings
+import numpy as np
+import pytest
+import SABR_functions as sabr
+
+TERM_RATE, BASE_RATE = 0.05, 0.02
+STRIKES = np.array([40000.0, 60000.0, 65000.0, 90000.0])[:, None]
+VOLS = np.array([0.4, 0.7, 1.1])[None, :]
+TTM = 0.4
+SPOT = 62000.0
+
+
+def price(w, spot=SPOT, vol=VOLS, ttm=TTM):
+    forward = spot*np.exp((TERM_RATE - BASE_RATE)*ttm)
+    return sabr.get_gk_price(w=w, forward=forward, term_rate=TERM_RATE, base_rate=BASE_RATE,
+                             ttm=ttm, vol=vol, strike=STRIKES)
+
+
+@pytest.mark.parametrize("w", [1, -1])
+def test_greeks_match_finite_differences(w):
+    forward = SPOT*np.exp((TERM_RATE - BASE_RATE)*TTM)
+    greeks = sabr.gk_price_and_greeks(w=w, forward=forward, strike=STRIKES, vol=VOLS, ttm=TTM,
+                                      term_rate=TERM_RATE, base_rate=BASE_RATE)
+    h_spot, h_vol, h_ttm = SPOT*1e-4, 1e-5, 1e-6
+
+    assert np.allclose(greeks.price, price(w), rtol=1e-12)
+    assert np.allclose(greeks.delta, (price(w, spot=SPOT + h_spot) - price(w, spot=SPOT - h_spot))/(2*h_spot),
+                       rtol=1e-6, atol=1e-9)
+    assert np.allclose(greeks.gamma, (price(w, spot=SPOT + h_spot) - 2*price(w) + price(w, spot=SPOT - h_spot))
+                       / h_spot**2, rtol=1e-4, atol=1e-10)
+    assert np.allclose(greeks.vega, (price(w, vol=VOLS + h_vol) - price(w, vol=VOLS - h_vol))/(2*h_vol),
+                       rtol=1e-6)
+    # calendar time passing shortens the TTM, the spot stays
+    assert np.allclose(greeks.theta, -(price(w, ttm=TTM + h_ttm) - price(w, ttm=TTM - h_ttm))/(2*h_ttm),
+                       rtol=1e-5)
+
+
+@pytest.mark.parametrize("w", [1, -1, np.array([[1], [-1], [1], [-1]])])
+def test_out_matches_fresh_arrays(w):
+    forward = SPOT*np.exp((TERM_RATE - BASE_RATE)*TTM)
+    kwargs = dict(w=w, forward=forward, strike=STRIKES, vol=VOLS, ttm=TTM, term_rate=TERM_RATE,
+                  base_rate=BASE_RATE)
+    out = sabr.GKGreeks(*(np.full((4, 3), np.nan) for _ in range(5)))
+    written = sabr.gk_price_and_greeks(out=out, **kwargs)
+    fresh = sabr.gk_price_and_greeks(**kwargs)
+    for name, array, expected in zip(fresh._fields, written, fresh):
+        assert array is getattr(out, name)
+        assert np.array_equal(array, expected), name
+
+
+def test_implied_volatility_extremes_dont_warn():
+    prices = np.array([1e-300, 1e-12, 0.5, 5000, 59999, 1e5, np.nan, 0])[:, None, None]
+    strikes = np.array([1e-3, 100, 60000, 1e6, 1e300])[None, :, None]
+    ttms = np.array([1e-12, 0.5, 1e8])
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        for w in (1, -1):
+            vols = sabr.implied_volatility(prices, 60000, strikes, ttms, w)
+    assert vols.shape == (8, 5, 3)
@@ -0,0 +1,27 @@
+"""
+A clean lognormal density on a coarse grid should pass check_density when the
+analytic cdf is given, even though its trapezoid integral overshoots 1
+"""
+import numpy as np
+from scipy.stats import lognorm
+import density_checks as checks
+
+
+def test_analytic_cdf_ignores_quadrature_error():
+    distribution = lognorm(s=0.8, scale=3000)
+    strikes = np.linspace(1, 60000, 101)
+    pdf, cdf = distribution.pdf(strikes), distribution.cdf(strikes)
+
+    trapezoid = checks.check_density(strikes, pdf, cdf[0], cdf[-1])
+    analytic = checks.check_density(strikes, pdf, cdf[0], cdf[-1], cdf=cdf)
+    assert trapezoid.max_cdf > 1 + 1e-4
+    assert not trapezoid.arbitrage_free
+    assert analytic.max_cdf <= 1
+    assert analytic.arbitrage_free
+
+
+def test_analytic_cdf_still_flags_overshoot():
+    strikes = np.linspace(0, 1, 11)
+    cdf = np.clip(strikes*1.1, 0, None)
+    report = checks.check_density(strikes, np.full(11, 1.1), cdf[0], cdf[-1], cdf=cdf)
+    assert not report.arbitrage_free
@@ -0,0 +1,91 @@
+"""
+DensityService on a thread pool with a fake clock: identical concurrent requests share
+one calibration, the cache expires after ttl and invalidate() forgets running work
+"""
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime as dt
+import pytest
+import density_service
+from density_service import DensityService
+from instrumentation import metrics
+
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+VALUATION_TIME = dt(2024, 4, 1, 8)
+
+
+class FakeClock():
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def gate(monkeypatch):
+    # calibrations wait for the gate, the test decides when they finish
+    gate = threading.Event()
+    calibrate = density_service._calibrate
+
+    def gated(*args):
+        gate.wait(30)
+        return calibrate(*args)
+
+    monkeypatch.setattr(density_service, "_calibrate", gated)
+    return gate
+
+
+@pytest.fixture
+def service():
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        yield DensityService(directory=DIRECTORY, ttl=60, executor=executor, valuation_time=VALUATION_TIME,
+                             calibration_kwargs={"model": "svi"}, clock=FakeClock())
+
+
+def calibrations():
+    return metrics.snapshot()["counters"].get("service_calibration", 0)
+
+
+def test_coalescing_and_ttl(service, gate):
+    async def run():
+        metrics.reset()
+        requests = [asyncio.ensure_future(service.density("BTC", "27SEP24")) for _ in range(3)]
+        await asyncio.sleep(0.05)
+        assert calibrations() == 1
+        assert metrics.snapshot()["counters"]["service_coalesced"] >= 2
+        gate.set()
+        results = await asyncio.gather(*requests)
+        assert all(result is results[0] for result in results)
+
+        assert await service.density("BTC", "27SEP24") is results[0]
+        assert calibrations() == 1
+
+        service.clock.now += 61
+        refreshed = await service.density("BTC", "27SEP24")
+        assert calibrations() == 2
+        assert refreshed is not results[0]
+
+    asyncio.run(run())
+
+
+def test_invalidate_drops_running_calibrations(service, gate):
+    async def run():
+        metrics.reset()
+        stale = asyncio.ensure_future(service.chain("BTC", "27SEP24"))
+        await asyncio.sleep(0.05)
+        service.invalidate("BTC", "27SEP24")
+        gate.set()
+        stale = await stale
+        assert not service._cache
+        assert await service.chain("BTC", "27SEP24") is not stale
+        assert calibrations() == 2
+
+    asyncio.run(run())
+
+
+def test_invalidate_needs_the_underlying(service):
+    with pytest.raises(ValueError):
+        service.invalidate(expiry="27SEP24")
@@ -0,0 +1,22 @@
+"""
+A chain rebuilt from its compact OptionChain keeps what option_prices needs
+"""
+import glob
+import os
+from datetime import datetime as dt
+import numpy as np
+from option_chain import OptionChain
+from read_prices import option_prices
+
+EXPORTS = sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "*-export.csv")))
+VALUATION_TIME = dt(2024, 4, 1, 8)
+
+
+def test_rebuilt_chain_fills_implied_vols():
+    a = option_prices(path=EXPORTS[0], valuation_time=VALUATION_TIME)
+    rebuilt = OptionChain.from_prices(a).to_prices()
+    a.fill_implied_vols()
+    rebuilt.fill_implied_vols()
+    marks = a.df["iv_mark"].reindex(rebuilt.filterfree_df.index).to_numpy()
+    assert np.isfinite(rebuilt.filterfree_df["iv_mark"]).any()
+    assert np.allclose(rebuilt.filterfree_df["iv_mark"], marks, equal_nan=True)
@@ -0,0 +1,81 @@
+"""
+Replays the bundled exports as synthetic tick streams: the chain patched by
+apply_quotes should be the one a fresh option_prices builds from the same quotes
+"""
+import glob
+import os
+from datetime import datetime as dt
+import numpy as np
+import pandas as pd
+import pytest
+from read_prices import option_prices
+from quote_stream import replay_quotes
+
+EXPORTS = sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "*-export.csv")))
+VALUATION_TIME = dt(2024, 4, 1, 8)
+
+
+@pytest.mark.parametrize("path", EXPORTS, ids=os.path.basename)
+def test_replay_matches_rebuild(path):
+    a = option_prices(path=path, valuation_time=VALUATION_TIME)
+    for updates in replay_quotes(a.filterfree_df, batch_size=4, n_ticks=50, seed=0):
+        a.apply_quotes(updates)
+
+        fresh = option_prices(df=a.filterfree_df, valuation_time=VALUATION_TIME)
+        assert a.atm == pytest.approx(fresh.atm, abs=0.01)
+        assert a.df.index.sort_values().equals(fresh.df.index.sort_values())
+
+
+@pytest.mark.parametrize("path", EXPORTS, ids=os.path.basename)
+def test_calibrated_replay_matches_rebuild(path):
+    a = option_prices(path=path, valuation_time=VALUATION_TIME)
+    a.calibrate_SABR(method="L-BFGS-B")
+    for updates in replay_quotes(a.filterfree_df, batch_size=4, n_ticks=30, seed=0):
+        a.apply_quotes(updates)
+    strikes, pdf, cdf = a.density()
+
+    fresh = option_prices(df=a.filterfree_df, valuation_time=VALUATION_TIME)
+    fresh.calibrate_SABR(method="L-BFGS-B")
+    fresh_strikes, fresh_pdf, fresh_cdf = fresh.density()
+    k = np.linspace(max(strikes[0], fresh_strikes[0]), min(strikes[-1], fresh_strikes[-1]), 500)
+    assert np.max(np.abs(np.interp(k, strikes, cdf) - np.interp(k, fresh_strikes, fresh_cdf))) < 0.01
+    assert (np.max(np.abs(np.interp(k, strikes, pdf) - np.interp(k, fresh_strikes, fresh_pdf)))
+            < 0.05*np.max(fresh_pdf))
+
+
+def test_filter_follows_the_touched_spreads():
+    a = option_prices(path=EXPORTS[0], valuation_time=VALUATION_TIME)
+    df = a.filterfree_df
+    liquid = a.df.index[:3]
+    illiquid = df.index[df["vol_bid_ask_spread"] >= a.min_vol_ba_spread][:2]
+    strike = df["strike"].max() + 10000
+    new = f"{a.underlying}-{a.exp.strftime('%d%b%y').upper()}-{strike:.0f}-C"
+    widened = df.loc[liquid, ["iv_bid"]].assign(iv_ask=df.loc[liquid, "iv_bid"] + 20)
+    narrowed = df.loc[illiquid, ["iv_bid"]].assign(iv_ask=df.loc[illiquid, "iv_bid"] + 1)
+    added = pd.DataFrame({"iv_bid": [80.0], "iv_ask": [82.0], "bid": [0.01], "ask": [0.011]}, index=[new])
+    a.apply_quotes(pd.concat([widened, narrowed, added]))
+
+    fresh = option_prices(df=a.filterfree_df, valuation_time=VALUATION_TIME)
+    assert a.df.index.sort_values().equals(fresh.df.index.sort_values())
+    assert not a.df.index.isin(liquid).any()
+    assert a.df.index.isin(illiquid).sum() == len(illiquid)
+    assert new in a.df.index
+
+
+def test_drift_is_per_quote():
+    # new strikes quoted as far from the fit as the old ones on average: the sum of
+    # squared errors grows with the number of quotes, the error per quote doesn't
+    a = option_prices(path=EXPORTS[0], valuation_time=VALUATION_TIME)
+    a.calibrate_SABR(method="L-BFGS-B")
+    calls = a.calls["strike"].to_numpy()
+    strikes = (calls[1:] + calls[:-1])/2
+    updates = {}
+    for attribute, column in [("SABR_call_params_asks", "iv_ask"), ("SABR_call_params_bids", "iv_bid")]:
+        result = a.calibration_results[attribute]
+        rms = np.sqrt(result["mse"]/np.count_nonzero(a.calls[column].notna()))
+        signs = np.where(np.arange(len(strikes)) % 2, 1, -1)
+        updates[column] = 100*(a.side_model(attribute).vol(strikes) + signs*rms)
+    index = [f"{a.underlying}-{a.exp.strftime('%d%b%y').upper()}-{k:g}-C" for k in strikes]
+    updates = pd.DataFrame(updates, index=index).assign(bid=0.01, ask=0.011)
+
+    assert a.apply_quotes(updates)["recalibrated"] == []
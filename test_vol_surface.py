@@ -0,0 +1,48 @@
+"""
+The surface interpolates total variance between the listed smiles: no calendar
+arbitrage between the expiries, and densities consistent with the interpolated vols
+"""
+import glob
+import os
+from datetime import datetime as dt
+import numpy as np
+import pytest
+import density_checks as checks
+from vol_surface import VolSurface
+
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+VALUATION_TIME = dt(2024, 4, 1, 8)
+
+
+@pytest.fixture(scope="module")
+def surface():
+    surface = VolSurface.from_exports(sorted(glob.glob(os.path.join(DIRECTORY, "BTC-*-export.csv"))),
+                                      valuation_time=VALUATION_TIME)
+    surface.calibrate(seed=0)
+    return surface
+
+
+def test_no_calendar_arbitrage_between_expiries(surface):
+    ttms = np.linspace(surface.ttms[0]/2, surface.ttms[-1]*1.5, 60)
+    forwards = surface.forward(ttms)
+    strikes = forwards[:, None]*np.exp(np.linspace(-1, 1, 41))
+    variance = surface.vol(strikes, ttms[:, None], side="ask")**2*ttms[:, None]
+    assert np.max(checks.calendar_arbitrage(variance)) <= 1e-10
+
+
+def test_listed_expiries_keep_their_smile(surface):
+    for chain in surface.chains:
+        strikes = chain.calls["strike"].to_numpy()
+        assert np.allclose(surface.vol(strikes, chain.ttm, side="ask"),
+                           chain.side_model("SABR_call_params_asks").vol(strikes), rtol=1e-10)
+
+
+def test_strike_derivatives(surface):
+    ttm = surface.ttms[:2].mean()
+    strikes = surface.forward(ttm)*np.exp(np.linspace(-0.8, 0.8, 9))
+    h = strikes*1e-4
+    vol, dvol_dk, d2vol_dk2 = surface._smile(strikes, ttm, "mid", derivatives=True)
+    up, down = surface.vol(strikes + h, ttm), surface.vol(strikes - h, ttm)
+    assert np.allclose(vol, surface.vol(strikes, ttm))
+    assert np.allclose(dvol_dk, (up - down)/(2*h), rtol=1e-5)
+    assert np.allclose(d2vol_dk2, (up - 2*vol + down)/h**2, rtol=1e-3, atol=1e-14)
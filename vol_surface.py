@@ -0,0 +1,357 @@
+"""
+SABR volatility surface over the listed expiries of one underlying
+
+    surface = VolSurface.from_names(["BTC-26APR", "BTC-27SEP", "BTC-27DEC"])
+    surface.calibrate(method="L-BFGS-B", seed=0)
+    surface.vol(60000, ttm=0.5)                 # between two listed expiries
+    strikes, pdf, cdf = surface.density(0.5)
+
+The nearest expiry is calibrated cold (multi-start, see SABR_engine), every further
+expiry starts from the fit of its shorter neighbour, then all the expiries are refit
+together with a penalty on the roughness of alpha, rho and nu in time:
+
+    sum of the per expiry mse + smoothness * sum_i |theta_i - theta_i-1|^2 / (t_i - t_i-1)
+
+(the integral of |dtheta/dt|^2 along a linear path, in units of the parameter box).
+Between two expiries the total variance vol^2*TTM is interpolated linearly in TTM at fixed
+log-moneyness log(strike/forward) between their two smiles, the forward linearly in TTM.
+Outside the listed expiries the vol is held flat at fixed log-moneyness. Total variance
+then only grows with the TTM if it does from one listed smile to the next, interpolating
+the SABR parameters instead creates calendar arbitrage between the expiries.
+"""
+import logging
+from collections import OrderedDict
+from datetime import datetime as dt
+import numpy as np
+from scipy.optimize import minimize
+import chain_loader as loader
+import SABR_calibration as s
+import SABR_engine as engine
+import SABR_functions as sabr
+import density_checks as checks
+from instrumentation import metrics, timed
+from read_prices import option_prices, sinh_grid, SABR_PARAM_ATTRIBUTES
+
+SIDES = {"mid": ["SABR_call_params_asks", "SABR_call_params_bids"],
+         "bid": ["SABR_call_params_bids"],
+         "ask": ["SABR_call_params_asks"]}
+
+
+def _surface_context(surface, *args, **kwargs):
+    return {"underlying": surface.underlying, "expiries": len(surface.chains)}
+
+
+class VolSurface():
+    def __init__(self, chains, beta=1, density_cache_size=128):
+        """
+        chains: option_prices instances of the same underlying, one per expiry
+        density_cache_size: number of (ttm, side, bins) densities kept by density()
+        """
+        if not chains:
+            raise ValueError("a surface needs at least one chain")
+        underlyings = {chain.underlying for chain in chains}
+        if len(underlyings) > 1:
+            raise ValueError(f"chains of several underlyings: {sorted(underlyings)}")
+
+        self.chains = sorted(chains, key=lambda chain: chain.ttm)
+        self.underlying = self.chains[0].underlying
+        self.beta = beta
+        self.density_cache_size = density_cache_size
+        self._densities = OrderedDict()
+
+    @classmethod
+    def from_names(cls, names, directory=None, chain_kwargs=None, valuation_time=None, **kwargs):
+        """
+        names: one export name (e.g. "BTC-27SEP") per expiry, see option_prices
+        valuation_time: datetime all the expiries are valued at, defaults to now
+        """
+        chain_kwargs = dict(chain_kwargs or {}, valuation_time=valuation_time or dt.now())
+        chains = [option_prices(name=name, directory=directory, **chain_kwargs) for name in names]
+        return cls(chains, **kwargs)
+
+    @classmethod
+    def from_exports(cls, paths, chain_kwargs=None, valuation_time=None, **kwargs):
+        """
+        paths: export paths or a directory, one chain is built per underlying and expiry found in them
+        valuation_time: datetime all the expiries are valued at, defaults to now
+        """
+        df = loader.read_exports(paths)
+        chain_kwargs = dict(chain_kwargs or {}, valuation_time=valuation_time or dt.now())
+        chains = [option_prices(df=group, **chain_kwargs) for _, group in df.groupby(["underlying", "date"])]
+        return cls(chains, **kwargs)
+
+    @property
+    def ttms(self):
+        return np.array([chain.ttm for chain in self.chains], dtype=float)
+
+    @property
+    def forwards(self):
+        return np.array([chain.atm for chain in self.chains], dtype=float)
+
+    def _check_ttms(self):
+        ttms = self.ttms
+        if np.any(ttms <= 0):
+            expired = [chain.exp.date() for chain in self.chains if chain.ttm <= 0]
+            raise ValueError(f"expired chains in the surface: {expired}")
+        if np.any(np.diff(ttms) <= 0):
+            raise ValueError("two chains of the surface have the same expiry")
+        return ttms
+
+    @timed("calibrate_surface", context=_surface_context)
+    def calibrate(self, method="L-BFGS-B", smoothness=1e-4, warm_start=True, number_of_tries=10,
+                  warm_tries=3, seed=None, max_evals=None):
+        """
+        Calibrates every expiry, then refits them jointly (see the module docstring)
+
+        method: scipy method of the per expiry fits
+        smoothness: weight of the roughness penalty in time, 0 keeps the per expiry fits
+        warm_start: start each expiry from its shorter neighbour's fit, with only warm_tries
+                    random restarts next to it instead of number_of_tries
+        number_of_tries, seed: random restarts of the cold fits (see option_prices.calibrate_SABR),
+                               the seed defaults to one derived from every expiry's job_seed()
+        max_evals: evaluation budget of the joint refit
+        """
+        ttms = self._check_ttms()
+        rng = np.random.default_rng([x for chain in self.chains for x in chain.job_seed()]
+                                    if seed is None else seed)
+        previous = None
+        for chain in self.chains:
+            if previous is None or not warm_start:
+                chain.calibrate_SABR(method=method, number_of_tries=number_of_tries, seed=rng)
+            else:
+                self._warm_start(chain, previous, method, warm_tries, rng)
+            previous = chain
+
+        if smoothness > 0 and len(self.chains) > 1:
+            self._joint_fit(ttms, smoothness, max_evals)
+        self._store_smiles()
+        self.check_calendar()
+
+    def _warm_start(self, chain, neighbour, method, warm_tries, rng):
+        # the neighbour's fit alone can sit in the wrong basin (puts especially), a few
+        # random starts compete with it in the same batch
+        sides = chain._quote_sides()
+        results = engine.calibrate_SABR_batch(strike_sets=[side[2] for side in sides],
+                                              vol_sets=[side[3] for side in sides],
+                                              forward=chain.atm,
+                                              TTM=chain.ttm,
+                                              method=method,
+                                              number_of_tries=warm_tries,
+                                              init_values=[getattr(neighbour, side[1]) for side in sides],
+                                              seed=rng,
+                                              beta=self.beta)
+        chain.calibration_results = {}
+        for side, result in zip(sides, results):
+            setattr(chain, side[1], result["params"])
+            chain.calibration_results[side[1]] = dict(result, source="neighbour")
+        chain._densities = {}
+
+    def _joint_fit(self, ttms, smoothness, max_evals):
+        # every side of every expiry in one (sides, expiries, 3) array
+        n_expiries = len(self.chains)
+        strike_sets, vol_sets, forwards, x0 = [], [], [], []
+        for attribute in SABR_PARAM_ATTRIBUTES:
+            for chain in self.chains:
+                side = {a: (k, v) for _, a, k, v in chain._quote_sides()}[attribute]
+                strike_sets.append(side[0])
+                vol_sets.append(side[1])
+                forwards.append(chain.atm)
+                alpha, _, rho, nu = getattr(chain, attribute)
+                x0.append([alpha, rho, nu])
+        strikes, vols, weights = engine.stack_sides(strike_sets, vol_sets, forwards)
+        forwards = np.array(forwards)[:, None, None]
+        side_ttms = np.tile(ttms, len(SABR_PARAM_ATTRIBUTES))[:, None, None]
+        gaps = np.diff(ttms)[None, :, None]
+        shape = (len(SABR_PARAM_ATTRIBUTES), n_expiries, 3)
+        # optimised in units of the parameter box, alpha, rho and nu weigh the same in the penalty
+        scale = engine.UPPER - engine.LOWER
+
+        def objective(u):
+            params = engine.LOWER + u.reshape(shape)*scale
+            mse, grad = engine.batch_mse(params.reshape(-1, 1, 3), strikes, vols, weights,
+                                         forwards, side_ttms, self.beta)
+            grad = grad.reshape(shape)*scale
+            jumps = np.diff(u.reshape(shape), axis=1)
+            penalty_grad = 2*smoothness*jumps/gaps
+            grad[:, 1:] += penalty_grad
+            grad[:, :-1] -= penalty_grad
+            return mse.sum() + smoothness*np.sum(jumps**2/gaps), grad.ravel()
+
+        u0 = ((np.reshape(x0, shape) - engine.LOWER)/scale).ravel()
+        options = {} if max_evals is None else {"maxfun": int(max_evals)}
+        result = minimize(objective, u0, jac=True, method="L-BFGS-B",
+                          bounds=[(0, 1)]*len(u0), options=options)
+        metrics.emit("optimizer", method="L-BFGS-B", success=result.success, status=result.status,
+                     nfev=result.nfev, nit=result.get("nit"), fun=result.fun, message=result.message)
+
+        params = engine.LOWER + result.x.reshape(shape)*scale
+        mse, _ = engine.batch_mse(params.reshape(-1, 1, 3), strikes, vols, weights,
+                                  forwards, side_ttms, self.beta)
+        mse = mse.reshape(shape[:2])
+        for i, attribute in enumerate(SABR_PARAM_ATTRIBUTES):
+            for j, chain in enumerate(self.chains):
+                alpha, rho, nu = params[i, j]
+                chain_params = [alpha, self.beta, rho, nu]
+                setattr(chain, attribute, chain_params)
+                chain.calibration_results[attribute] = {"params": chain_params, "mse": float(mse[i, j]),
+                                                        "nfev": int(result.nfev), "source": "surface"}
+                chain._densities = {}
+
+    def _store_smiles(self):
+        # the [alpha, beta, rho, nu] of every expiry per side, the nodes of the interpolation
+        self._smiles = {attribute: np.array([getattr(chain, attribute) for chain in self.chains], dtype=float)
+                        for attribute in SABR_PARAM_ATTRIBUTES}
+        self._densities.clear()
+
+    def _neighbours(self, ttm):
+        # indices of the listed expiries around ttm and the weight of the longer one,
+        # ttm is clipped to the listed expiries
+        ttms = self.ttms
+        inside = np.clip(ttm, ttms[0], ttms[-1])
+        if len(ttms) == 1:
+            return np.zeros(np.shape(ttm), dtype=int), np.zeros(np.shape(ttm), dtype=int), 0*inside, inside
+        upper = np.clip(np.searchsorted(ttms, inside), 1, len(ttms) - 1)
+        lower = upper - 1
+        weight = (inside - ttms[lower])/(ttms[upper] - ttms[lower])
+        return lower, upper, weight, inside
+
+    def _side_smile(self, strike, ttm, attribute, derivatives=False):
+        # total variance of the two neighbouring smiles at the same log-moneyness, see the
+        # module docstring. strike k maps to k*F_j/F on expiry j, so dk_j/dk = F_j/F
+        if not hasattr(self, "_smiles"):
+            raise ValueError("the surface isn't calibrated, call calibrate() first")
+        strike, ttm = np.broadcast_arrays(np.asarray(strike, dtype=float), np.asarray(ttm, dtype=float))
+        lower, upper, weight, inside = self._neighbours(ttm)
+        forward = self.forward(ttm)
+        variance = np.zeros(strike.shape)
+        dvariance = np.zeros(strike.shape)
+        d2variance = np.zeros(strike.shape)
+        for j, chain in enumerate(self.chains):
+            share = np.where(lower == j, 1 - weight, 0) + np.where(upper == j, weight, 0)
+            if not np.any(share):
+                continue
+            alpha, beta, rho, nu = self._smiles[attribute][j]
+            ratio = chain.atm/forward
+            vol, dvol_dk, d2vol_dk2 = sabr.strike_volatility_SABR_strike_derivatives(
+                k=strike*ratio, f=chain.atm, alpha=alpha, beta=beta, nu=nu, rho=rho, t=chain.ttm)
+            share = share*chain.ttm
+            variance += share*vol**2
+            dvariance += share*2*vol*dvol_dk*ratio
+            d2variance += share*2*(dvol_dk**2 + vol*d2vol_dk2)*ratio**2
+        # flat vol outside the listed expiries: the variance per unit of TTM of the nearest one
+        vol = np.sqrt(variance/inside)
+        if not derivatives:
+            return vol
+        dvol_dk = dvariance/(2*inside*vol)
+        d2vol_dk2 = (d2variance/(2*inside) - dvol_dk**2)/vol
+        return vol, dvol_dk, d2vol_dk2
+
+    def forward(self, ttm):
+        """
+        Forward at TTM ttm, linear in TTM between the expiries' put-call parity forwards
+        """
+        return np.interp(ttm, self.ttms, self.forwards)
+
+    def _smile(self, strike, ttm, side, derivatives=False):
+        if side not in SIDES:
+            raise ValueError("side should be 'mid', 'bid' or 'ask'")
+        results = [self._side_smile(strike, ttm, attribute, derivatives) for attribute in SIDES[side]]
+        if not derivatives:
+            return sum(results)/len(results)
+        return tuple(sum(r[i] for r in results)/len(results) for i in range(3))
+
+    def vol(self, strike, ttm, side="mid"):
+        """
+        SABR vol (decimal) of the call smile at (strike, ttm), both broadcast together
+        """
+        return self._smile(np.asarray(strike, dtype=float), np.asarray(ttm, dtype=float), side)
+
+    def price(self, strike, ttm, w=1, side="mid"):
+        """
+        Undiscounted price (in USD) of a call (w=1) or put (w=-1) at (strike, ttm)
+        """
+        strike = np.asarray(strike, dtype=float)
+        ttm = np.asarray(ttm, dtype=float)
+        return sabr.get_gk_price(w=w,
+                                 forward=self.forward(ttm),
+                                 term_rate=0,
+                                 base_rate=0,
+                                 ttm=ttm,
+                                 vol=self._smile(strike, ttm, side),
+                                 strike=strike)
+
+    def grid(self, ttm, n=101):
+        """
+        sinh strike grid around the forward at ttm, over the liquid strikes of all the
+        expiries (+ 40000 above, as option_prices.pdf_grid)
+        """
+        forward = float(self.forward(ttm))
+        lower = min(np.min(chain.df["strike"]) for chain in self.chains)
+        upper = max(np.max(chain.df["strike"]) for chain in self.chains) + 40000
+        concentration = abs(float(self.vol(forward, ttm)))*np.sqrt(ttm)
+        return sinh_grid(forward, lower, upper, concentration, n)
+
+    def check_calendar(self, side="mid", points=41, tolerance=1e-6):
+        """
+        Calendar spread arbitrage: total variance vol^2*TTM has to grow with the TTM at fixed
+        log-moneyness. Checked between the listed expiries and half way between them, on
+        points log-moneyness values over the liquid strikes of all the expiries
+
+        Returns the largest total variance drop (see density_checks.calendar_arbitrage)
+        from each checked TTM to the next
+        """
+        ttms = self.ttms
+        ttms = np.sort(np.concatenate([ttms, (ttms[1:] + ttms[:-1])/2]))
+        forwards = self.forward(ttms)
+        lower = min(np.log(np.min(chain.df["strike"])/chain.atm) for chain in self.chains)
+        upper = max(np.log(np.max(chain.df["strike"])/chain.atm) for chain in self.chains)
+        strikes = forwards[:, None]*np.exp(np.linspace(lower, upper, points))
+        variance = self.vol(strikes, ttms[:, None], side)**2*ttms[:, None]
+        drops = checks.calendar_arbitrage(variance)
+        for i in np.flatnonzero(drops > tolerance):
+            metrics.count("arbitrage_detected")
+            metrics.emit("calendar_arbitrage", level=logging.WARNING, underlying=self.underlying,
+                         side=side, ttm=ttms[i], next_ttm=ttms[i+1], variance_drop=drops[i])
+        return drops
+
+    def implied_pdf(self, ttm, grid=None, side="mid", bins=200, repair=False):
+        """
+        Breeden-Litzenberger density at TTM ttm (see option_prices.implied_pdf, method="analytic",
+        for repair)
+
+        Returns (strikes, pdf, cdf), pdf is a probability per unit of strike
+        """
+        if ttm <= 0:
+            raise ValueError("ttm should be positive")
+        grid = self.grid(ttm, bins+1) if grid is None else np.asarray(grid, dtype=float)
+        vol, dvol_dk, d2vol_dk2 = self._smile(grid, ttm, side, derivatives=True)
+        pdf, cdf = sabr.breeden_litzenberger(forward=self.forward(ttm),
+                                             ttm=ttm,
+                                             strike=grid,
+                                             vol=vol,
+                                             dvol_dk=dvol_dk,
+                                             d2vol_dk2=d2vol_dk2)
+        if not repair:
+            return grid, pdf, cdf
+        report = checks.check_density(grid, pdf, cdf[0], cdf[-1], cdf=cdf)
+        if not report.arbitrage_free:
+            metrics.emit("density", level=logging.WARNING, underlying=self.underlying, ttm=ttm, side=side,
+                         **{field: np.asarray(value).item() for field, value in report._asdict().items()})
+        pdf, cdf = checks.repair_density(grid, pdf, report.lower_tail, report.upper_tail)
+        return grid, pdf, cdf
+
+    def density(self, ttm, side="mid", bins=200):
+        """
+        implied_pdf on its default grid, repaired, the last density_cache_size results are
+        kept until the next calibration
+        """
+        key = (float(ttm), side, bins)
+        if key in self._densities:
+            self._densities.move_to_end(key)
+            metrics.count("density_cache_hit")
+            return self._densities[key]
+        result = self.implied_pdf(ttm, side=side, bins=bins, repair=True)
+        self._densities[key] = result
+        while len(self._densities) > self.density_cache_size:
+            self._densities.popitem(last=False)
+        return result